@@ -77,5 +77,6 @@ for i, t in enumerate(timestamps):
         center_y + i / len(timestamps) * extent * math.sin(current_angle)
     ))
 
-# finally close the nix file
+# write any data still buffered in memory and close the nix file
+data_file.flush()
 nix_file.close()
@@ -67,5 +67,6 @@ for i, t in enumerate(timestamps[1:], start=1):
 # Indicate that we saw last timestamp
 data_file.notify_saw_last_timestamp()
 
-# finally close the nix file
+# write any data still buffered in memory and close the nix file
+data_file.flush()
 nix_file.close()
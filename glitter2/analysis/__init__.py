@@ -2,32 +2,59 @@
 ================
 
 """
+import os
 from os.path import exists
+import h5py
 import nixio as nix
 import numpy as np
 import numpy.linalg
-from typing import Dict, List, Tuple, Type, Union, Set, Any, Optional, Iterator
+from math import pi
+from typing import Dict, List, Tuple, Type, Union, Set, Any, Optional, \
+    Iterator, Callable, FrozenSet, Hashable
+import inspect
 import pandas as pd
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping
+from functools import partial
 
 from kivy_garden.collider import Collide2DPoly, CollideEllipse
 
 from kivy_garden.painter import PaintCircle, PaintEllipse, PaintPolygon, \
     PaintFreeformPolygon, PaintPoint, PaintShape
 
-from glitter2.storage.data_file import DataFile
+from glitter2.storage.data_file import DataFile, EventChannelData, \
+    PosChannelData
+from glitter2.analysis.collide import ZoneCollider, zone_collider_from_state, \
+    collide_any_zone
 
 __all__ = (
     'default_value', 'not_cached', 'AnalysisFactory', 'AnalysisSpec',
-    'FileDataAnalysis', 'AnalysisChannel', 'TemporalAnalysisChannel',
-    'EventAnalysisChannel', 'PosAnalysisChannel', 'ZoneAnalysisChannel',
-    'get_variable_type_optional')
+    'FileDataAnalysis', 'LazyChannelsData', 'ComputeCache',
+    'AnalysisChannel', 'TemporalAnalysisChannel', 'EventAnalysisChannel',
+    'PosAnalysisChannel', 'ZoneAnalysisChannel', 'get_variable_type_optional')
 
 
 def _sort_dict(d: dict) -> List[tuple]:
     return list(sorted(d.items(), key=lambda x: x[0]))
 
 
+def _get_property_table(items: List[tuple]) -> Dict[str, list]:
+    return {
+        'Property': [key for key, _ in items],
+        'Value': [value for _, value in items]}
+
+
+def _get_column_array(data: Union[np.ndarray, list]) -> np.ndarray:
+    """Returns the column as an array, converting non-numeric lists (e.g.
+    the metadata values) to strings.
+    """
+    if isinstance(data, np.ndarray):
+        return data
+    if all(isinstance(v, (int, float, bool)) for v in data):
+        return np.asarray(data)
+    return np.array([str(v) for v in data], dtype=str)
+
+
 def _get_flat_types(type_hint: Type) -> Tuple[Type]:
     if hasattr(type_hint, '__origin__') and type_hint.__origin__ is Union:
         return type_hint.__args__
@@ -215,15 +242,19 @@ class AnalysisSpec:
         Tuple[Optional[List[str]], str, Type['AnalysisChannel'], str, tuple,
               dict]] = []
 
+    _compute_plan: Optional[List[tuple]] = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._default_args = defaultdict(dict)
         self._new_channels = []
         self._computations = []
+        self._compute_plan = None
 
     def add_arg_default(
             self, cls: Type['AnalysisChannel'], name: str, value: Any):
         self._default_args[cls][name] = value
+        self._compute_plan = None
 
     def add_new_channel_computation(
             self, channel: str, new_channel_name: str, compute_method,
@@ -240,6 +271,7 @@ class AnalysisSpec:
             compute_method)
         self._computations.append(
             (channels, compute_key, cls, method_name, args, kwargs))
+        self._compute_plan = None
 
     def compute_create_channels(self, analysis_object: 'FileDataAnalysis'):
         default_args = self._default_args
@@ -273,13 +305,58 @@ class AnalysisSpec:
             add = getattr(analysis_object, f'add_{ret_type}_channel')
             add(new_name, *res)
 
-    def compute(self, analysis_object: 'FileDataAnalysis') -> list:
-        output = []
-        default_args = self._default_args
-        cls_cache = {}
+    def get_compute_plan(self) -> List[tuple]:
+        """Returns the computations added with :meth:`add_computation`,
+        along with the key of the active intervals used by each computation.
+
+        The key contains the value of the method's arguments that select the
+        active intervals (see :attr:`AnalysisChannel._interval_args_`), after
+        replacing the defaults with the value that will be used. Computations
+        of a channel with the same key use the same active intervals.
+
+        The plan only depends on the spec, so it's created once and reused
+        for all the files.
+        """
+        if self._compute_plan is not None:
+            return self._compute_plan
 
+        default_args = self._default_args
+        plan = self._compute_plan = []
         for channels, compute_key, cls, method_name, args, kwargs in \
                 self._computations:
+            brief_name = method_name
+            if brief_name.startswith('compute_'):
+                brief_name = brief_name[8:]
+
+            bound = inspect.signature(getattr(cls, method_name)).bind_partial(
+                None, *args, **kwargs)
+            bound.apply_defaults()
+            cls_defaults = default_args.get(cls, {})
+
+            interval_key = []
+            for name in cls._interval_args_:
+                if name not in bound.arguments:
+                    continue
+                value = bound.arguments[name]
+                if value is default_value:
+                    # same as AnalysisChannel.get_args
+                    value = cls_defaults.get(name, getattr(cls, name, None))
+                interval_key.append(value)
+
+            plan.append((
+                channels, compute_key, cls, method_name, brief_name, args,
+                kwargs, tuple(interval_key)))
+        return plan
+
+    def compute(self, analysis_object: 'FileDataAnalysis') -> list:
+        default_args = self._default_args
+
+        # group the computations by channel, and for each channel by their
+        # active intervals, so the intervals are only computed once
+        channel_groups = defaultdict(lambda: defaultdict(list))
+        n = 0
+        for channels, compute_key, cls, method_name, brief_name, args, \
+                kwargs, interval_key in self.get_compute_plan():
             if not channels:
                 if cls.analysis_type == 'event':
                     channels = analysis_object.event_channels_data.keys()
@@ -289,37 +366,215 @@ class AnalysisSpec:
                     channels = analysis_object.zone_channels_shapes.keys()
 
             for channel in channels:
-                cache_key = cls, channel
-                if cache_key not in cls_cache:
-                    obj = cls_cache[cache_key] = cls(
-                        name=channel, analysis_object=analysis_object)
+                channel_groups[(cls, channel)][interval_key].append(
+                    (n, compute_key, method_name, brief_name, args, kwargs))
+                n += 1
+
+        output = [None] * n
+        for (cls, channel), groups in channel_groups.items():
+            analysis_channel = cls(
+                name=channel, analysis_object=analysis_object)
+            for name, value in default_args.get(cls, {}).items():
+                setattr(analysis_channel, name, value)
+
+            for items in groups.values():
+                for i, compute_key, method_name, brief_name, args, kwargs \
+                        in items:
+                    f = getattr(analysis_channel, method_name)
+                    res = f(*args, **kwargs)
+
+                    output[i] = (
+                        analysis_channel.analysis_type, channel, brief_name,
+                        compute_key, res)
 
-                    for name, value in default_args.get(cls, {}).items():
-                        setattr(obj, name, value)
+        return output
 
-                analysis_channel = cls_cache[cache_key]
+    @staticmethod
+    def _get_special_arg_channels(
+            cls: Type['AnalysisChannel'], method_name: str, args: tuple,
+            kwargs: dict) -> Set[str]:
+        """Returns the names of the channels passed to the method as special
+        args, e.g. the ``event_channel`` of a pos channel computation.
+        """
+        special_args = cls.spec_get_special_arg_type()
+        if not special_args:
+            return set()
+
+        bound = inspect.signature(getattr(cls, method_name)).bind_partial(
+            None, *args, **kwargs)
+        names = set()
+        for name, value in bound.arguments.items():
+            if name not in special_args or not value or \
+                    value is default_value:
+                continue
+            if isinstance(value, str):
+                names.add(value)
+            else:
+                names.update(value)
+        return names
 
-                brief_name = method_name
-                if brief_name.startswith('compute_'):
-                    brief_name = brief_name[8:]
+    def get_required_channels(self) -> Optional[Set[str]]:
+        """Returns the names of the channels stored in the file that are
+        needed by the computations of the spec, or None if all the channels
+        may be needed (e.g. a computation applies to all channels of a type).
 
-                f = getattr(analysis_channel, method_name)
-                res = f(*args, **kwargs)
+        The returned names can be passed to
+        :meth:`FileDataAnalysis.load_file_data` so that only these channels
+        are loaded from the file. The names are case-insensitive.
+        """
+        default_args = self._default_args
+        created = {
+            new_name.lower() for _, new_name, *_ in self._new_channels}
+        names = set()
+
+        for cls, values in default_args.items():
+            special_args = cls.spec_get_special_arg_type()
+            for name, value in values.items():
+                if name not in special_args or not value:
+                    continue
+                if isinstance(value, str):
+                    names.add(value)
+                else:
+                    names.update(value)
 
-                output.append(
-                    (analysis_channel.analysis_type, channel, brief_name,
-                     compute_key, res))
+        for channel, _, cls, method_name, args, kwargs in self._new_channels:
+            names.add(channel)
+            names.update(self._get_special_arg_channels(
+                cls, method_name, args, kwargs))
 
-        return output
+        for channels, _, cls, method_name, args, kwargs in \
+                self._computations:
+            if not channels:
+                return None
+            names.update(channels)
+            names.update(self._get_special_arg_channels(
+                cls, method_name, args, kwargs))
+
+        return {name for name in names if name.lower() not in created}
 
     def clear_arg_defaults(self):
         self._default_args = defaultdict(dict)
+        self._compute_plan = None
 
     def clear_new_channel_computation(self):
         self._new_channels = []
 
     def clear_computation(self):
         self._computations = []
+        self._compute_plan = None
+
+
+class LazyChannelsData(MutableMapping):
+    """A dict of channel name to its data, where the data of a channel can be
+    loaded only when it is first accessed.
+
+    The channels are kept in the order they were added, like a dict. A channel
+    added with :meth:`set_loader` is loaded by calling the loader when its
+    value is first requested, after which the data replaces the loader.
+    """
+
+    _items: Dict[str, Any] = {}
+
+    _loaders: Dict[str, Callable[[], np.ndarray]] = {}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._items = {}
+        self._loaders = {}
+
+    def set_loader(self, name: str, loader: Callable[[], np.ndarray]):
+        """Adds the channel (or replaces its value) so that its data is
+        loaded by calling ``loader`` when it's first accessed.
+        """
+        self._items[name] = None
+        self._loaders[name] = loader
+
+    def is_loaded(self, name: str) -> bool:
+        """Returns whether the data of the channel has been loaded.
+        """
+        if name not in self._items:
+            raise KeyError(name)
+        return name not in self._loaders
+
+    def __getitem__(self, name: str):
+        if name in self._loaders:
+            self._items[name] = self._loaders.pop(name)()
+        return self._items[name]
+
+    def __setitem__(self, name: str, value):
+        self._loaders.pop(name, None)
+        self._items[name] = value
+
+    def __delitem__(self, name: str):
+        del self._items[name]
+        self._loaders.pop(name, None)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, name):
+        return name in self._items
+
+
+class ComputeCache:
+    """A least recently used cache of computed values, with a bounded
+    number of items.
+
+    It counts the number of times a requested value was found in
+    :attr:`hits`, or not found in :attr:`misses`.
+    """
+
+    max_size: int = 128
+    """The max number of values cached. When a value is added to a full
+    cache, the least recently used value is removed.
+    """
+
+    hits: int = 0
+    """The number of times :meth:`get` found the value.
+    """
+
+    misses: int = 0
+    """The number of times :meth:`get` did not find the value.
+    """
+
+    _items: OrderedDict = None
+
+    def __init__(self, max_size: int = 128, **kwargs):
+        super().__init__(**kwargs)
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the value cached for the key, or ``not_cached``.
+        """
+        items = self._items
+        if key not in items:
+            self.misses += 1
+            return not_cached
+
+        self.hits += 1
+        items.move_to_end(key)
+        return items[key]
+
+    def set(self, key: Hashable, value: Any):
+        """Caches the value for the key.
+        """
+        items = self._items
+        items[key] = value
+        items.move_to_end(key)
+        if len(items) > self.max_size:
+            items.popitem(last=False)
+
+    def clear(self):
+        """Removes all the values, but not the counts.
+        """
+        self._items.clear()
 
 
 class FileDataAnalysis:
@@ -352,6 +607,35 @@ class FileDataAnalysis:
 
     pixels_per_meter = 0
 
+    raw_data_suffixes = {
+        'xlsx': '.xlsx', 'npz': '.npz', 'h5': '.h5', 'parquet': '.parquet',
+        'feather': '.feather'}
+    """The file extension of each format supported by
+    :meth:`export_raw_data`.
+    """
+
+    raw_data_chunk_size = 1 << 20
+    """The max number of rows processed and written at once when exporting
+    the raw data.
+    """
+
+    data_summary_header = [
+        'data file', 'video path', 'video filename', 'missed timestamps',
+        'channel_type', 'channel', 'measure', 'measure_key', 'value']
+    """The header of the rows returned by :meth:`compute_data_summary`.
+    """
+
+    active_intervals_cache: ComputeCache = None
+    """Caches the active intervals computed by the channels (see
+    :meth:`get_active_intervals`), so that channels using the same mask
+    share them.
+    """
+
+    _memmaps: List[np.memmap] = []
+    """The channels data memory-mapped from the file, which are released by
+    :meth:`close_data_file`.
+    """
+
     def __init__(self, filename, **kwargs):
         super(FileDataAnalysis, self).__init__(**kwargs)
         self.filename = filename
@@ -361,6 +645,8 @@ class FileDataAnalysis:
         self.zone_channels_shapes = {}
         self.channels_metadata = {}
         self.normalized_names_map = {}
+        self.active_intervals_cache = ComputeCache(max_size=64)
+        self._memmaps = []
 
     def flatten_data(self, data_arrays) -> np.ndarray:
         ordered_indices = self.data_file.timestamp_intervals_ordered_keys
@@ -383,6 +669,9 @@ class FileDataAnalysis:
 
     def load_file_metadata(self, channels: Set[str] = None):
         data_file = self.data_file
+        self.active_intervals_cache.clear()
+        if channels:
+            channels = {name.lower() for name in channels}
         data_file.open_file()
 
         self.video_metadata = data_file.video_metadata_dict
@@ -419,15 +708,79 @@ class FileDataAnalysis:
             for _, channel in _sort_dict(src_channels):
                 m = channel.channel_config_dict
                 name = m['name']
-                if channels and name not in channels:
+                if channels and name.lower() not in channels:
                     continue
 
                 normalized_names_map[name.lower()] = name
                 metadata[name] = m
                 channels_data[name] = None
 
-    def load_file_data(self, channels: Set[str] = None):
+    def _read_channel_data(self, channel, memmap: bool = False) -> np.ndarray:
+        """Reads the data of the event or pos channel from the file.
+
+        If ``memmap`` and the channel's data is stored in a single contiguous
+        and uncompressed dataset, the data is memory-mapped (copy-on-write)
+        from the file instead of being read into memory. Event channels stored
+        as runs (see :attr:`~glitter2.storage.data_file.EventChannelData.
+        runs_storage`) are expanded from the runs and sparse pos channels
+        (see :attr:`~glitter2.storage.data_file.PosChannelData.
+        sparse_storage`) from their stored frames. Arrays stored without
+        their padding at the end are padded with the default value.
+        """
+        if isinstance(channel, PosChannelData) and channel.sparse_storage \
+                and channel.sparse_buffers:
+            # flatten_data converts the SparseFrameData to the dense data
+            return self.flatten_data(channel.sparse_buffers)
+
+        data_arrays = channel.data_arrays
+        if isinstance(channel, EventChannelData) and channel.runs_storage or \
+                isinstance(channel, PosChannelData) and \
+                channel.sparse_storage or \
+                any(arr.shape[0] < channel.get_num_frames(n)
+                    for n, arr in data_arrays.items()):
+            channel.pad_to_num_frames()
+            return self.flatten_data(
+                {n: buffer.array
+                 for n, buffer in channel.data_buffers.items()})
+
+        if memmap and len(data_arrays) == 1:
+            dataset = data_arrays[0]._h5group.group['data']
+            offset = dataset.id.get_offset()
+            if dataset.chunks is None and dataset.compression is None and \
+                    offset is not None and dataset.size and \
+                    not dataset.dtype.hasobject:
+                data = np.memmap(
+                    dataset.file.filename, dtype=dataset.dtype, mode='c',
+                    offset=offset, shape=dataset.shape)
+                self._memmaps.append(data)
+                return data
+
+        return self.flatten_data(data_arrays)
+
+    def load_file_data(
+            self, channels: Set[str] = None, lazy: bool = False,
+            memmap: bool = False):
+        """Loads the timestamps and the channels data from the file.
+
+        :param channels: The optional names of the channels to load
+            (case-insensitive). If None or empty, all channels are loaded.
+            E.g. :meth:`AnalysisSpec.get_required_channels`.
+        :param lazy: If True, the data of each event and pos channel is only
+            read from the file when it is first accessed in
+            :attr:`event_channels_data` or :attr:`pos_channels_data`, which
+            become :class:`LazyChannelsData` instances. The file must
+            remain open until then.
+        :param memmap: If True, the data of channels stored in a single
+            contiguous and uncompressed dataset is memory-mapped from the file
+            instead of being read. The memory-mapped data is only valid until
+            :meth:`close_data_file`, which removes it from the channels data.
+        """
+        if lazy:
+            self.event_channels_data = LazyChannelsData()
+            self.pos_channels_data = LazyChannelsData()
         self.load_file_metadata(channels)
+        if channels:
+            channels = {name.lower() for name in channels}
         data_file = self.data_file
 
         self.timestamps = self.flatten_data(data_file.timestamps_arrays)
@@ -446,7 +799,7 @@ class FileDataAnalysis:
             for _, channel in _sort_dict(src_channels):
                 m = channel.channel_config_dict
                 name = m['name']
-                if channels and name not in channels:
+                if channels and name.lower() not in channels:
                     continue
 
                 if channels_data is None:
@@ -454,16 +807,41 @@ class FileDataAnalysis:
                     cls = shape_cls_map[state['cls']]
                     shape = cls.create_shape_from_state(state)
                     zone_channels_shapes[name] = shape
+                elif lazy:
+                    channels_data.set_loader(
+                        name,
+                        partial(self._read_channel_data, channel, memmap))
                 else:
-                    channels_data[name] = self.flatten_data(
-                        channel.data_arrays)
+                    channels_data[name] = self._read_channel_data(
+                        channel, memmap)
 
     def close_data_file(self):
+        """Closes the file. The channels data memory-mapped from the file (see
+        :meth:`load_file_data`) is set to None, so that the file is released
+        once the data is no longer referenced elsewhere.
+        """
+        self._release_memmaps()
         if self.nix_file is None:
             return
         self.nix_file.close()
         self.nix_file = None
 
+    def _release_memmaps(self):
+        memmaps = {id(data) for data in self._memmaps}
+        if not memmaps:
+            return
+
+        self._memmaps = []
+        for channels_data in (self.event_channels_data, self.pos_channels_data):
+            for name in list(channels_data):
+                if isinstance(channels_data, LazyChannelsData) and \
+                        not channels_data.is_loaded(name):
+                    continue
+                if id(channels_data[name]) in memmaps:
+                    channels_data[name] = None
+        # the computed values may be views of the memory-mapped data
+        self.active_intervals_cache.clear()
+
     def compute_data_summary(self, spec: AnalysisSpec) -> list:
         # export_computed_statistics provides the header
         rows = []
@@ -498,22 +876,25 @@ class FileDataAnalysis:
 
         excel_writer = pd.ExcelWriter(filename, engine='xlsxwriter')
 
-        header = [
-            'data file', 'video path', 'video filename', 'missed timestamps',
-            'channel_type', 'channel', 'measure', 'measure_key', 'value']
+        header = FileDataAnalysis.data_summary_header
         df = pd.DataFrame(data, columns=header)
         df.to_excel(excel_writer, sheet_name='statistics', index=False)
 
         excel_writer.save()
 
-    def export_raw_data_to_excel(self, filename, dump_zone_collider=False):
-        if not filename.endswith('.xlsx'):
-            filename += '.xlsx'
-
-        if exists(filename):
-            raise ValueError('"{}" already exists'.format(filename))
-        excel_writer = pd.ExcelWriter(filename, engine='xlsxwriter')
-
+    def get_raw_data_tables(
+            self, dump_zone_collider=False
+    ) -> Dict[str, Dict[Any, Union[np.ndarray, list]]]:
+        """Returns all the raw data of the file as tables, as exported by
+        :meth:`export_raw_data`.
+
+        :param dump_zone_collider: Whether to add a column for each pos and
+            zone channel pair, indicating whether the position is in the zone
+            for each timestamp.
+        :return: A dict mapping each table (sheet) name to a dict that maps the
+            table's column names to the column's data.
+        """
+        tables = {}
         if self.missed_timestamps:
             # if we have timestamp discontinuities, indicate it
             data = [
@@ -521,16 +902,12 @@ class FileDataAnalysis:
             if self.missing_timestamp_values:
                 data.append('timestamps around where frames are missing:')
                 data.extend(self.missing_timestamp_values)
-
-            df = pd.DataFrame(data)
-            df.to_excel(
-                excel_writer, sheet_name='missing_timestamps', index=False)
+            tables['missing_timestamps'] = {0: data}
 
         file_metadata = dict(self.metadata)
         file_metadata.update(self.video_metadata)
-        file_metadata = _sort_dict(file_metadata)
-        df = pd.DataFrame(file_metadata, columns=['Property', 'Value'])
-        df.to_excel(excel_writer, sheet_name='file_metadata', index=False)
+        tables['file_metadata'] = _get_property_table(
+            _sort_dict(file_metadata))
 
         # add sheet for all the channels metadata
         metadata = []
@@ -547,49 +924,32 @@ class FileDataAnalysis:
             d = dict(channels_metadata[channel_name])
             d.pop('shape_config', None)
             metadata.extend(_sort_dict(d))
-        df = pd.DataFrame(metadata, columns=['Property', 'Value'])
-        df.to_excel(excel_writer, sheet_name='channels_metadata', index=False)
-
-        # add timestamps
-        df = pd.DataFrame(self.timestamps, columns=['timestamp'])
-        df.to_excel(excel_writer, sheet_name='timestamps', index=False)
-
-        # add event channels data
-        columns_header = []
-        columns = []
-        for channel_name, data in self.event_channels_data.items():
-            columns_header.append(channel_name)
-            columns.append(data)
-        df = pd.DataFrame(columns).T
-        df.columns = columns_header
-        df.to_excel(excel_writer, sheet_name='event_channels', index=False)
+        tables['channels_metadata'] = _get_property_table(metadata)
+
+        tables['timestamps'] = {'timestamp': self.timestamps}
+        tables['event_channels'] = dict(self.event_channels_data)
 
         # add pos channels data
         colliders = {}
         if dump_zone_collider:
             for channel_name, shape in self.zone_channels_shapes.items():
                 colliders[channel_name] = \
-                    ZoneAnalysisChannel.collider_from_shape(shape)
+                    ZoneAnalysisChannel.zone_collider_from_shape(shape)
 
-        columns_header = []
-        columns = []
+        columns = tables['pos_channels'] = {}
+        n = self.raw_data_chunk_size
         for channel_name, data in self.pos_channels_data.items():
-            columns_header.append(f'{channel_name}:x')
-            columns_header.append(f'{channel_name}:y')
-            columns.append(data[:, 0])
-            columns.append(data[:, 1])
+            columns[f'{channel_name}:x'] = data[:, 0]
+            columns[f'{channel_name}:y'] = data[:, 1]
 
             for zone_name, collider in colliders.items():
                 valid_points = data[:, 0] != -1
-                columns_header.append(f'{channel_name}:--:{zone_name}')
-
-                valid_points[valid_points] = collider.collide_points(
-                    data[valid_points, :].tolist())
-                columns.append(valid_points)
-
-        df = pd.DataFrame(columns).T
-        df.columns = columns_header
-        df.to_excel(excel_writer, sheet_name='pos_channels', index=False)
+                # collide in chunks to limit the size of the temp arrays
+                for i in range(0, len(data), n):
+                    valid = valid_points[i:i + n]
+                    valid[valid] = collider.collide_points(
+                        data[i:i + n][valid, :])
+                columns[f'{channel_name}:--:{zone_name}'] = valid_points
 
         # add zone channels metadata
         shape_config = []
@@ -598,8 +958,107 @@ class FileDataAnalysis:
             # only save shape info
             d = channels_metadata[channel_name].get('shape_config', {})
             shape_config.extend(_sort_dict(d))
-        df = pd.DataFrame(shape_config, columns=['Property', 'Value'])
-        df.to_excel(excel_writer, sheet_name='zone_channels', index=False)
+        tables['zone_channels'] = _get_property_table(shape_config)
+
+        return tables
+
+    def export_raw_data(
+            self, filename: str, file_format: str = 'xlsx',
+            dump_zone_collider=False, compression: Optional[str] = 'gzip'):
+        """Exports all the raw data of the file to the given format.
+
+        The tables returned by :meth:`get_raw_data_tables` are saved as:
+
+        * ``'xlsx'``: A sheet per table in an Excel file. Excel is limited to
+          about 1M rows and it's slow for large files.
+        * ``'npz'``: A compressed numpy ``.npz`` file with an array per
+          column, named ``"table/column"``.
+        * ``'h5'``: A group per table in a H5 file, containing a dataset per
+          column. A ``/`` in the column names is replaced by a ``_``.
+        * ``'parquet'`` or ``'feather'``: A directory with a file per table.
+          This requires ``pyarrow``.
+
+        The property/value tables (e.g. the metadata) are saved as strings in
+        all but the Excel format. The filename's extension is added if
+        missing, as listed in :attr:`raw_data_suffixes`.
+
+        :param filename: The file to create. It must not exist.
+        :param file_format: The format.
+        :param dump_zone_collider: See :meth:`get_raw_data_tables`.
+        :param compression: The h5 compression filter used for the h5 format.
+        """
+        if file_format not in self.raw_data_suffixes:
+            raise ValueError(f'Unknown raw data format "{file_format}"')
+        if file_format == 'xlsx':
+            self.export_raw_data_to_excel(filename, dump_zone_collider)
+            return
+
+        suffix = self.raw_data_suffixes[file_format]
+        if not filename.endswith(suffix):
+            filename += suffix
+        if exists(filename):
+            raise ValueError('"{}" already exists'.format(filename))
+
+        tables = self.get_raw_data_tables(dump_zone_collider)
+        if file_format == 'npz':
+            arrays = {}
+            for table, columns in tables.items():
+                for name, data in columns.items():
+                    arrays[f'{table}/{name}'] = _get_column_array(data)
+            np.savez_compressed(filename, **arrays)
+        elif file_format == 'h5':
+            self._export_raw_data_to_h5(filename, tables, compression)
+        else:
+            os.mkdir(filename)
+            for table, columns in tables.items():
+                df = pd.DataFrame({
+                    str(name): _get_column_array(data)
+                    for name, data in columns.items()})
+                path = os.path.join(filename, f'{table}{suffix}')
+                if file_format == 'parquet':
+                    df.to_parquet(path)
+                else:
+                    df.to_feather(path)
+
+    def _export_raw_data_to_h5(
+            self, filename: str,
+            tables: Dict[str, Dict[Any, Union[np.ndarray, list]]],
+            compression: Optional[str]):
+        n = self.raw_data_chunk_size
+        with h5py.File(filename, 'w', track_order=True) as f:
+            for table, columns in tables.items():
+                group = f.create_group(table, track_order=True)
+                for name, data in columns.items():
+                    name = str(name).replace('/', '_')
+                    data = _get_column_array(data)
+
+                    if data.dtype.kind == 'U':
+                        group.create_dataset(
+                            name, data=data.astype(object),
+                            dtype=h5py.string_dtype())
+                        continue
+                    if not len(data):
+                        group.create_dataset(name, data=data)
+                        continue
+
+                    dataset = group.create_dataset(
+                        name, shape=data.shape, dtype=data.dtype,
+                        chunks=True, compression=compression)
+                    for i in range(0, len(data), n):
+                        dataset[i:i + n] = data[i:i + n]
+
+    def export_raw_data_to_excel(self, filename, dump_zone_collider=False):
+        if not filename.endswith('.xlsx'):
+            filename += '.xlsx'
+
+        if exists(filename):
+            raise ValueError('"{}" already exists'.format(filename))
+        excel_writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+
+        for table, columns in self.get_raw_data_tables(
+                dump_zone_collider).items():
+            df = pd.DataFrame(columns)
+            df.to_excel(excel_writer, sheet_name=table, index=False)
 
         excel_writer.save()
 
@@ -633,6 +1092,34 @@ class FileDataAnalysis:
         self.zone_channels_shapes[name] = shape
         self.normalized_names_map[name.lower()] = name
 
+    def get_active_intervals(
+            self, channels: FrozenSet[str],
+            get_mask: Callable[[], np.ndarray], start: Optional[float] = None,
+            end: Optional[float] = None) -> Dict[str, np.ndarray]:
+        """Returns the active intervals of a mask, between ``start`` and
+        ``end``, as computed by
+        :meth:`TemporalAnalysisChannel._get_active_intervals`.
+
+        The intervals are cached in :attr:`active_intervals_cache` so any
+        channel that uses the same mask shares them.
+
+        :param channels: The normalized names of the channels whose masks are
+            combined (with AND) into the mask, identifying the mask. For event
+            channels, the mask is where the event is active and for pos
+            channels, it's where the position is valid.
+        :param get_mask: Called to get the mask, if the intervals are not
+            cached.
+        :param start: The start time of the intervals, if any.
+        :param end: The end time of the intervals, if any.
+        """
+        key = channels, start, end
+        intervals = self.active_intervals_cache.get(key)
+        if intervals is not_cached:
+            intervals = TemporalAnalysisChannel._get_active_intervals(
+                get_mask(), self.timestamps, start=start, end=end)
+            self.active_intervals_cache.set(key, intervals)
+        return intervals
+
     def normalized_name(self, name):
         normalized_name = name.lower()
         names = self.normalized_names_map
@@ -677,14 +1164,31 @@ class AnalysisChannel:
     means. E.g. whether it's a event channel name etc.
     """
 
+    _interval_args_: Tuple[str, ...] = ()
+    """The names of the compute method args that select the active
+    intervals the method is computed over. Used by
+    :meth:`AnalysisSpec.get_compute_plan` to group computations.
+    """
+
     _compute_method_args_cache: Dict[
         str, Dict[str, Tuple[str, Tuple[Type, bool]]]] = {}
 
+    compute_cache_size = 128
+    """The max number of computed values cached by each channel in
+    :attr:`compute_cache`.
+    """
+
+    compute_cache: ComputeCache = None
+    """The :class:`ComputeCache` of the values computed by the channel, keyed
+    by the name of the measure and its args.
+    """
+
     def __init__(self, name: str, analysis_object: FileDataAnalysis, **kwargs):
         self.analysis_object = analysis_object
         self.name = name
         self.metadata = analysis_object.channels_metadata[
             analysis_object.normalized_name(name)]
+        self.compute_cache = ComputeCache(max_size=self.compute_cache_size)
 
     def normalized_name(self, name):
         return self.analysis_object.normalized_name(name)
@@ -806,20 +1310,24 @@ class AnalysisChannel:
         return res
 
     def get_cache(self, prop: str, **kwargs) -> Tuple:
+        """Returns the cached value of ``prop`` computed with the given
+        args, after replacing the defaults like :meth:`get_args`, or
+        ``not_cached`` if it's not cached. Also returns the args.
+        """
         args = tuple(self.get_args(**kwargs))
-        prop_val = getattr(self, prop)
-
-        if prop_val is not None and prop_val[1] == args:
-            return prop_val[0], args
-        return not_cached, args
+        return self.compute_cache.get((prop, args)), args
 
     def get_cache_these_args(self, prop: str, **kwargs) -> Any:
-        args = tuple(kwargs.values())
-        prop_val = getattr(self, prop)
+        """Like :meth:`get_cache`, but the args are used as is and only the
+        value is returned.
+        """
+        return self.compute_cache.get((prop, tuple(kwargs.values())))
 
-        if prop_val is not None and prop_val[1] == args:
-            return prop_val[0]
-        return not_cached
+    def set_cache(self, prop: str, args: tuple, value: Any):
+        """Caches the value of ``prop`` computed with the args, as returned
+        by :meth:`get_cache`.
+        """
+        self.compute_cache.set((prop, args), value)
 
 
 class TemporalAnalysisChannel(AnalysisChannel):
@@ -847,7 +1355,7 @@ class TemporalAnalysisChannel(AnalysisChannel):
             s = np.searchsorted(timestamps, start, side='left')
         e = timestamps.shape[0]
         if end is not None:
-            e = np.searchsorted(data, end, side='right')
+            e = np.searchsorted(timestamps, end, side='right')
 
         data = data[s:e]
         timestamps = timestamps[s:e]
@@ -924,16 +1432,6 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
 
     analysis_type: str = 'event'
 
-    _active_duration: Tuple[float, Tuple] = None
-
-    _delay_to_first: Tuple[float, Tuple] = None
-
-    _scored_duration: Tuple[float, Tuple] = None
-
-    _event_count: Tuple[int, Tuple] = None
-
-    _active_interval: Tuple[Dict[str, np.ndarray], Tuple] = None
-
     start: Optional[float] = None
 
     end: Optional[float] = None
@@ -977,18 +1475,14 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
 
     _special_arg_type_: Dict[str, str] = {'event_channels': 'event'}
 
+    _interval_args_: Tuple[str, ...] = ('start', 'end')
+
     def get_active_intervals(
             self, start: Optional[float] = None,
             end: Optional[float] = None) -> Dict[str, np.ndarray]:
-        val = self.get_cache_these_args(
-            '_active_interval', start=start, end=end)
-        if val is not not_cached:
-            return val
-
-        intervals = self._get_active_intervals(
-            self.data, self.timestamps, start=start, end=end)
-        self._active_interval = intervals, (start, end)
-        return intervals
+        norm = self.analysis_object.normalized_name
+        return self.analysis_object.get_active_intervals(
+            frozenset([norm(self.name)]), lambda: self.data, start, end)
 
     def compute_active_duration(
             self, start: Optional[DefaultFloat] = default_value,
@@ -1000,7 +1494,7 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
 
         intervals = self.get_active_intervals(start, end)['intervals']
         val = self._compute_active_duration(intervals)
-        self._active_duration = val, (start, end)
+        self.set_cache('_active_duration', (start, end), val)
         return val
 
     def compute_delay_to_first(
@@ -1014,7 +1508,7 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
         active_intervals = self.get_active_intervals(start, end)
         val = self._compute_delay_to_first(
             active_intervals['timestamps'], active_intervals['intervals'])
-        self._delay_to_first = val, (start, end)
+        self.set_cache('_delay_to_first', (start, end), val)
         return val
 
     def compute_scored_duration(
@@ -1027,7 +1521,7 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
 
         timestamps = self.get_active_intervals(start, end)['timestamps']
         val = self._compute_scored_duration(timestamps)
-        self._scored_duration = val, (start, end)
+        self.set_cache('_scored_duration', (start, end), val)
         return val
 
     def compute_event_count(
@@ -1040,7 +1534,7 @@ class EventAnalysisChannel(TemporalAnalysisChannel):
 
         intervals = self.get_active_intervals(start, end)['intervals']
         val = self._compute_event_count(intervals)
-        self._event_count = val, (start, end)
+        self.set_cache('_event_count', (start, end), val)
         return val
 
     def compute_event_intervals(
@@ -1077,14 +1571,6 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
 
     analysis_type: str = 'pos'
 
-    _mean_center_distance: Tuple[float, Tuple] = None
-
-    _distance_traveled: Tuple[float, Tuple] = None
-
-    _mean_speed: Tuple[float, Tuple] = None
-
-    _active_interval: Tuple[Dict[str, np.ndarray], Tuple] = None
-
     _colliders: Dict[str, Union[Collide2DPoly, CollideEllipse]]
 
     start: Optional[float] = None
@@ -1137,9 +1623,27 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
         'event_channel': 'event', 'event_channels': 'event',
         'zone_channel': 'zone', 'zone_channels': 'zone'}
 
+    _interval_args_: Tuple[str, ...] = ('event_channel', 'start', 'end')
+
+    _cumulative_distance: np.ndarray = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._colliders = {}
+        self._zone_colliders = {}
+
+    def get_zone_collider(self, zone_name: str) -> ZoneCollider:
+        """Returns the vectorized
+        :class:`~glitter2.analysis.collide.ZoneCollider` of the zone.
+        """
+        if zone_name not in self._zone_colliders:
+            norm = self.analysis_object.normalized_name
+
+            shape = self.analysis_object.zone_channels_shapes[norm(zone_name)]
+            self._zone_colliders[zone_name] = \
+                ZoneAnalysisChannel.zone_collider_from_shape(shape)
+
+        return self._zone_colliders[zone_name]
 
     def get_collider(
             self, zone_name: str) -> Union[Collide2DPoly, CollideEllipse]:
@@ -1156,24 +1660,45 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
             self, event_channel: Optional[str] = None,
             start: Optional[float] = None,
             end: Optional[float] = None) -> Dict[str, np.ndarray]:
-        val = self.get_cache_these_args(
-            '_active_interval', event_channel=event_channel, start=start,
-            end=end)
-        if val is not not_cached:
-            return val
-
         norm = self.analysis_object.normalized_name
-
-        data = self.data[:, 0] != -1
+        # the mask is where the pos channel is valid and the event is active
+        channels = [norm(self.name)]
         if event_channel:
-            data = np.logical_and(
-                data,
-                self.analysis_object.event_channels_data[norm(event_channel)])
-
-        intervals = self._get_active_intervals(
-            data, self.timestamps, start=start, end=end)
-        self._active_interval = intervals, (start, end)
-        return intervals
+            channels.append(norm(event_channel))
+
+        def get_mask():
+            data = self.data[:, 0] != -1
+            if event_channel:
+                data = np.logical_and(
+                    data, self.analysis_object.event_channels_data[
+                        norm(event_channel)])
+            return data
+
+        return self.analysis_object.get_active_intervals(
+            frozenset(channels), get_mask, start, end)
+
+    def get_cumulative_distance(self) -> np.ndarray:
+        """Returns the cumulative distance traveled from the first frame to
+        each frame, so the distance from frame ``i`` to ``j`` is
+        ``d[j] - d[i]``.
+        """
+        if self._cumulative_distance is None:
+            data = self.data
+            steps = np.linalg.norm(data[1:, :] - data[:-1, :], axis=1)
+            d = self._cumulative_distance = np.empty(len(self.data))
+            d[:1] = 0
+            np.cumsum(steps, out=d[1:])
+        return self._cumulative_distance
+
+    def _compute_intervals_distance(
+            self, intervals: Dict[str, np.ndarray]) -> float:
+        """Returns the total distance traveled within the active intervals.
+        """
+        indices = intervals['indices'] + intervals['start']
+        if not len(indices):
+            return 0.
+        d = self.get_cumulative_distance()
+        return float(np.sum(d[indices[:, 1]] - d[indices[:, 0]]))
 
     def compute_event_from_pos(
             self, event_channels: List[str]) -> Tuple[np.ndarray, dict]:
@@ -1187,14 +1712,10 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
 
     def compute_pos_in_any_zone(
             self, zone_channels: List[str]) -> Tuple[np.ndarray, dict]:
-        arr = []
         valid_points = self.data[:, 0] != -1
-        points = self.data[valid_points, :].tolist()
-        for zone in zone_channels:
-            collider = self.get_collider(zone)
-            arr.append(collider.collide_points(points))
-
-        valid_points[valid_points] = np.logical_or.reduce(arr, axis=0)
+        colliders = [self.get_zone_collider(zone) for zone in zone_channels]
+        valid_points[valid_points] = collide_any_zone(
+            self.data[valid_points, :], colliders)
 
         return valid_points, {}
 
@@ -1216,8 +1737,9 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
         data = data[intervals['mask'], :] - collider.get_centroid()
         val = float(np.mean(numpy.linalg.norm(data, axis=1)))
 
-        self._mean_center_distance = val, (
-            zone_channel, event_channel, start, end)
+        self.set_cache(
+            '_mean_center_distance',
+            (zone_channel, event_channel, start, end), val)
         return val
 
     def compute_distance_traveled(
@@ -1231,16 +1753,9 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
             return val
 
         intervals = self.get_active_intervals(event_channel, start, end)
-        indices = intervals['indices']
-        data = self.data[intervals['start']:intervals['end'], :]
-
-        val = 0
-        for s, e in indices:
-            val += np.sum(
-                np.linalg.norm(data[s + 1:e + 1, :] - data[s:e, :], axis=1))
-        val = float(val)
+        val = self._compute_intervals_distance(intervals)
 
-        self._distance_traveled = val, (event_channel, start, end)
+        self.set_cache('_distance_traveled', (event_channel, start, end), val)
         return val
 
     def compute_mean_speed(
@@ -1254,21 +1769,15 @@ class PosAnalysisChannel(TemporalAnalysisChannel):
             return val
 
         intervals = self.get_active_intervals(event_channel, start, end)
-        indices = intervals['indices']
         interval_times = intervals['intervals']
-        data = self.data[intervals['start']:intervals['end'], :]
-
-        dist = 0
-        for s, e in indices:
-            dist += np.sum(
-                np.linalg.norm(data[s + 1:e + 1, :] - data[s:e, :], axis=1))
+        dist = self._compute_intervals_distance(intervals)
 
         dt = np.sum(interval_times[:, 1] - interval_times[:, 0])
         val = 0.
         if dt:
             val = float(dist / dt)
 
-        self._mean_speed = val, (event_channel, start, end)
+        self.set_cache('_mean_speed', (event_channel, start, end), val)
         return val
 
 
@@ -1302,14 +1811,22 @@ class ZoneAnalysisChannel(AnalysisChannel):
         elif isinstance(shape, PaintEllipse):
             x, y = shape.center
             rx, ry = shape.radius_x, shape.radius_y
+            # the shape's angle is in radians, the collider's in degrees
             return CollideEllipse(
-                x=x, y=y, rx=rx, ry=ry, angle=shape.angle)
+                x=x, y=y, rx=rx, ry=ry, angle=shape.angle / pi * 180.)
         elif isinstance(shape, PaintPoint):
             x, y = shape.position
             return CollideEllipse(x=x, y=y, rx=1, ry=1)
         else:
             assert False
 
+    @staticmethod
+    def zone_collider_from_shape(shape: PaintShape) -> ZoneCollider:
+        """Like :meth:`collider_from_shape`, but returns the vectorized
+        :class:`~glitter2.analysis.collide.ZoneCollider`.
+        """
+        return zone_collider_from_state(shape.get_state())
+
     @property
     def collider(self):
         collider = self._collider
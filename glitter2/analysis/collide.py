@@ -0,0 +1,242 @@
+"""Zone collision
+================
+
+Vectorized tests for whether positions are inside a zone, used when computing
+e.g. :meth:`~glitter2.analysis.PosAnalysisChannel.compute_pos_in_any_zone` or
+when exporting the raw data with the zone collider.
+
+The colliders are created from the state of the zone's
+:class:`~kivy_garden.painter.PaintShape` (see :func:`zone_collider_from_state`)
+and return the same result as the :mod:`kivy_garden.collider` collider created
+by :meth:`~glitter2.analysis.ZoneAnalysisChannel.collider_from_shape`, but
+operate directly on a ``(N, 2)`` array of points and return a boolean mask.
+
+E.g.::
+
+    >>> collider = zone_collider_from_state(
+    ...     {'cls': 'PaintCircle', 'center': [10, 10], 'radius': 5})
+    >>> collider.collide_points(np.array([[10, 12], [20, 20]]))
+    array([ True, False])
+"""
+from typing import Tuple, List, Iterable
+from math import cos, sin, floor, ceil
+import numpy as np
+
+__all__ = (
+    'ZoneCollider', 'PolygonZoneCollider', 'EllipseZoneCollider',
+    'zone_collider_from_state', 'collide_any_zone')
+
+
+class ZoneCollider:
+    """Base class for the vectorized zone colliders.
+    """
+
+    bounding_box: Tuple[float, float, float, float] = (0, 0, 0, 0)
+    """The ``(x1, y1, x2, y2)`` bounding box of the zone. Points outside it
+    are never in the zone.
+    """
+
+    def _collide(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def collide_points(
+            self, points: np.ndarray, prefilter: bool = True) -> np.ndarray:
+        """Returns a boolean array indicating for each point whether it's in
+        the zone.
+
+        :param points: A ``(N, 2)`` array of the x, y position of the points.
+        :param prefilter: Whether to first test the points against the
+            :attr:`bounding_box` and only test the points within it against
+            the zone. This is faster when most points are outside the zone.
+        """
+        points = np.asarray(points)
+        x = points[:, 0]
+        y = points[:, 1]
+        if not prefilter:
+            return self._collide(x, y)
+
+        x1, y1, x2, y2 = self.bounding_box
+        mask = (x >= x1) & (x <= x2) & (y >= y1) & (y <= y2)
+        if mask.all():
+            return self._collide(x, y)
+
+        mask[mask] = self._collide(x[mask], y[mask])
+        return mask
+
+
+class PolygonZoneCollider(ZoneCollider):
+    """Tests whether the points are inside a polygon, using the even-odd
+    rule.
+
+    Like the cached :class:`~kivy_garden.collider.Collide2DPoly`, the points
+    are first rounded to the integer pixel grid of the polygon's bounding box.
+    Whether each pixel is in the polygon is computed once, for all pixels,
+    when first needed.
+    """
+
+    points: np.ndarray = None
+    """The ``(M, 2)`` array of the polygon's corners.
+    """
+
+    _pixels: np.ndarray = None
+
+    def __init__(self, points: List[float], **kwargs):
+        super().__init__(**kwargs)
+        self.points = points = np.asarray(points, dtype=np.float64).reshape(
+            -1, 2)
+
+        if len(points):
+            self.bounding_box = (
+                floor(points[:, 0].min()), floor(points[:, 1].min()),
+                ceil(points[:, 0].max()), ceil(points[:, 1].max()))
+
+    def get_pixels(self) -> np.ndarray:
+        """Returns a ``(H + 1, W + 1)`` boolean array of whether each pixel
+        (row for y, column for x) of the bounding box is in the polygon.
+        """
+        if self._pixels is not None:
+            return self._pixels
+
+        x1, y1, x2, y2 = self.bounding_box
+        width, height = x2 - x1 + 1, y2 - y1 + 1
+        # pad an extra column for the crossings right of all the pixels
+        parity = np.zeros((height, width + 1), dtype=np.uint8)
+
+        # like Collide2DPoly, work relative to the bounding box so the
+        # crossings are computed the same, even for points on an edge.
+        # Edge i goes from corner i - 1 to corner i
+        px = self.points[:, 0] - x1
+        py = self.points[:, 1] - y1
+        px_prev, py_prev = np.roll(px, 1), np.roll(py, 1)
+        edges = py != py_prev
+        px, py = px[edges], py[edges]
+        px_prev, py_prev = px_prev[edges], py_prev[edges]
+
+        dy = py_prev - py
+        constant = px - py * px_prev / dy + py * px / dy
+        multiple = (px_prev - px) / dy
+
+        # each edge is crossed by the pixel rows y where low < y <= high
+        first = np.floor(np.minimum(py, py_prev)).astype(np.int64) + 1
+        last = np.floor(np.maximum(py, py_prev)).astype(np.int64)
+        counts = np.maximum(last - first + 1, 0)
+        edge = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.cumsum(counts) - counts
+        row = np.arange(len(edge)) - np.repeat(offsets, counts) + first[edge]
+
+        # an edge crossing at c toggles all the pixels x > c in its row
+        cross = row * multiple[edge] + constant[edge]
+        col = np.clip(np.floor(cross).astype(np.int64) + 1, 0, width)
+        np.bitwise_xor.at(parity, (row, col), 1)
+
+        self._pixels = np.bitwise_xor.accumulate(
+            parity, axis=1)[:, :-1].astype(np.bool_)
+        return self._pixels
+
+    def _collide(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        if not len(self.points):
+            return np.zeros(len(x), dtype=np.bool_)
+
+        x1, y1, x2, y2 = self.bounding_box
+        result = (x >= x1) & (x <= x2) & (y >= y1) & (y <= y2)
+        pixels = self.get_pixels()
+        result[result] = pixels[
+            (y[result] - y1 + .5).astype(np.int64),
+            (x[result] - x1 + .5).astype(np.int64)]
+        return result
+
+
+class EllipseZoneCollider(ZoneCollider):
+    """Tests whether the points are inside an ellipse or circle.
+    """
+
+    center: Tuple[float, float] = (0, 0)
+    """The center of the ellipse.
+    """
+
+    radius_x: float = 0
+    """The radius of the ellipse along its x-axis.
+    """
+
+    radius_y: float = 0
+    """The radius of the ellipse along its y-axis.
+    """
+
+    angle: float = 0
+    """The angle in radians by which the ellipse's x-axis is rotated counter
+    clockwise.
+    """
+
+    def __init__(
+            self, center: Tuple[float, float], radius_x: float,
+            radius_y: float, angle: float = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.center = x, y = tuple(center)
+        self.radius_x = radius_x
+        self.radius_y = radius_y
+        self.angle = angle
+
+        c, s = cos(angle), sin(angle)
+        w = ((radius_x * c) ** 2 + (radius_y * s) ** 2) ** .5
+        h = ((radius_x * s) ** 2 + (radius_y * c) ** 2) ** .5
+        self.bounding_box = x - w, y - h, x + w, y + h
+
+    def _collide(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        rx, ry = self.radius_x, self.radius_y
+        if not rx or not ry:
+            return np.zeros(len(x), dtype=np.bool_)
+
+        cx, cy = self.center
+        dx = x - cx
+        dy = y - cy
+        if rx == ry:
+            return dx * dx + dy * dy <= rx * rx
+
+        angle = self.angle
+        if angle:
+            c, s = cos(angle), sin(angle)
+            dx, dy = dx * c + dy * s, dy * c - dx * s
+        return (dx / rx) ** 2 + (dy / ry) ** 2 <= 1
+
+
+def zone_collider_from_state(state: dict) -> ZoneCollider:
+    """Creates the collider for the zone from the state of its
+    :class:`~kivy_garden.painter.PaintShape`, as returned by
+    :meth:`~kivy_garden.painter.PaintShape.get_state`.
+    """
+    cls = state['cls']
+    if cls in ('PaintPolygon', 'PaintFreeformPolygon'):
+        return PolygonZoneCollider(points=state['points'])
+    elif cls == 'PaintCircle':
+        r = state['radius']
+        return EllipseZoneCollider(
+            center=state['center'], radius_x=r, radius_y=r)
+    elif cls == 'PaintEllipse':
+        return EllipseZoneCollider(
+            center=state['center'], radius_x=state['radius_x'],
+            radius_y=state['radius_y'], angle=state['angle'])
+    elif cls == 'PaintPoint':
+        return EllipseZoneCollider(
+            center=state['position'], radius_x=1, radius_y=1)
+    raise ValueError(f'Unknown zone shape "{cls}"')
+
+
+def collide_any_zone(
+        points: np.ndarray, colliders: Iterable[ZoneCollider],
+        prefilter: bool = True) -> np.ndarray:
+    """Returns a boolean array indicating for each point whether it's in any
+    of the zones.
+
+    Each zone only tests the points not already found in a previous zone.
+    """
+    points = np.asarray(points)
+    result = np.zeros(len(points), dtype=np.bool_)
+    remaining = np.arange(len(points))
+
+    for collider in colliders:
+        if not len(remaining):
+            break
+        inside = collider.collide_points(points[remaining], prefilter)
+        result[remaining[inside]] = True
+        remaining = remaining[~inside]
+    return result
@@ -2,9 +2,7 @@
 ===============
 
 """
-from typing import Dict, List, Optional
-import numpy as np
-from itertools import chain
+from typing import List, Optional
 from os.path import dirname, join
 import os
 import sys
@@ -13,7 +11,6 @@ from threading import Thread
 import time
 from queue import Queue, Empty
 import pathlib
-import nixio as nix
 
 from kivy.event import EventDispatcher
 from kivy.properties import BooleanProperty, NumericProperty, StringProperty
@@ -23,15 +20,13 @@ from kivy.app import App
 from kivy.logger import Logger
 
 from more_kivy_app.app import app_error, report_exception_in_app
-from base_kivy_app.utils import pretty_space
 
-from glitter2.storage.imports.legacy import LegacyFileReader
-from glitter2.analysis import FileDataAnalysis, AnalysisSpec
-from glitter2.storage.data_file import DataFile
-from glitter2.player import GlitterPlayer
-from glitter2.storage.imports.clever_sys import read_clever_sys_file, \
-    add_clever_sys_data_to_file
-from glitter2.storage.imports.csv import read_csv, add_csv_data_to_file
+from glitter2.analysis import AnalysisSpec
+from glitter2.video import VideoDataCache
+from glitter2.analysis.process import SourceFile, FileProcessBase, \
+    SummeryStatsExporter, RawDataExporter, LegacyGlitterImporter, \
+    CleverSysImporter, CSVImporter, BatchJournal, iter_process_files
+from glitter2.analysis.scan import SourceScanCache, iter_source_files
 
 __all__ = (
     'SourceFile', 'FileProcessBase', 'SummeryStatsExporter', 'RawDataExporter',
@@ -39,364 +34,14 @@ __all__ = (
     'ExportManager')
 
 
-class SourceFile:
-
-    filename: pathlib.Path = None
-
-    file_size = 0
-
-    source_root: pathlib.Path = None
-    """The parent directory of the selected directory or file.
-    """
-
-    skip = False
-
-    result = ''
-
-    status = ''
-    """Can be one of ``''``, ``'processing'``, ``'failed'``, or ``'done'``.
-    """
-
-    item_index = None
-
-    exception = None
-
-    def __init__(self, filename: pathlib.Path, source_root: pathlib.Path):
-        super(SourceFile, self).__init__()
-        self.filename = filename
-        self.source_root = source_root
-        self.file_size = filename.stat().st_size
-
-    def get_gui_data(self):
-        status = self.status or ('skipping' if self.skip else '(no status)')
-        return {
-            'filename.text': str(self.filename),
-            'file_size.text': pretty_space(self.file_size),
-            'skip.state': 'down' if self.skip else 'normal',
-            'status.text': status,
-            'result': self.result,
-            'source_obj': self,
-        }
-
-    def pre_process(self):
-        self.exception = None
-        self.result = ''
-        self.status = 'running'
-
-    def post_process(self, e=None):
-        if e is None:
-            self.result = ''
-            self.status = 'done'
-        else:
-            tb = ''.join(traceback.format_exception(*sys.exc_info()))
-            self.result = 'Error: {}\n\n'.format(e)
-            self.result += tb
-            self.status = 'failed'
-            self.exception = str(e), tb
-
-    def reset_status(self):
-        self.exception = None
-        self.result = ''
-        self.status = ''
-
-
-class FileProcessBase:
-
-    def init_process(self):
-        pass
-
-    def process_file(self, src: SourceFile):
-        src.pre_process()
-        try:
-            res = self._process_file(src)
-        except BaseException as e:
-            src.post_process(e)
-            res = None
-        else:
-            src.post_process()
-
-        return res
-
-    def _process_file(self, src: SourceFile):
-        raise NotImplementedError
-
-    def finish_process(self):
-        pass
-
-    def _create_or_open_data_file(
-            self, src: SourceFile, target_filename, video_file, width, height,
-            timestamps=None):
-        existed = target_filename.exists()
-        nix_file = nix.File.open(str(target_filename), nix.FileMode.ReadWrite)
-
-        try:
-            if existed:
-                data_file = DataFile(nix_file=nix_file)
-                data_file.open_file()
-                if not data_file.saw_all_timestamps:
-                    raise ValueError(
-                        f'Did not watch all video frames for '
-                        f'"{src.filename}" so we cannot add import data')
-
-                metadata = data_file.video_metadata_dict
-                if tuple(metadata['src_vid_size']) != (width, height):
-                    raise ValueError(
-                        f'Data file\'s ({src.filename}) video size '
-                        f'does not match the original video file that created '
-                        f'the h5 data file ({target_filename}).')
-
-                use_src_timestamps = False
-                if timestamps is not None and \
-                        len(data_file.timestamps) == len(timestamps) and \
-                        np.all(np.asarray(data_file.timestamps) ==
-                               np.asarray(timestamps)):
-                    use_src_timestamps = True
-
-                return nix_file, data_file, use_src_timestamps
-
-            data_file = DataFile(nix_file=nix_file)
-            data_file.init_new_file()
-
-            use_src_timestamps = timestamps is not None
-            timestamps_, metadata = GlitterPlayer.get_file_data(
-                str(video_file), metadata_only=use_src_timestamps)
-            if not use_src_timestamps:
-                timestamps = timestamps_
-
-            data_file.set_file_data(
-                video_file_metadata=metadata, saw_all_timestamps=True,
-                timestamps=[timestamps], event_channels=[], pos_channels=[],
-                zone_channels=[])
-
-            data_file = DataFile(nix_file=nix_file)
-            data_file.open_file()
-        except BaseException:
-            nix_file.close()
-            raise
-
-        return nix_file, data_file, use_src_timestamps
-
-
-class SummeryStatsExporter(FileProcessBase):
-
-    spec: AnalysisSpec = None
-
-    export_filename: 'str' = ''
-
-    results: list = []
-
-    def __init__(self, spec, export_filename, **kwargs):
-        super().__init__(**kwargs)
-        self.spec = spec
-        self.export_filename = export_filename
-
-        if not export_filename:
-            raise ValueError('No export path specified for the stats data')
-        if pathlib.Path(export_filename).exists():
-            raise ValueError('"{}" already exists'.format(export_filename))
-
-        self.results = []
-
-    def _process_file(self, src: SourceFile):
-        spec = self.spec
-        with FileDataAnalysis(filename=str(src.filename)) as data_file:
-            data_file.load_file_data()
-
-            self.results.append(data_file.compute_data_summary(spec))
-
-    def finish_process(self):
-        results = list(chain(*self.results))
-        if not pathlib.Path(self.export_filename).parent.exists():
-            pathlib.Path(self.export_filename).parent.mkdir(parents=True)
-        FileDataAnalysis.export_computed_data_summary(
-            self.export_filename, results)
-
-
-class RawDataExporter(FileProcessBase):
-
-    dump_zone_collider = False
-
-    data_export_root: str = ''
-
-    def __init__(
-            self, dump_zone_collider=False, data_export_root='',
-            **kwargs):
-        super().__init__(**kwargs)
-        self.dump_zone_collider = dump_zone_collider
-        self.data_export_root = data_export_root
-
-        if not data_export_root:
-            raise ValueError('No export path specified for the raw data')
-
-    def _process_file(self, src: SourceFile):
-        with FileDataAnalysis(filename=str(src.filename)) as data_file:
-            data_file.load_file_data()
-
-            root = pathlib.Path(self.data_export_root)
-            filename = root.joinpath(
-                src.filename.relative_to(
-                    src.source_root)).with_suffix('.xlsx')
-            if not filename.parent.exists():
-                filename.parent.mkdir(parents=True)
-            data_file.export_raw_data_to_excel(
-                str(filename), dump_zone_collider=self.dump_zone_collider)
-
-
-class LegacyGlitterImporter(FileProcessBase):
-
-    output_files_root: str = ''
-
-    def __init__(self, output_files_root='', **kwargs):
-        super().__init__(**kwargs)
-        self.output_files_root = output_files_root
-
-        if not output_files_root:
-            raise ValueError('No export path specified for imported H5 files')
-
-    def _process_file(self, src: SourceFile):
-        output_files_root = pathlib.Path(self.output_files_root)
-        target_filename = output_files_root.joinpath(
-            src.filename.relative_to(src.source_root))
-
-        if not target_filename.parent.exists():
-            target_filename.parent.mkdir(parents=True)
-        if target_filename.exists():
-            raise ValueError(
-                f'"{target_filename}" already exists and legacy upgrading '
-                f'does not support appending')
-
-        legacy_reader = LegacyFileReader()
-        nix_file = nix.File.open(
-            str(target_filename), nix.FileMode.Overwrite)
-        try:
-            legacy_reader.upgrade_legacy_file(str(src.filename), nix_file)
-        finally:
-            nix_file.close()
-        return target_filename
-
-
-class CleverSysImporter(FileProcessBase):
-
-    output_files_root: str = ''
-
-    import_append_if_file_exists = False
-
-    def __init__(
-            self, output_files_root='', import_append_if_file_exists=False,
-            **kwargs):
-        super().__init__(**kwargs)
-        self.output_files_root = output_files_root
-        self.import_append_if_file_exists = import_append_if_file_exists
-
-        if not output_files_root:
-            raise ValueError('No export path specified for imported H5 files')
-
-    def _process_file(self, src: SourceFile):
-        data, video_metadata, zones, calibration = read_clever_sys_file(
-            src.filename)
-
-        video_file = pathlib.Path(video_metadata['video_file'])
-        if not video_file.exists():
-            # linux and windows paths can both be parsed with PureWindowsPath,
-            # but not with PurePosixPath, which fails on windows path
-            video_file = src.filename.parent.joinpath(
-                pathlib.PureWindowsPath(video_metadata['video_file']).name)
-            if not video_file.exists():
-                raise ValueError(
-                    f"Could not find {video_metadata['video_file']} or "
-                    f"{video_file}")
-
-        target_filename = pathlib.Path(
-            self.output_files_root).joinpath(
-                src.filename.relative_to(src.source_root).with_name(
-                    video_file.with_suffix('.h5').name))
-
-        if not target_filename.parent.exists():
-            target_filename.parent.mkdir(parents=True)
-
-        if not self.import_append_if_file_exists and target_filename.exists():
-            raise ValueError(
-                f'"{target_filename}" already exists, skipping file')
-
-        w = video_metadata['width']
-        h = video_metadata['height']
-        nix_file, data_file, src_timestamps = self._create_or_open_data_file(
-            src, target_filename, video_file, w, h)
-
-        try:
-            add_clever_sys_data_to_file(
-                data_file, data, video_metadata, zones, calibration)
-        finally:
-            nix_file.close()
-
-        return target_filename
-
-
-class CSVImporter(FileProcessBase):
-
-    output_files_root: str = ''
-
-    import_append_if_file_exists = False
-
-    def __init__(
-            self, output_files_root='', import_append_if_file_exists=False,
-            **kwargs):
-        super().__init__(**kwargs)
-        self.output_files_root = output_files_root
-        self.import_append_if_file_exists = import_append_if_file_exists
-
-        if not output_files_root:
-            raise ValueError('No export path specified for imported H5 files')
-
-    def _process_file(self, src: SourceFile):
-        metadata, timestamps, events, pos, zones = read_csv(str(src.filename))
-        saw_all_timestamps = metadata.get('saw_all_timestamps', False)
-
-        video_file = pathlib.Path(metadata['filename'])
-        if not video_file.exists():
-            # linux and windows paths can both be parsed with PureWindowsPath,
-            # but not with PurePosixPath, which fails on windows path
-            video_file = src.filename.parent.joinpath(
-                pathlib.PureWindowsPath(metadata['filename']).name)
-            if not video_file.exists():
-                raise ValueError(
-                    f"Could not find {metadata['filename']} or {video_file}")
-
-        target_filename = pathlib.Path(
-            self.output_files_root).joinpath(
-                src.filename.relative_to(src.source_root).with_name(
-                    video_file.with_suffix('.h5').name))
-
-        if not target_filename.parent.exists():
-            target_filename.parent.mkdir(parents=True)
-
-        if not self.import_append_if_file_exists and target_filename.exists():
-            raise ValueError(
-                f'"{target_filename}" already exists, skipping file')
-
-        w = metadata['video_width']
-        h = metadata['video_height']
-        # if we saw all the timestamps, use that instead of reading from file
-        timestamps_used = timestamps if saw_all_timestamps else None
-        nix_file, data_file, src_timestamps = self._create_or_open_data_file(
-            src, target_filename, video_file, w, h, timestamps_used)
-
-        try:
-            add_csv_data_to_file(
-                data_file, metadata, timestamps, events, pos, zones,
-                src_timestamps)
-        finally:
-            nix_file.close()
-
-        return target_filename
-
-
 class ExportManager(EventDispatcher):
 
     _config_props_ = (
         'source', 'source_match_suffix', 'generated_file_output_path',
         'root_raw_data_export_path', 'stats_export_path',
-        'raw_dump_zone_collider')
+        'raw_dump_zone_collider', 'video_cache_path', 'video_cache_size',
+        'num_workers', 'resume_stats_export', 'resume_from_journal',
+        'source_scan_threads', 'raw_export_format')
 
     num_files = NumericProperty(0)
 
@@ -445,6 +90,20 @@ class ExportManager(EventDispatcher):
     source: pathlib.Path = pathlib.Path()
 
     source_match_suffix = StringProperty('*.h5')
+    """The glob pattern of the names of the files in :attr:`source` to
+    process. Multiple patterns can be separated by ``;`` or ``,``.
+    """
+
+    source_scan_threads = NumericProperty(0)
+    """The number of threads used to scan the directories of :attr:`source`
+    in parallel, e.g. for network drives. If zero, it's scanned in the
+    export thread.
+    """
+
+    source_scan_cache: Optional[SourceScanCache] = None
+    """Caches the directory listings of the last scans so scanning again is
+    faster.
+    """
 
     generated_file_output_path = StringProperty('')
 
@@ -456,10 +115,20 @@ class ExportManager(EventDispatcher):
 
     raw_dump_zone_collider = BooleanProperty(True)
 
+    raw_export_format = StringProperty('xlsx')
+    """The file format of the exported raw data. See
+    :meth:`~glitter2.analysis.FileDataAnalysis.export_raw_data`.
+    """
+
     stats_template_path = StringProperty('')
 
     stats_export_path = StringProperty('')
 
+    resume_stats_export = BooleanProperty(False)
+    """Whether to resume a stats export to :attr:`stats_export_path` that was
+    stopped before it finished. See :class:`SummeryStatsExporter`.
+    """
+
     source_contents: List['SourceFile'] = []
 
     spec: Optional[AnalysisSpec] = None
@@ -468,6 +137,30 @@ class ExportManager(EventDispatcher):
 
     import_append_if_file_exists = False
 
+    video_cache_path = StringProperty('')
+    """If not empty, the directory where the timestamps and metadata of video
+    files read when importing are cached, so repeated imports of the same
+    video files don't need to read all the frames again.
+    """
+
+    video_cache_size = NumericProperty(256)
+    """The maximum size of the video cache in :attr:`video_cache_path`, in
+    MB.
+    """
+
+    resume_from_journal = BooleanProperty(True)
+    """Whether to skip files that were already processed successfully in a
+    previous run, as recorded in the processor's
+    :class:`~glitter2.analysis.process.BatchJournal`. Files that failed or
+    that changed since are processed again.
+    """
+
+    num_workers = NumericProperty(0)
+    """The number of worker processes used to process the files in parallel.
+
+    If zero, the files are processed one at a time in the export thread.
+    """
+
     def __init__(self, **kwargs):
         super(ExportManager, self).__init__(**kwargs)
         self.source_contents = []
@@ -571,33 +264,50 @@ class ExportManager(EventDispatcher):
              (self.source, self.source_match_suffix)))
 
     def refresh_source_contents(self, source: pathlib.Path, match_suffix: str):
-        contents = []
-        total_size = 0
-        num_files = 0
-        temp_h5 = self.currently_open_temp_h5_file
-
-        for base in source.glob('**'):
-            # always be ready to stop
-            if self.stop_op:
-                return [], 0, 0, []
+        """Scans the source for the files to process and sends them to the GUI
+        in batches as they are found.
+        """
+        queue_put = self.kivy_thread_queue.put
+        trigger = self.trigger_run_in_kivy
+        cache = self.source_scan_cache
+        if cache is None:
+            cache = self.source_scan_cache = SourceScanCache()
 
-            for file in base.glob(match_suffix):
-                if self.stop_op:
-                    return [], 0, 0, []
+        def stop():
+            return self.stop_op
 
-                if not file.is_file():
-                    continue
+        num_files = 0
+        batch = []
+        last_sent = time.perf_counter()
 
-                if temp_h5 is not None and temp_h5 == file:
-                    continue
+        def send_batch():
+            gui_data = self.set_src_data_index(batch)
+            size = sum(item.file_size for item in batch)
+            queue_put(('add_source_contents', (batch, size, gui_data)))
+            trigger()
 
-                item = SourceFile(filename=file, source_root=source)
+        for files in iter_source_files(
+                source, match_suffix, int(self.source_scan_threads), stop,
+                cache, self.currently_open_temp_h5_file):
+            for item in files:
+                item.item_index = num_files
                 num_files += 1
-                total_size += item.file_size
-                contents.append(item)
+            batch.extend(files)
 
-        gui_data = self.set_src_data_index(contents, set_index=True)
-        return contents, total_size, num_files, gui_data
+            # don't flood the GUI with many small updates
+            if time.perf_counter() - last_sent >= .25:
+                send_batch()
+                batch = []
+                last_sent = time.perf_counter()
+
+        # always be ready to stop
+        if self.stop_op:
+            queue_put(('refresh_source_contents', ([], 0, 0, [])))
+            trigger()
+            return
+
+        if batch:
+            send_batch()
 
     @app_error
     def request_process_files(self, summary_template_file=None):
@@ -698,8 +408,7 @@ class ExportManager(EventDispatcher):
                     kivy_queue_put(('toggle_skip', gui_data))
                     self.compute_to_be_processed_size()
                 elif msg == 'refresh_source_contents':
-                    res = self.refresh_source_contents(*value)
-                    kivy_queue_put(('refresh_source_contents', res))
+                    self.refresh_source_contents(*value)
                 elif msg == 'process_files':
                     self._start_processing_time = time.perf_counter()
                     self.compute_to_be_processed_size()
@@ -758,6 +467,12 @@ class ExportManager(EventDispatcher):
                     self.processed_size = 0
                     self.source_contents = contents
                     self.recycle_view.data = gui_data
+                elif msg == 'add_source_contents':
+                    contents, total_size, gui_data = value
+                    self.source_contents.extend(contents)
+                    self.num_files += len(contents)
+                    self.total_size += total_size
+                    self.recycle_view.data.extend(gui_data)
                 elif msg == 'update_source_items':
                     self.recycle_view.data = value
                 elif msg == 'toggle_skip':
@@ -824,14 +539,21 @@ class ExportManager(EventDispatcher):
         mode = self.batch_mode
         export_mode = self.batch_export_mode
         import_append_if_file_exists = self.import_append_if_file_exists
+        video_cache = None
+        if self.video_cache_path:
+            video_cache = VideoDataCache(
+                self.video_cache_path,
+                max_size=int(self.video_cache_size * 1024 * 1024))
 
         if mode == 'export_raw':
             processor = RawDataExporter(
                 dump_zone_collider=self.raw_dump_zone_collider,
-                data_export_root=self.root_raw_data_export_path)
+                data_export_root=self.root_raw_data_export_path,
+                export_format=self.raw_export_format)
         elif mode == 'export_stats':
             processor = SummeryStatsExporter(
-                spec=self.spec, export_filename=self.stats_export_path)
+                spec=self.spec, export_filename=self.stats_export_path,
+                resume=self.resume_stats_export)
         else:
             assert mode == 'import'
             if export_mode == 'legacy':
@@ -840,41 +562,52 @@ class ExportManager(EventDispatcher):
             elif export_mode == 'cleversys':
                 processor = CleverSysImporter(
                     output_files_root=self.generated_file_output_path,
-                    import_append_if_file_exists=import_append_if_file_exists)
+                    import_append_if_file_exists=import_append_if_file_exists,
+                    video_cache=video_cache)
             elif export_mode == 'csv':
                 processor = CSVImporter(
                     output_files_root=self.generated_file_output_path,
-                    import_append_if_file_exists=import_append_if_file_exists)
+                    import_append_if_file_exists=import_append_if_file_exists,
+                    video_cache=video_cache)
             else:
                 assert False, export_mode
 
-        processor.init_process()
-        for item in self.source_contents:
-            if self.stop_op:
-                return
-            if item.skip:
-                queue_put(('increment', (self, 'num_skipped_files', 1)))
-                trigger()
-                continue
+        def stop():
+            return self.stop_op
 
-            item.status = 'running'
-            queue_put(
-                ('update_source_item', (item.item_index, item.get_gui_data())))
-            processor.process_file(item)
+        journal = None
+        if processor.get_journal_filename():
+            journal = BatchJournal(processor.get_journal_filename())
 
-            queue_put(
-                ('update_source_item', (item.item_index, item.get_gui_data())))
-            if item.status != 'done':
-                queue_put(('increment', (self, 'num_failed_files', 1)))
-            else:
-                queue_put(('increment', (self, 'num_processed_files', 1)))
-            queue_put(('increment', (self, 'processed_size', item.file_size)))
-
-            if item.exception is not None:
-                queue_put(('exception', item.exception))
-            trigger()
+        try:
+            for event, item in iter_process_files(
+                    processor, self.source_contents, int(self.num_workers),
+                    stop, journal, self.resume_from_journal):
+                if event == 'skipped':
+                    queue_put(('increment', (self, 'num_skipped_files', 1)))
+                    trigger()
+                    continue
 
-        processor.finish_process()
+                queue_put((
+                    'update_source_item',
+                    (item.item_index, item.get_gui_data())))
+                if event in ('processed', 'previously_done'):
+                    if item.status != 'done':
+                        queue_put(
+                            ('increment', (self, 'num_failed_files', 1)))
+                    else:
+                        queue_put(
+                            ('increment', (self, 'num_processed_files', 1)))
+                    queue_put(
+                        ('increment',
+                         (self, 'processed_size', item.file_size)))
+
+                    if item.exception is not None:
+                        queue_put(('exception', item.exception))
+                trigger()
+        finally:
+            if journal is not None:
+                journal.close()
 
     def stop(self):
         if self.internal_thread_queue:
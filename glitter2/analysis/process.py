@@ -0,0 +1,996 @@
+"""Batch file processing
+==========================
+
+Processes files in batch, e.g. exporting the summary statistics or raw data of
+Glitter2 H5 data files, or importing data from other programs into H5 data
+files. Each file to be processed is represented by a :class:`SourceFile` and
+processed with a :class:`FileProcessBase` subclass.
+
+This module does not require a running Kivy app, window, or clock, so it can be
+used headless e.g. by :mod:`glitter2.batch`. The files can be processed one at
+a time or in parallel in a process pool, using :func:`iter_process_files`.
+
+E.g.::
+
+    processor = RawDataExporter(data_export_root='/home/user/raw')
+    files = [SourceFile(filename=f, source_root=root) for f in filenames]
+    for event, item in iter_process_files(processor, files, num_workers=4):
+        print(event, item.filename, item.status)
+"""
+from typing import Dict, List, Optional, Callable, Generator, Tuple, \
+    Iterable
+import numpy as np
+import io
+import os
+import csv
+import json
+from math import inf
+import sys
+import signal
+import time
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
+import pathlib
+import nixio as nix
+import xlsxwriter
+
+from glitter2.storage.imports.legacy import LegacyFileReader
+from glitter2.analysis import FileDataAnalysis, AnalysisSpec
+from glitter2.storage.data_file import DataFile
+from glitter2.video import get_video_file_data, VideoDataCache
+from glitter2.storage.imports.clever_sys import read_clever_sys_file, \
+    add_clever_sys_data_to_file
+from glitter2.storage.imports.csv import read_csv, add_csv_data_to_file
+
+__all__ = (
+    'SourceFile', 'FileProcessBase', 'SummaryStatsWriter', 'BatchJournal',
+    'SummeryStatsExporter', 'RawDataExporter',
+    'LegacyGlitterImporter', 'CleverSysImporter', 'CSVImporter',
+    'iter_process_files')
+
+
+class SourceFile:
+
+    filename: pathlib.Path = None
+
+    file_size = 0
+
+    source_root: pathlib.Path = None
+    """The parent directory of the selected directory or file.
+    """
+
+    skip = False
+
+    result = ''
+
+    status = ''
+    """Can be one of ``''``, ``'processing'``, ``'failed'``, or ``'done'``.
+    """
+
+    item_index = None
+
+    exception = None
+
+    file_mtime_ns = 0
+    """The modification time of the file, in ns, when it was listed.
+    """
+
+    def __init__(
+            self, filename: pathlib.Path, source_root: pathlib.Path,
+            stat: Optional[os.stat_result] = None):
+        """
+        :param filename: The file.
+        :param source_root: See :attr:`source_root`.
+        :param stat: The file's stat, if already available. Otherwise, the
+            file is stat-ed.
+        """
+        super(SourceFile, self).__init__()
+        self.filename = filename
+        self.source_root = source_root
+        if stat is None:
+            stat = filename.stat()
+        self.file_size = stat.st_size
+        self.file_mtime_ns = stat.st_mtime_ns
+
+    def get_gui_data(self):
+        # it imports kivy, so only import it when used by the GUI
+        from base_kivy_app.utils import pretty_space
+        status = self.status or ('skipping' if self.skip else '(no status)')
+        return {
+            'filename.text': str(self.filename),
+            'file_size.text': pretty_space(self.file_size),
+            'skip.state': 'down' if self.skip else 'normal',
+            'status.text': status,
+            'result': self.result,
+            'source_obj': self,
+        }
+
+    def pre_process(self):
+        self.exception = None
+        self.result = ''
+        self.status = 'running'
+
+    def post_process(self, e=None):
+        if e is None:
+            self.result = ''
+            self.status = 'done'
+        else:
+            tb = ''.join(traceback.format_exception(*sys.exc_info()))
+            self.result = 'Error: {}\n\n'.format(e)
+            self.result += tb
+            self.status = 'failed'
+            self.exception = str(e), tb
+
+    def reset_status(self):
+        self.exception = None
+        self.result = ''
+        self.status = ''
+
+
+class FileProcessBase:
+
+    video_cache: Optional[VideoDataCache] = None
+    """If not None, a cache used to read the timestamps and metadata of the
+    video files, when creating new data files.
+    """
+
+    def __init__(self, video_cache: Optional[VideoDataCache] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.video_cache = video_cache
+
+    def init_process(self):
+        pass
+
+    def process_file(self, src: SourceFile, index: Optional[int] = None):
+        """Processes the file and adds its result with :meth:`add_result`.
+
+        :param src: The file to process.
+        :param index: The order of the file among all the processed files.
+            See :meth:`add_result`.
+        """
+        res = self.run_process_file(src)
+        if src.status == 'done':
+            self.add_result(src, res, index)
+        return res
+
+    def run_process_file(self, src: SourceFile):
+        """Processes the file like :meth:`process_file`, but without adding
+        the result. This is used by the worker processes, after which the
+        result is added by the main process with :meth:`add_result`.
+        """
+        src.pre_process()
+        try:
+            res = self._process_file(src)
+        except BaseException as e:
+            src.post_process(e)
+            res = None
+        else:
+            src.post_process()
+
+        return res
+
+    def _process_file(self, src: SourceFile):
+        raise NotImplementedError
+
+    def add_result(self, src: SourceFile, res, index: Optional[int] = None):
+        """Called with the result of each file that was successfully
+        processed, in the process that calls :meth:`finish_process`.
+
+        :param src: The processed file.
+        :param res: The value returned by :meth:`_process_file`.
+        :param index: The order of the file among all the processed files.
+            Files may finish out of order when processed in parallel, so this
+            can be used to order the results. If None, the file is after all
+            the previous files.
+        """
+        pass
+
+    def finish_process(self):
+        pass
+
+    def get_journal_filename(self) -> Optional[str]:
+        """Returns the filename of the :class:`BatchJournal` that records which
+        files were processed, or None if it doesn't use a journal.
+        """
+        return None
+
+    def _create_or_open_data_file(
+            self, src: SourceFile, target_filename, video_file, width, height,
+            timestamps=None):
+        existed = target_filename.exists()
+        nix_file = nix.File.open(str(target_filename), nix.FileMode.ReadWrite)
+
+        try:
+            if existed:
+                data_file = DataFile(nix_file=nix_file)
+                data_file.open_file()
+                if not data_file.saw_all_timestamps:
+                    raise ValueError(
+                        f'Did not watch all video frames for '
+                        f'"{src.filename}" so we cannot add import data')
+
+                metadata = data_file.video_metadata_dict
+                if tuple(metadata['src_vid_size']) != (width, height):
+                    raise ValueError(
+                        f'Data file\'s ({src.filename}) video size '
+                        f'does not match the original video file that created '
+                        f'the h5 data file ({target_filename}).')
+
+                use_src_timestamps = False
+                if timestamps is not None and \
+                        len(data_file.timestamps) == len(timestamps) and \
+                        np.all(np.asarray(data_file.timestamps) ==
+                               np.asarray(timestamps)):
+                    use_src_timestamps = True
+
+                return nix_file, data_file, use_src_timestamps
+
+            data_file = DataFile(nix_file=nix_file)
+            data_file.init_new_file()
+
+            use_src_timestamps = timestamps is not None
+            timestamps_, metadata = get_video_file_data(
+                str(video_file), metadata_only=use_src_timestamps,
+                cache=self.video_cache)
+            if not use_src_timestamps:
+                timestamps = timestamps_
+
+            data_file.set_file_data(
+                video_file_metadata=metadata, saw_all_timestamps=True,
+                timestamps=[timestamps], event_channels=[], pos_channels=[],
+                zone_channels=[])
+
+            data_file = DataFile(nix_file=nix_file)
+            data_file.open_file()
+        except BaseException:
+            nix_file.close()
+            raise
+
+        return nix_file, data_file, use_src_timestamps
+
+
+class SummaryStatsWriter:
+    """Writes the summary statistics rows of many data files to a CSV file
+    as each file is processed, and then creates the Excel file from the CSV
+    file once all the files are processed.
+
+    Only the rows of one file are kept in memory at once, and if processing
+    stops, the files already written can be skipped when resumed.
+
+    The rows are appended to the CSV file :attr:`filename` in the order the
+    files finished processing. The :attr:`typed_columns` are written as JSON,
+    so that e.g. numbers are not converted to strings. For each file, a JSON
+    line is appended to the index file :attr:`index_filename` once its rows
+    are on disk. It records the file's index, filename, and the byte range of
+    its rows in the CSV file. The Excel file lists the files in the order of
+    their index, and then filename.
+    """
+
+    typed_columns = ['missed timestamps', 'value']
+    """The columns of
+    :attr:`~glitter2.analysis.FileDataAnalysis.data_summary_header` whose
+    values are written as JSON to the CSV file.
+    """
+
+    filename: str = ''
+    """The CSV file to which the rows are written.
+    """
+
+    index_filename: str = ''
+    """The file listing the files whose rows are in :attr:`filename`.
+    """
+
+    completed: Dict[str, dict] = {}
+    """Maps the filename of each data file whose rows were written, to its
+    index entry.
+    """
+
+    _file = None
+
+    _index_file = None
+
+    def __init__(self, filename: str, resume: bool = False):
+        self.filename = filename
+        self.index_filename = f'{filename}.index'
+        self.completed = {}
+
+        exists = os.path.exists(filename)
+        if exists and not resume:
+            raise ValueError(
+                f'"{filename}" already exists. Resume to add to it')
+        if resume and exists:
+            self._load_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_file', None)
+        state.pop('_index_file', None)
+        return state
+
+    def _load_index(self):
+        """Reads the entries of the files whose rows were completely written,
+        and removes any partially written rows after them.
+        """
+        completed = {}
+        end = 0
+        index_end = 0
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as fh:
+                for line in fh:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+
+                    completed[entry['filename']] = entry
+                    end = max(end, entry['end'])
+                    index_end += len(line)
+
+        if os.path.getsize(self.filename) < end:
+            raise ValueError(
+                f'"{self.filename}" is shorter than listed in '
+                f'"{self.index_filename}"')
+
+        with open(self.filename, 'r+b') as fh:
+            fh.truncate(end)
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r+b') as fh:
+                fh.truncate(index_end)
+        self.completed = completed
+
+    def open(self):
+        """Opens the CSV and index files for appending. It's called
+        automatically by :meth:`add_rows`.
+        """
+        if self._file is not None:
+            return
+
+        parent = pathlib.Path(self.filename).parent
+        if not parent.exists():
+            parent.mkdir(parents=True)
+
+        self._file = open(self.filename, 'ab')
+        try:
+            if not self._file.tell():
+                self._write_csv([FileDataAnalysis.data_summary_header])
+            self._index_file = open(self.index_filename, 'ab')
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Closes the files opened by :meth:`open`.
+        """
+        for name in ('_file', '_index_file'):
+            fh = getattr(self, name)
+            if fh is not None:
+                setattr(self, name, None)
+                fh.close()
+
+    def _write_csv(self, rows: List[list]):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerows(rows)
+        self._file.write(buffer.getvalue().encode('utf8'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add_rows(self, filename: str, index: int, rows: List[list]):
+        """Appends the summary rows of the data file to the CSV file.
+
+        :param filename: The data file's filename.
+        :param index: The order of the data file in the exported Excel file.
+        :param rows: The rows as returned by
+            :meth:`~glitter2.analysis.FileDataAnalysis.compute_data_summary`.
+        """
+        self.open()
+        header = FileDataAnalysis.data_summary_header
+        typed_cols = [header.index(name) for name in self.typed_columns]
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i in typed_cols:
+                row[i] = json.dumps(self._get_cell_value(row[i]))
+
+        start = self._file.tell()
+        self._write_csv(rows)
+
+        entry = {
+            'index': index, 'filename': filename, 'start': start,
+            'end': self._file.tell()}
+        self._index_file.write(json.dumps(entry).encode('utf8') + b'\n')
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self.completed[filename] = entry
+
+    def set_index(self, filename: str, index: int):
+        """Sets the index of a data file whose rows were already written, e.g.
+        when resuming with a different list of files. It only changes the
+        order of the file in the Excel file created by :meth:`export_excel`.
+        """
+        self.completed[filename]['index'] = index
+
+    @staticmethod
+    def _get_cell_value(value):
+        """Returns the value as it's written to the Excel file, but with
+        nan/inf and None as is.
+        """
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        # like pandas, cells that are not a number or string, e.g. lists, are
+        # written as strings
+        return str(value)
+
+    @staticmethod
+    def _parse_value(value: str):
+        value = json.loads(value)
+        if value is None:
+            return ''
+        if isinstance(value, float) and (
+                value != value or value in (inf, -inf)):
+            # Excel has no nan/inf numbers
+            return '' if value != value else str(value)
+        return value
+
+    def export_excel(self, filename: str):
+        """Creates the Excel file from the rows of the CSV file, ordered by
+        the files' index.
+
+        The rows are read from the CSV file and written to the Excel file one
+        data file at a time, so the data is never all in memory.
+        """
+        self.close()
+        if not filename.endswith('.xlsx'):
+            filename += '.xlsx'
+        if os.path.exists(filename):
+            raise ValueError('"{}" already exists'.format(filename))
+
+        header = FileDataAnalysis.data_summary_header
+        typed_cols = [header.index(name) for name in self.typed_columns]
+        entries = sorted(
+            self.completed.values(),
+            key=lambda e: (e['index'], e['filename']))
+
+        workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+        try:
+            sheet = workbook.add_worksheet('statistics')
+            sheet.write_row(0, 0, header, workbook.add_format({'bold': True}))
+            row_i = 1
+
+            with open(self.filename, 'rb') as fh:
+                for entry in entries:
+                    fh.seek(entry['start'])
+                    data = fh.read(entry['end'] - entry['start'])
+                    for row in csv.reader(io.StringIO(data.decode('utf8'))):
+                        for i in typed_cols:
+                            row[i] = self._parse_value(row[i])
+                        sheet.write_row(row_i, 0, row)
+                        row_i += 1
+        finally:
+            workbook.close()
+
+
+class SummeryStatsExporter(FileProcessBase):
+
+    spec: AnalysisSpec = None
+
+    export_filename: 'str' = ''
+
+    writer: SummaryStatsWriter = None
+    """Writes the summary of each file as it's processed, to a CSV file next to
+    :attr:`export_filename`. The Excel file is created from it once all the
+    files are processed.
+    """
+
+    def __init__(self, spec, export_filename, resume=False, **kwargs):
+        """
+        :param spec: The computations to export for each file.
+        :param export_filename: The Excel file to create.
+        :param resume: Whether to resume a previous export to the same
+            filename that was stopped before the Excel file was created.
+            Files already written to the CSV file are not processed again.
+        """
+        super().__init__(**kwargs)
+        self.spec = spec
+        self.export_filename = export_filename
+
+        if not export_filename:
+            raise ValueError('No export path specified for the stats data')
+        if pathlib.Path(export_filename).exists():
+            raise ValueError('"{}" already exists'.format(export_filename))
+
+        self.writer = SummaryStatsWriter(
+            str(pathlib.Path(export_filename).with_suffix('.csv')),
+            resume=resume)
+
+    def _process_file(self, src: SourceFile):
+        if str(src.filename) in self.writer.completed:
+            return None
+
+        spec = self.spec
+        with FileDataAnalysis(filename=str(src.filename)) as data_file:
+            # only read the channels used by the spec, when they are used. The
+            # data is only used while the file is open, so it can be mapped
+            data_file.load_file_data(
+                spec.get_required_channels(), lazy=True, memmap=True)
+
+            return data_file.compute_data_summary(spec)
+
+    def add_result(self, src: SourceFile, res, index: Optional[int] = None):
+        writer = self.writer
+        if res is None:
+            # it was already written when resuming, so only use its index in
+            # this run, which may not be the same as when it was written
+            if index is not None:
+                writer.set_index(str(src.filename), index)
+            return
+        if index is None:
+            index = max(
+                (e['index'] for e in writer.completed.values()),
+                default=-1) + 1
+        writer.add_rows(str(src.filename), index, res)
+
+    def finish_process(self):
+        self.writer.export_excel(self.export_filename)
+
+
+class RawDataExporter(FileProcessBase):
+
+    dump_zone_collider = False
+
+    data_export_root: str = ''
+
+    export_format = 'xlsx'
+    """The file format of the exported raw data. See
+    :meth:`~glitter2.analysis.FileDataAnalysis.export_raw_data`.
+    """
+
+    def __init__(
+            self, dump_zone_collider=False, data_export_root='',
+            export_format='xlsx', **kwargs):
+        super().__init__(**kwargs)
+        self.dump_zone_collider = dump_zone_collider
+        self.data_export_root = data_export_root
+        self.export_format = export_format
+
+        if not data_export_root:
+            raise ValueError('No export path specified for the raw data')
+        if export_format not in FileDataAnalysis.raw_data_suffixes:
+            raise ValueError(f'Unknown raw data format "{export_format}"')
+
+    def _process_file(self, src: SourceFile):
+        with FileDataAnalysis(filename=str(src.filename)) as data_file:
+            data_file.load_file_data(lazy=True)
+
+            root = pathlib.Path(self.data_export_root)
+            filename = root.joinpath(
+                src.filename.relative_to(src.source_root)).with_suffix(
+                FileDataAnalysis.raw_data_suffixes[self.export_format])
+            if not filename.parent.exists():
+                filename.parent.mkdir(parents=True)
+            data_file.export_raw_data(
+                str(filename), self.export_format,
+                dump_zone_collider=self.dump_zone_collider)
+        return filename
+
+    def get_journal_filename(self) -> Optional[str]:
+        return os.path.join(self.data_export_root, BatchJournal.default_name)
+
+
+class LegacyGlitterImporter(FileProcessBase):
+
+    output_files_root: str = ''
+
+    def __init__(self, output_files_root='', **kwargs):
+        super().__init__(**kwargs)
+        self.output_files_root = output_files_root
+
+        if not output_files_root:
+            raise ValueError('No export path specified for imported H5 files')
+
+    def get_journal_filename(self) -> Optional[str]:
+        return os.path.join(self.output_files_root, BatchJournal.default_name)
+
+    def _process_file(self, src: SourceFile):
+        output_files_root = pathlib.Path(self.output_files_root)
+        target_filename = output_files_root.joinpath(
+            src.filename.relative_to(src.source_root))
+
+        if not target_filename.parent.exists():
+            target_filename.parent.mkdir(parents=True)
+        if target_filename.exists():
+            raise ValueError(
+                f'"{target_filename}" already exists and legacy upgrading '
+                f'does not support appending')
+
+        legacy_reader = LegacyFileReader()
+        nix_file = nix.File.open(
+            str(target_filename), nix.FileMode.Overwrite)
+        try:
+            legacy_reader.upgrade_legacy_file(str(src.filename), nix_file)
+        finally:
+            nix_file.close()
+        return target_filename
+
+
+class CleverSysImporter(FileProcessBase):
+
+    output_files_root: str = ''
+
+    import_append_if_file_exists = False
+
+    def __init__(
+            self, output_files_root='', import_append_if_file_exists=False,
+            **kwargs):
+        super().__init__(**kwargs)
+        self.output_files_root = output_files_root
+        self.import_append_if_file_exists = import_append_if_file_exists
+
+        if not output_files_root:
+            raise ValueError('No export path specified for imported H5 files')
+
+    def get_journal_filename(self) -> Optional[str]:
+        return os.path.join(self.output_files_root, BatchJournal.default_name)
+
+    def _process_file(self, src: SourceFile):
+        data, video_metadata, zones, calibration = read_clever_sys_file(
+            src.filename)
+
+        video_file = pathlib.Path(video_metadata['video_file'])
+        if not video_file.exists():
+            # linux and windows paths can both be parsed with PureWindowsPath,
+            # but not with PurePosixPath, which fails on windows path
+            video_file = src.filename.parent.joinpath(
+                pathlib.PureWindowsPath(video_metadata['video_file']).name)
+            if not video_file.exists():
+                raise ValueError(
+                    f"Could not find {video_metadata['video_file']} or "
+                    f"{video_file}")
+
+        target_filename = pathlib.Path(
+            self.output_files_root).joinpath(
+                src.filename.relative_to(src.source_root).with_name(
+                    video_file.with_suffix('.h5').name))
+
+        if not target_filename.parent.exists():
+            target_filename.parent.mkdir(parents=True)
+
+        if not self.import_append_if_file_exists and target_filename.exists():
+            raise ValueError(
+                f'"{target_filename}" already exists, skipping file')
+
+        w = video_metadata['width']
+        h = video_metadata['height']
+        nix_file, data_file, src_timestamps = self._create_or_open_data_file(
+            src, target_filename, video_file, w, h)
+
+        try:
+            add_clever_sys_data_to_file(
+                data_file, data, video_metadata, zones, calibration)
+            data_file.flush()
+        finally:
+            nix_file.close()
+
+        return target_filename
+
+
+class CSVImporter(FileProcessBase):
+
+    output_files_root: str = ''
+
+    import_append_if_file_exists = False
+
+    def __init__(
+            self, output_files_root='', import_append_if_file_exists=False,
+            **kwargs):
+        super().__init__(**kwargs)
+        self.output_files_root = output_files_root
+        self.import_append_if_file_exists = import_append_if_file_exists
+
+        if not output_files_root:
+            raise ValueError('No export path specified for imported H5 files')
+
+    def get_journal_filename(self) -> Optional[str]:
+        return os.path.join(self.output_files_root, BatchJournal.default_name)
+
+    def _process_file(self, src: SourceFile):
+        metadata, timestamps, events, pos, zones = read_csv(str(src.filename))
+        saw_all_timestamps = metadata.get('saw_all_timestamps', False)
+
+        video_file = pathlib.Path(metadata['filename'])
+        if not video_file.exists():
+            # linux and windows paths can both be parsed with PureWindowsPath,
+            # but not with PurePosixPath, which fails on windows path
+            video_file = src.filename.parent.joinpath(
+                pathlib.PureWindowsPath(metadata['filename']).name)
+            if not video_file.exists():
+                raise ValueError(
+                    f"Could not find {metadata['filename']} or {video_file}")
+
+        target_filename = pathlib.Path(
+            self.output_files_root).joinpath(
+                src.filename.relative_to(src.source_root).with_name(
+                    video_file.with_suffix('.h5').name))
+
+        if not target_filename.parent.exists():
+            target_filename.parent.mkdir(parents=True)
+
+        if not self.import_append_if_file_exists and target_filename.exists():
+            raise ValueError(
+                f'"{target_filename}" already exists, skipping file')
+
+        w = metadata['video_width']
+        h = metadata['video_height']
+        # if we saw all the timestamps, use that instead of reading from file
+        timestamps_used = timestamps if saw_all_timestamps else None
+        nix_file, data_file, src_timestamps = self._create_or_open_data_file(
+            src, target_filename, video_file, w, h, timestamps_used)
+
+        try:
+            add_csv_data_to_file(
+                data_file, metadata, timestamps, events, pos, zones,
+                src_timestamps)
+            data_file.flush()
+        finally:
+            nix_file.close()
+
+        return target_filename
+
+
+class BatchJournal:
+    """A SQLite journal that records the status of each file processed by a
+    :class:`FileProcessBase`, so that a batch that was stopped or crashed can
+    be resumed without processing again the files that were done.
+
+    Each file is recorded with its size and modification time when processed
+    and the output file created, if any. A file is considered done, only if
+    it was processed successfully, its size and modification time did not
+    change, and its output file still exists. Files that failed are always
+    processed again.
+
+    Files are recorded separately for each processor class, so e.g. importing
+    and exporting to the same directory use the same journal file.
+
+    E.g.::
+
+        journal = BatchJournal('/home/user/export/.glitter2_journal.sqlite')
+        for event, item in iter_process_files(
+                processor, files, journal=journal):
+            ...
+        journal.close()
+    """
+
+    default_name = '.glitter2_journal.sqlite'
+    """The journal's filename in the output directory, as returned by
+    :meth:`FileProcessBase.get_journal_filename`.
+    """
+
+    filename: str = ''
+    """The SQLite file of the journal.
+    """
+
+    _connection: Optional[sqlite3.Connection] = None
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        parent = pathlib.Path(filename).parent
+        if not parent.exists():
+            parent.mkdir(parents=True)
+
+        self._connection = sqlite3.connect(filename)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS source_files ('
+                'processor TEXT NOT NULL, filename TEXT NOT NULL, '
+                'size INTEGER, mtime_ns INTEGER, status TEXT, output TEXT, '
+                'error TEXT, time REAL, PRIMARY KEY (processor, filename))')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_entry(self, processor: str, src: SourceFile) -> Optional[dict]:
+        """Returns the journal entry of the file as a dict, or None if it's
+        not in the journal.
+
+        :param processor: The name of the processor class.
+        :param src: The file.
+        """
+        row = self._connection.execute(
+            'SELECT size, mtime_ns, status, output, error, time FROM '
+            'source_files WHERE processor = ? AND filename = ?',
+            (processor, str(src.filename))).fetchone()
+        if row is None:
+            return None
+        keys = 'size', 'mtime_ns', 'status', 'output', 'error', 'time'
+        return dict(zip(keys, row))
+
+    def is_done(self, processor: str, src: SourceFile) -> bool:
+        """Returns whether the file was successfully processed and didn't
+        change since.
+        """
+        entry = self.get_entry(processor, src)
+        if entry is None or entry['status'] != 'done':
+            return False
+        if entry['size'] != src.file_size or \
+                entry['mtime_ns'] != src.file_mtime_ns:
+            return False
+        return not entry['output'] or os.path.exists(entry['output'])
+
+    def record(self, processor: str, src: SourceFile, output=None):
+        """Records the current status of the file that was processed.
+
+        :param processor: The name of the processor class.
+        :param src: The processed file.
+        :param output: The output filename of the processed file, if any.
+        """
+        error = src.exception[0] if src.exception is not None else None
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO source_files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?)',
+                (processor, str(src.filename), src.file_size,
+                 src.file_mtime_ns, src.status,
+                 str(output) if output is not None else '', error,
+                 time.time()))
+
+
+_worker_processor: Optional[FileProcessBase] = None
+"""The processor used to process the files in a worker process of
+:func:`iter_process_files`.
+"""
+
+
+def _init_process_worker(processor: FileProcessBase):
+    global _worker_processor
+    # Ctrl-C is handled by the main process, which stops submitting files
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_processor = processor
+    processor.init_process()
+
+
+def _run_process_worker(src: SourceFile):
+    res = _worker_processor.run_process_file(src)
+    return src.status, src.result, src.exception, res
+
+
+def iter_process_files(
+        processor: FileProcessBase, source_files: Iterable[SourceFile],
+        num_workers: int = 0, stop: Optional[Callable[[], bool]] = None,
+        journal: Optional[BatchJournal] = None, resume: bool = True
+) -> Generator[Tuple[str, SourceFile], None, None]:
+    """Processes the files with the processor and yields the progress as each
+    file is processed.
+
+    It yields 2-tuples of ``(event, item)``, where event is one of:
+
+    * ``'skipped'``: the item is skipped because :attr:`SourceFile.skip` is
+      True.
+    * ``'running'``: the item started processing.
+    * ``'processed'``: the item finished processing. Its
+      :attr:`SourceFile.status` is either ``'done'`` or ``'failed'``.
+    * ``'cancelled'``: the item was waiting to be processed when ``stop``
+      returned True, so it was not processed and its status was reset.
+    * ``'previously_done'``: the item is listed as done in the ``journal``,
+      so it's not processed again. Its status is set to ``'done'``.
+
+    :meth:`FileProcessBase.finish_process` is called once all the files have
+    been processed, unless stopped.
+
+    :param processor: The :class:`FileProcessBase` used to process the files.
+    :param source_files: The files to process. The results are added in the
+        order of the files, even if they finish out of order.
+    :param num_workers: The number of worker processes used to process the
+        files in parallel. If zero, the files are processed one at a time in
+        the current thread. When using workers, the processor must be
+        picklable.
+    :param stop: An optional callable that returns True when processing
+        should be stopped. It's checked before each file is processed. With
+        workers, the files already being processed are finished.
+    :param journal: An optional :class:`BatchJournal` in which the status of
+        each processed file is recorded.
+    :param resume: If True, files listed as done in the ``journal`` are not
+        processed again.
+    """
+    name = processor.__class__.__name__
+
+    def previously_done(item):
+        if not resume or journal is None or not journal.is_done(name, item):
+            return False
+        item.reset_status()
+        item.status = 'done'
+        item.result = 'Processed in a previous run'
+        return True
+
+    def record(item, res):
+        if journal is not None:
+            if not isinstance(res, (str, pathlib.PurePath)):
+                res = None
+            journal.record(name, item, res)
+
+    if not num_workers:
+        processor.init_process()
+        for i, item in enumerate(source_files):
+            if stop is not None and stop():
+                return
+            if item.skip:
+                yield 'skipped', item
+                continue
+            if previously_done(item):
+                yield 'previously_done', item
+                continue
+
+            item.status = 'running'
+            yield 'running', item
+            record(item, processor.process_file(item, i))
+            yield 'processed', item
+
+        processor.finish_process()
+        return
+
+    # only submit a few files more than the workers, so that when stopped
+    # we only need to wait for the files currently being processed
+    items = iter(enumerate(source_files))
+    pending: Dict[Future, Tuple[int, SourceFile]] = {}
+    max_pending = 2 * num_workers
+    stopped = False
+
+    with ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_process_worker,
+            initargs=(processor, )) as executor:
+        while True:
+            while not stopped and len(pending) < max_pending:
+                if stop is not None and stop():
+                    stopped = True
+                    break
+
+                i, item = next(items, (None, None))
+                if item is None:
+                    break
+                if item.skip:
+                    yield 'skipped', item
+                    continue
+                if previously_done(item):
+                    yield 'previously_done', item
+                    continue
+
+                item.status = 'running'
+                pending[executor.submit(_run_process_worker, item)] = i, item
+                yield 'running', item
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, timeout=.25, return_when=FIRST_COMPLETED)
+            if not stopped and stop is not None and stop():
+                stopped = True
+            if stopped:
+                for future in list(pending):
+                    if future.cancel():
+                        _, item = pending.pop(future)
+                        item.reset_status()
+                        yield 'cancelled', item
+
+            for future in done:
+                i, item = pending.pop(future)
+                res = None
+                try:
+                    item.status, item.result, item.exception, res = \
+                        future.result()
+                except BaseException as e:
+                    # e.g. if the worker process died
+                    item.post_process(e)
+                else:
+                    if item.status == 'done':
+                        processor.add_result(item, res, i)
+                record(item, res)
+                yield 'processed', item
+
+    if not stopped:
+        processor.finish_process()
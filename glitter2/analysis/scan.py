@@ -0,0 +1,194 @@
+"""Source file scanning
+========================
+
+Finds the source files to be processed in batch by
+:mod:`glitter2.analysis.process`, by walking the source directory tree.
+
+The tree is walked in a single pass using :func:`os.scandir`, so directories
+and files are distinguished without an additional ``stat`` call per entry.
+Directories can be listed in parallel with a thread pool, which is much
+faster for network file systems where each listing has a high latency. The
+files are yielded as they are found so they can be shown before the scan is
+done.
+
+A :class:`SourceScanCache` can be used to remember the directory listings of
+the last scan, so that scanning the same directory again only lists the
+directories that changed since.
+
+E.g.::
+
+    cache = SourceScanCache()
+    for files in iter_source_files(
+            '/home/user/data', '*.h5;*.csv', num_threads=8, cache=cache):
+        for item in files:
+            print(item.filename, item.file_size)
+"""
+from typing import Dict, List, Optional, Callable, Generator, Tuple, Union
+import os
+import re
+import pathlib
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
+
+from glitter2.analysis.process import SourceFile
+
+__all__ = ('SourceScanCache', 'parse_match_patterns', 'iter_source_files')
+
+
+def parse_match_patterns(match_suffix: str) -> List[str]:
+    """Splits the ``;`` or ``,`` separated glob patterns into a list.
+
+    E.g. ``'*.h5; *.csv'`` becomes ``['*.h5', '*.csv']``.
+    """
+    patterns = [p.strip() for p in re.split('[;,]', match_suffix)]
+    return [p for p in patterns if p]
+
+
+class SourceScanCache:
+    """Caches the listing of each directory scanned by
+    :func:`iter_source_files`.
+
+    A directory's cached listing is used as long as the modification time of
+    the directory didn't change, which changes when files are added, removed,
+    or renamed in it. The files that match are always stat-ed again, because
+    their size and modification time can change without changing the
+    directory.
+    """
+
+    directories: Dict[str, Tuple[int, List[str], List[str]]] = {}
+    """Maps each directory to the modification time in ns of the directory
+    when it was listed, and the names of its files and sub-directories.
+    """
+
+    def __init__(self):
+        self.directories = {}
+
+    def clear(self):
+        self.directories = {}
+
+
+def _scan_directory(
+        path: str, patterns: List[str], cache: Optional[SourceScanCache]
+) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
+    """Lists the directory and returns the files that match any of the
+    patterns along with their stat, and the sub-directories.
+    """
+    try:
+        return _list_directory(path, patterns, cache)
+    except PermissionError:
+        # like glob, skip directories we cannot read
+        return [], []
+
+
+def _list_directory(
+        path: str, patterns: List[str], cache: Optional[SourceScanCache]
+) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
+    matched = []
+    cached = None
+    mtime_ns = None
+    if cache is not None:
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = cache.directories.get(path)
+        if cached is not None and cached[0] != mtime_ns:
+            cached = None
+
+    if cached is not None:
+        _, files, dirs = cached
+        for name in files:
+            if any(fnmatch(name, p) for p in patterns):
+                filename = os.path.join(path, name)
+                try:
+                    matched.append((filename, os.stat(filename)))
+                except FileNotFoundError:
+                    continue
+        return matched, [os.path.join(path, name) for name in dirs]
+
+    files = []
+    dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # don't follow symlinks to directories to prevent cycles
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+                if any(fnmatch(entry.name, p) for p in patterns):
+                    matched.append((entry.path, entry.stat()))
+
+    if cache is not None:
+        cache.directories[path] = mtime_ns, files, dirs
+    return matched, [os.path.join(path, name) for name in dirs]
+
+
+def iter_source_files(
+        source: Union[str, pathlib.Path], match_suffix: str = '*.h5',
+        num_threads: int = 0, stop: Optional[Callable[[], bool]] = None,
+        cache: Optional[SourceScanCache] = None,
+        exclude: Optional[pathlib.Path] = None
+) -> Generator[List[SourceFile], None, None]:
+    """Walks the ``source`` directory recursively and yields lists of the
+    :class:`~glitter2.analysis.process.SourceFile` of the files that match,
+    as they are found.
+
+    :param source: The directory to scan.
+    :param match_suffix: One or more glob patterns matched against the file
+        names, separated by ``;`` or ``,``. See :func:`parse_match_patterns`.
+    :param num_threads: The number of threads used to list directories in
+        parallel. If zero, directories are listed one at a time in the
+        current thread, in depth-first order. Otherwise, the order of the
+        files is not deterministic.
+    :param stop: An optional callable that returns True when the scan should
+        be stopped.
+    :param cache: An optional :class:`SourceScanCache` used to speed up
+        scanning the same directories again.
+    :param exclude: An optional file that is excluded even if it matches.
+    """
+    source = pathlib.Path(source)
+    root = str(source)
+    patterns = parse_match_patterns(match_suffix)
+
+    def get_files(matched):
+        return [
+            SourceFile(
+                filename=pathlib.Path(filename), source_root=source,
+                stat=stat)
+            for filename, stat in matched
+            if exclude is None or pathlib.Path(filename) != exclude]
+
+    if not num_threads:
+        stack = [root]
+        while stack:
+            if stop is not None and stop():
+                return
+
+            matched, dirs = _scan_directory(stack.pop(), patterns, cache)
+            stack.extend(reversed(dirs))
+            files = get_files(matched)
+            if files:
+                yield files
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending: Dict[Future, str] = {
+            executor.submit(_scan_directory, root, patterns, cache): root}
+        try:
+            while pending:
+                if stop is not None and stop():
+                    return
+
+                done, _ = wait(
+                    pending, timeout=.25, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    matched, dirs = future.result()
+                    for path in dirs:
+                        pending[executor.submit(
+                            _scan_directory, path, patterns, cache)] = path
+
+                    files = get_files(matched)
+                    if files:
+                        yield files
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,383 @@
+"""Headless batch processing
+=============================
+
+Command line tool that exports or imports Glitter2 data files in batch,
+without the Glitter2 app. It can run e.g. on servers without a display.
+The job is described by a YAML or JSON file and run with::
+
+    python -m glitter2.batch job.yaml
+
+The job keys are named like the :class:`~glitter2.analysis.export.
+ExportManager` config properties of the app's batch mode:
+
+* ``batch_mode``: One of ``'export_stats'``, ``'export_raw'``, or
+  ``'import'``.
+* ``batch_export_mode``: When importing, the source file type. One of
+  ``'legacy'``, ``'cleversys'``, or ``'csv'``.
+* ``source``: The directory searched (recursively) for the files to process,
+  or a single file.
+* ``source_match_suffix``: The glob pattern of the files to process in the
+  directory. Multiple patterns can be separated by ``;``. Defaults to
+  ``'*.h5'``.
+* ``source_scan_threads``: The number of threads used to scan the source
+  directory. Defaults to zero.
+* ``stats_export_path``: The Excel file to where the summary statistics are
+  exported, when exporting stats.
+* ``resume_stats_export``: Whether to resume a stats export that was
+  stopped before it finished. Defaults to False.
+* ``root_raw_data_export_path``: The directory where the raw data is
+  exported, when exporting raw data.
+* ``raw_dump_zone_collider``: Whether to export which zones each position is
+  in, when exporting raw data. Defaults to True.
+* ``raw_export_format``: The file format of the exported raw data, e.g.
+  ``'xlsx'`` or ``'h5'``. See :meth:`~glitter2.analysis.FileDataAnalysis.
+  export_raw_data`. Defaults to ``'xlsx'``.
+* ``generated_file_output_path``: The directory where the imported H5 files
+  are created, when importing.
+* ``import_append_if_file_exists``: Whether to add the imported data to H5
+  files that already exist. Defaults to False.
+* ``video_cache_path`` and ``video_cache_size``: The optional video cache
+  used when importing. See :class:`~glitter2.video.VideoDataCache`.
+* ``resume_from_journal``: Whether to skip the files that were already
+  processed in a previous run, as recorded in the output directory's
+  :class:`~glitter2.analysis.process.BatchJournal`. Defaults to True.
+* ``num_workers``: The number of worker processes used. Defaults to zero,
+  in which case files are processed one at a time.
+* ``stats``: When exporting stats, the computations, as described in
+  :func:`get_analysis_spec`.
+
+The progress is printed to stdout as JSON lines, one line per event, ending
+with a ``'summary'`` line. The exit code is 0 if all the files were processed
+successfully, 1 if some files failed, 2 if the job itself failed, and 3 if the
+job was interrupted with Ctrl-C.
+
+Kivy
+----
+
+The Glitter2 data and analysis modules use Kivy's utilities and zone shapes,
+so some Kivy modules are still imported when processing files. However, no
+window, app, or clock is created. They are imported only once the job is
+read and Kivy is configured to not parse the command line arguments, log to
+the console, or write its config and log files.
+"""
+from typing import Dict, List, Optional, Any
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import argparse
+import pathlib
+import traceback
+
+__all__ = (
+    'load_job', 'get_analysis_spec', 'get_processor', 'get_source_files',
+    'run_job', 'main')
+
+EXIT_SUCCESS = 0
+"""The exit code when all the files were processed successfully.
+"""
+
+EXIT_FILES_FAILED = 1
+"""The exit code when some files failed to be processed.
+"""
+
+EXIT_JOB_FAILED = 2
+"""The exit code when the job itself failed, e.g. if it's invalid.
+"""
+
+EXIT_INTERRUPTED = 3
+"""The exit code when the job was interrupted with Ctrl-C.
+"""
+
+
+def _configure_kivy():
+    """Configures Kivy so importing it doesn't take over the command line
+    arguments, print logs, or write its config and log files.
+    """
+    for name in (
+            'KIVY_NO_ARGS', 'KIVY_NO_CONSOLELOG', 'KIVY_NO_CONFIG',
+            'KIVY_NO_FILELOG'):
+        os.environ.setdefault(name, '1')
+
+
+def load_job(filename: str) -> Dict[str, Any]:
+    """Reads the job dict from a YAML or JSON file. Files ending with
+    ``.json`` are read as JSON, otherwise as YAML.
+    """
+    with open(filename, 'r', encoding='utf8') as fh:
+        if filename.lower().endswith('.json'):
+            job = json.load(fh)
+        else:
+            from ruamel.yaml import YAML
+            job = YAML(typ='safe').load(fh)
+
+    if not isinstance(job, dict):
+        raise ValueError(f'Job file "{filename}" must contain a mapping')
+    return job
+
+
+def _get_compute_method(name: str):
+    from glitter2.analysis import AnalysisFactory
+
+    try:
+        cls_name, method_name = name.split('.')
+    except ValueError:
+        raise ValueError(
+            f'Method "{name}" must be of the form "Class.compute_method"')
+
+    for cls in AnalysisFactory.analysis_classes:
+        if cls.__name__ == cls_name:
+            break
+    else:
+        raise ValueError(f'Unrecognized analysis class "{cls_name}"')
+
+    if not method_name.startswith('compute_'):
+        method_name = f'compute_{method_name}'
+    method = getattr(cls, method_name, None)
+    if method is None:
+        raise ValueError(f'Unrecognized method "{method_name}" of {cls_name}')
+    return cls, method
+
+
+def get_analysis_spec(stats: Dict[str, Any]):
+    """Creates the :class:`~glitter2.analysis.AnalysisSpec` from the job's
+    ``stats`` dict. E.g.:
+
+    .. code-block:: yaml
+
+        stats:
+          defaults:
+            PosAnalysisChannel:
+              zone_channel: A circle
+          new_channels:
+            - channel: A spiral
+              new_channel: in spiral
+              method: PosAnalysisChannel.compute_pos_in_any_zone
+              args:
+                zone_channels: [A circle]
+          computations:
+            - channels: [An event, in spiral]
+              method: EventAnalysisChannel.compute_event_count
+              compute_key: count
+
+    Methods are named by their analysis class and method name. The
+    ``compute_`` method prefix is optional. If ``channels`` is empty or
+    missing, the computation is applied to all the channels of the class's
+    type.
+    """
+    from glitter2.analysis import AnalysisSpec, AnalysisFactory
+
+    spec = AnalysisSpec()
+    classes = {cls.__name__: cls for cls in AnalysisFactory.analysis_classes}
+    for cls_name, values in (stats.get('defaults') or {}).items():
+        if cls_name not in classes:
+            raise ValueError(f'Unrecognized analysis class "{cls_name}"')
+        for name, value in values.items():
+            spec.add_arg_default(classes[cls_name], name, value)
+
+    for item in stats.get('new_channels') or []:
+        _, method = _get_compute_method(item['method'])
+        spec.add_new_channel_computation(
+            item['channel'], item['new_channel'], method,
+            **(item.get('args') or {}))
+
+    for item in stats.get('computations') or []:
+        _, method = _get_compute_method(item['method'])
+        spec.add_computation(
+            item.get('channels') or [], method,
+            compute_key=item.get('compute_key', ''),
+            **(item.get('args') or {}))
+
+    return spec
+
+
+def get_processor(job: Dict[str, Any]):
+    """Creates the :class:`~glitter2.analysis.process.FileProcessBase` that
+    processes the job's files.
+    """
+    from glitter2.video import VideoDataCache
+    from glitter2.analysis.process import SummeryStatsExporter, \
+        RawDataExporter, LegacyGlitterImporter, CleverSysImporter, \
+        CSVImporter
+
+    mode = job.get('batch_mode')
+    if mode == 'export_raw':
+        return RawDataExporter(
+            dump_zone_collider=job.get('raw_dump_zone_collider', True),
+            data_export_root=job.get('root_raw_data_export_path', ''),
+            export_format=job.get('raw_export_format', 'xlsx'))
+    if mode == 'export_stats':
+        return SummeryStatsExporter(
+            spec=get_analysis_spec(job.get('stats') or {}),
+            export_filename=job.get('stats_export_path', ''),
+            resume=job.get('resume_stats_export', False))
+    if mode != 'import':
+        raise ValueError(f'Unrecognized batch_mode "{mode}"')
+
+    video_cache = None
+    if job.get('video_cache_path'):
+        video_cache = VideoDataCache(
+            job['video_cache_path'],
+            max_size=int(job.get('video_cache_size', 256) * 1024 * 1024))
+
+    export_mode = job.get('batch_export_mode')
+    output_files_root = job.get('generated_file_output_path', '')
+    append = job.get('import_append_if_file_exists', False)
+    if export_mode == 'legacy':
+        return LegacyGlitterImporter(output_files_root=output_files_root)
+    if export_mode == 'cleversys':
+        return CleverSysImporter(
+            output_files_root=output_files_root,
+            import_append_if_file_exists=append, video_cache=video_cache)
+    if export_mode == 'csv':
+        return CSVImporter(
+            output_files_root=output_files_root,
+            import_append_if_file_exists=append, video_cache=video_cache)
+    raise ValueError(f'Unrecognized batch_export_mode "{export_mode}"')
+
+
+def get_source_files(
+        source: str, match_suffix: str = '*.h5', num_threads: int = 0
+) -> list:
+    """Returns the :class:`~glitter2.analysis.process.SourceFile` list of all
+    the files in the ``source`` directory (recursively) matching
+    ``match_suffix``, or of the ``source`` file if it's a file.
+
+    See :func:`~glitter2.analysis.scan.iter_source_files` for the
+    parameters.
+    """
+    from glitter2.analysis.process import SourceFile
+    from glitter2.analysis.scan import iter_source_files
+
+    source = pathlib.Path(source).expanduser().absolute()
+    if source.is_file():
+        return [SourceFile(filename=source, source_root=source.parent)]
+    if not source.is_dir():
+        raise ValueError(f'Source "{source}" does not exist')
+
+    contents = []
+    for files in iter_source_files(source, match_suffix, num_threads):
+        contents.extend(files)
+    return contents
+
+
+def _write_line(out, data: dict):
+    out.write(json.dumps(data) + '\n')
+    out.flush()
+
+
+def run_job(
+        job: Dict[str, Any], out=None, num_workers: Optional[int] = None
+) -> int:
+    """Runs the job and returns the exit code.
+
+    :param job: The job dict, e.g. as returned by :func:`load_job`.
+    :param out: The file-like object to where the JSON lines progress is
+        written. Defaults to stdout.
+    :param num_workers: If not None, overrides the job's ``num_workers``.
+    """
+    out = out or sys.stdout
+    _configure_kivy()
+    ts = time.perf_counter()
+    counts = {
+        'processed': 0, 'failed': 0, 'skipped': 0, 'cancelled': 0,
+        'previously_done': 0}
+    interrupted = []
+    journal = None
+
+    def stop():
+        return bool(interrupted)
+
+    def handle_interrupt(*largs):
+        interrupted.append(True)
+
+    try:
+        from glitter2.analysis.process import iter_process_files, \
+            BatchJournal
+        processor = get_processor(job)
+        source_files = get_source_files(
+            job.get('source', ''), job.get('source_match_suffix', '*.h5'),
+            job.get('source_scan_threads', 0))
+        if num_workers is None:
+            num_workers = job.get('num_workers', 0)
+
+        _write_line(
+            out, {'event': 'start', 'num_files': len(source_files),
+                  'total_size': sum(f.file_size for f in source_files)})
+
+        if processor.get_journal_filename():
+            journal = BatchJournal(processor.get_journal_filename())
+
+        # signals can only be handled in the main thread
+        old_handler = None
+        if threading.current_thread() is threading.main_thread():
+            old_handler = signal.signal(signal.SIGINT, handle_interrupt)
+        try:
+            for event, item in iter_process_files(
+                    processor, source_files, int(num_workers), stop,
+                    journal, job.get('resume_from_journal', True)):
+                line = {
+                    'event': event, 'filename': str(item.filename),
+                    'status': item.status}
+                if event == 'processed':
+                    if item.status == 'done':
+                        counts['processed'] += 1
+                    else:
+                        counts['failed'] += 1
+                        line['error'] = item.exception[0]
+                        line['traceback'] = item.exception[1]
+                elif event in ('skipped', 'cancelled', 'previously_done'):
+                    counts[event] += 1
+                _write_line(out, line)
+        finally:
+            if old_handler is not None:
+                signal.signal(signal.SIGINT, old_handler)
+            if journal is not None:
+                journal.close()
+    except Exception as e:
+        _write_line(out, {
+            'event': 'error', 'error': str(e),
+            'traceback': ''.join(traceback.format_exception(*sys.exc_info()))
+        })
+        code = EXIT_JOB_FAILED
+    else:
+        if interrupted:
+            code = EXIT_INTERRUPTED
+        elif counts['failed']:
+            code = EXIT_FILES_FAILED
+        else:
+            code = EXIT_SUCCESS
+
+    _write_line(out, {
+        'event': 'summary', **counts, 'elapsed': time.perf_counter() - ts,
+        'exit_code': code})
+    return code
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    """Runs the command line tool with the given arguments and returns the
+    exit code.
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m glitter2.batch',
+        description='Batch exports or imports Glitter2 data files.')
+    parser.add_argument(
+        'job', help='The YAML or JSON file describing the job.')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help="The number of worker processes. Overrides the job's "
+             "num_workers.")
+    parsed = parser.parse_args(args)
+
+    try:
+        job = load_job(parsed.job)
+    except Exception as e:
+        _write_line(sys.stdout, {'event': 'error', 'error': str(e)})
+        return EXIT_JOB_FAILED
+    return run_job(job, num_workers=parsed.workers)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
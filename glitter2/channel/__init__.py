@@ -4,7 +4,8 @@
 API for a channel controller as well as the channel types that the user can
 create. E.g. an event channel, a position based channel, etc.
 """
-from typing import Iterable, List, Dict, Iterator, Optional, Any, Union
+from typing import Iterable, List, Dict, Iterator, Optional, Any, Union, \
+    Tuple
 from itertools import cycle, chain
 import numpy as np
 from collections import defaultdict
@@ -598,6 +599,16 @@ class PosChannel(TemporalChannel):
 
     _current_point_back_graphics: Optional[Line] = None
 
+    _tail_window: Optional[Tuple[float, int, int, float]] = None
+    """The sliding window of the last displayed tail, if any.
+
+    It's a tuple of ``(interval_start, end, start, tail_start)``, where
+    ``interval_start`` is the first timestamp of the interval, ``end`` is the
+    index of the last timestamp in the tail, ``start`` is the index of the
+    first timestamp in the tail and ``tail_start`` is the time the tail
+    starts.
+    """
+
     def __init__(self, **kwargs):
         super(PosChannel, self).__init__(**kwargs)
         self.fbind('display_line', self._display_line_graphics)
@@ -695,12 +706,12 @@ class PosChannel(TemporalChannel):
         t = self.current_timestamp
         timestamps, data, i = self.data_channel.get_previous_timestamp_data(t)
         if timestamps is None:
+            self._tail_window = None
             line_end.points = line.points = []
             return
 
-        times = np.array(timestamps[:i + 1])
-        s = np.searchsorted(
-            times, t - self.channel_controller.pos_channels_time_tail)
+        s = self._get_tail_start_index(
+            timestamps, i, t - self.channel_controller.pos_channels_time_tail)
 
         points = np.array(data[s:i + 1, :])
         if not points.shape[0]:
@@ -723,6 +734,27 @@ class PosChannel(TemporalChannel):
         else:
             line_end.points = [points[-2], points[-1], x, y]
 
+    def _get_tail_start_index(
+            self, timestamps: np.ndarray, i: int, tail_start: float) -> int:
+        """Returns the index in ``timestamps`` of the first timestamp that is
+        at or after ``tail_start``, but not after ``i + 1``.
+
+        When playing sequentially, the window from the last frame is slid
+        forward so it takes constant time, instead of searching the interval.
+        """
+        window = self._tail_window
+        interval_start = timestamps[0] if len(timestamps) else None
+        if window is not None and window[0] == interval_start and \
+                0 <= i - window[1] <= 2 and tail_start >= window[3]:
+            s = window[2]
+            while s <= i and timestamps[s] < tail_start:
+                s += 1
+        else:
+            s = int(np.searchsorted(timestamps[:i + 1], tail_start))
+
+        self._tail_window = interval_start, i, s, tail_start
+        return s
+
     def update_current_point_graphics(self, *args):
         p = self._current_point_graphics
         circle = self._current_point_back_graphics
@@ -18,6 +18,8 @@ from kivy.properties import BooleanProperty, NumericProperty, StringProperty
 
 from more_kivy_app.app import app_error
 
+from glitter2.video import get_video_metadata, get_video_file_data
+
 __all__ = ('GlitterPlayer', )
 
 
@@ -300,13 +302,7 @@ class GlitterPlayer(EventDispatcher):
         """Returns the metadata from the given media player, adding any
         additional required metadata.
         """
-        metadata = ffplayer.get_metadata()
-        filename = os.path.abspath(os.path.expanduser(filename))
-        head, tail = os.path.split(filename)
-        metadata['filename_head'] = head
-        metadata['filename_tail'] = tail
-        metadata['file_size'] = os.stat(filename).st_size
-        return metadata
+        return get_video_metadata(ffplayer, filename)
 
     def callback_opening(self):
         """Handles the player callback (:attr:`_frame_trigger`) when the player
@@ -506,38 +502,9 @@ class GlitterPlayer(EventDispatcher):
             cls, filename: str, metadata_only: bool = False
     ) -> Tuple[List[float], dict]:
         """Returns the timestamps and metadata of the video file.
+
+        See :func:`~glitter2.video.get_video_file_data`, which this calls.
         """
-        filename = os.path.abspath(filename)
-        ff_opts = {
-            'sync': 'video', 'an': True, 'sn': True, 'paused': False, 'x': 4,
-            'y': 4, 'out_fmt': 'gray'}
-        ffplayer = MediaPlayer(filename, ff_opts=ff_opts)
-
-        # get metadata
-        while True:
-            src_vid_size = ffplayer.get_metadata().get('src_vid_size')
-            duration = ffplayer.get_metadata().get('duration')
-            src_fmt = ffplayer.get_metadata().get('src_pix_fmt')
-
-            # only get out of opening when we have the metadata
-            if duration and src_vid_size[0] and src_vid_size[1] and src_fmt:
-                metadata = cls._get_video_metadata(ffplayer, filename)
-                break
-
-        # read video frames
-        timestamps = []
-
-        if not metadata_only:
-            while True:
-                frame, val = ffplayer.get_frame()
-
-                assert val != 'paused'
-                if val == 'eof':
-                    break
-                if frame is None:
-                    time.sleep(.1)
-                    continue
-                timestamps.append(frame[1])
-
-        ffplayer.close_player()
-        return timestamps, metadata
+        timestamps, metadata = get_video_file_data(
+            filename, metadata_only=metadata_only)
+        return timestamps.tolist(), metadata
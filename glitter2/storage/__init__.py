@@ -54,8 +54,21 @@ Whenever we open a new file, the GUI must be cleared and old file closed.
      - ---
      - ---
      - Import the channels from the yaml file
+
+All changes are written to an autosave file, which is copied to the h5 file
+when saved. To open large files quickly, an existing h5 file is first opened
+read only, while it's copied to the autosave file in the background. The
+autosave file replaces it once the copy is done, before the first change is
+written. When saving, only the changes are written to the h5 file using
+:func:`~glitter2.storage.sync.sync_h5_file`, unless the file changed
+externally since.
+
+The autosave that is scheduled every :attr:`StorageController.backup_interval`
+seconds only copies the changes in the Kivy thread and then writes them to the
+file in a background thread. Until it's done, other file accesses wait for it
+(see :attr:`~glitter2.storage.data_file.DataFile.file_access_callback`).
 """
-from typing import Optional
+from typing import Optional, Dict, Tuple
 import nixio as nix
 from os.path import exists, basename, splitext, split, join, isdir, dirname, \
     abspath
@@ -65,6 +78,11 @@ from tempfile import NamedTemporaryFile
 from shutil import copy2
 from functools import partial
 from contextlib import contextmanager
+from threading import Thread, Event, current_thread
+from queue import Queue
+import time
+import sys
+import traceback
 import h5py
 
 from kivy.event import EventDispatcher
@@ -75,10 +93,11 @@ from kivy.clock import Clock
 from kivy.logger import Logger
 from kivy.lang import Builder
 
-from more_kivy_app.app import app_error
+from more_kivy_app.app import app_error, report_exception_in_app
 from more_kivy_app.utils import yaml_dumps, yaml_loads
 
 from glitter2.storage.data_file import DataFile, read_nix_prop
+from glitter2.storage.sync import sync_h5_file
 from glitter2.player import GlitterPlayer
 
 __all__ = ('StorageController', )
@@ -137,12 +156,88 @@ class StorageController(EventDispatcher):
 
     last_filename_summary = StringProperty('')
 
+    _working_copy_thread: Optional[Thread] = None
+    """The thread copying the opened file to the autosave file, if the copy
+    has not yet replaced the opened file. See :meth:`open_file`.
+    """
+
+    _working_copy_error: Optional[BaseException] = None
+    """The error raised while copying in :attr:`_working_copy_thread`, if
+    any.
+    """
+
+    _saved_file_stat: Optional[Tuple[int, int]] = None
+    """The ``(size, mtime_ns)`` of :attr:`filename` after it was last opened
+    or saved. If it changed by the next save, the file was changed externally
+    and it's replaced rather than only writing the changes.
+    """
+
+    _unsaved_data_arrays: Dict[str, int] = {}
+    """Data arrays of the autosave file that changed since the last save. See
+    :meth:`~glitter2.storage.data_file.DataFile.pop_modified_data_arrays`.
+    """
+
+    autosave_thread: Optional[Thread] = None
+    """The thread that writes the scheduled autosaves to the file.
+    """
+
+    _autosave_queue: Optional[Queue] = None
+    """Queue used to send the autosave data to :attr:`autosave_thread`.
+    """
+
+    _kivy_thread_queue: Optional[Queue] = None
+    """Queue used to send the autosave results back to the Kivy thread.
+    """
+
+    trigger_run_in_kivy = None
+    """Trigger that processes the messages in :attr:`_kivy_thread_queue` in
+    the Kivy thread.
+    """
+
+    _autosave_idle: Optional[Event] = None
+    """Set when :attr:`autosave_thread` is not writing to the file.
+    """
+
+    autosave_snapshot_time = NumericProperty(0)
+    """The time in seconds the last scheduled autosave took in the Kivy thread,
+    copying the changes to be written.
+    """
+
+    autosave_write_time = NumericProperty(0)
+    """The time in seconds the last scheduled autosave took in
+    :attr:`autosave_thread`, writing the changes to the file and flushing it
+    to disk.
+    """
+
+    autosave_wait_time = NumericProperty(0)
+    """The total time in seconds the Kivy thread waited for
+    :attr:`autosave_thread` to finish writing before accessing the file.
+    """
+
+    autosave_skipped_count = NumericProperty(0)
+    """The number of scheduled autosaves skipped because the previous one
+    was still being written. Their changes are written by the next one.
+    """
+
     def __init__(self, app, channel_controller, player, ruler, **kwargs):
         super(StorageController, self).__init__(**kwargs)
         self.app = app
         self.channel_controller = channel_controller
         self.player = player
         self.ruler = ruler
+        self._unsaved_data_arrays = {}
+
+        self._autosave_idle = Event()
+        self._autosave_idle.set()
+        self._autosave_queue = Queue()
+        self._kivy_thread_queue = Queue()
+        self.trigger_run_in_kivy = Clock.create_trigger(
+            self.process_queue_in_kivy_thread)
+        self.autosave_thread = Thread(
+            target=self.run_autosave_thread,
+            args=(self._kivy_thread_queue, self._autosave_queue))
+        self.autosave_thread.start()
+
         if (not os.environ.get('KIVY_DOC_INCLUDE', None) and
                 self.backup_interval):
             self.backup_event = Clock.schedule_interval(
@@ -269,7 +364,8 @@ class StorageController(EventDispatcher):
             self.backup_filename, nix.FileMode.Overwrite,
             compression=self.nix_compression)
         self.data_file = DataFile(
-            nix_file=self.nix_file, unsaved_callback=self.set_data_unsaved)
+            nix_file=self.nix_file, unsaved_callback=self.set_data_unsaved,
+            file_access_callback=self.wait_for_autosave)
         Logger.debug(
             'Glitter2: Created tempfile {}, with file "{}"'.
             format(self.backup_filename, self.filename))
@@ -333,17 +429,21 @@ class StorageController(EventDispatcher):
         self.backup_filename = temp.name
         temp.close()
 
-        copy2(filename, self.backup_filename)
+        # read from the file while it's copied, until something is written
+        self._start_working_copy(filename)
+        self._saved_file_stat = self._get_file_stat(filename)
+        self._unsaved_data_arrays = {}
 
-        self.nix_file = nix.File.open(
-            self.backup_filename, nix.FileMode.ReadWrite,
-            compression=self.nix_compression)
+        self.nix_file = nix.File.open(filename, nix.FileMode.ReadOnly)
         self.data_file = DataFile(
-            nix_file=self.nix_file, unsaved_callback=self.set_data_unsaved)
+            nix_file=self.nix_file, unsaved_callback=self.set_data_unsaved,
+            file_access_callback=self.wait_for_autosave)
         Logger.debug(
             'Ceed Controller (storage): Created tempfile {}, from existing '
             'file "{}"'.format(self.backup_filename, self.filename))
 
+        # upgrading a file writes to it, which first switches to the
+        # autosave file (see set_data_unsaved)
         self.data_file.upgrade_file()
         self.data_file.open_file()
         self.channel_controller.reset_new_file(
@@ -362,6 +462,8 @@ class StorageController(EventDispatcher):
             yield
             return
 
+        self._open_working_copy()
+        self.data_file.flush()
         self.nix_file.close()
         yield
         self.nix_file = nix.File.open(
@@ -373,13 +475,17 @@ class StorageController(EventDispatcher):
         """Closes without saving the data. But if data was unsaved, it leaves
         the backup file unchanged.
         """
+        # if the copy failed, the autosave file is incomplete
+        copy_failed = self._wait_working_copy() is not None
         if self.nix_file is not None:
+            self.data_file.flush()
             self.nix_file.close()
             self.nix_file = None
             self.data_file = None
 
         if (not self.has_unsaved and not self.config_changed or
-                force_remove_autosave) and self.backup_filename:
+                force_remove_autosave or copy_failed) and \
+                self.backup_filename:
             remove(self.backup_filename)
 
         Logger.debug(
@@ -388,6 +494,102 @@ class StorageController(EventDispatcher):
 
         self.filename = self.backup_filename = ''
         self.read_only_file = False
+        self._saved_file_stat = None
+        self._unsaved_data_arrays = {}
+
+    @staticmethod
+    def _get_file_stat(filename) -> Tuple[int, int]:
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _start_working_copy(self, filename):
+        """Starts copying the file to the autosave file in a thread.
+        """
+        self._working_copy_error = None
+
+        def copy_file():
+            try:
+                copy2(filename, self.backup_filename)
+            except BaseException as e:
+                self._working_copy_error = e
+
+        thread = self._working_copy_thread = Thread(
+            target=copy_file, daemon=True)
+        thread.start()
+
+    def _wait_working_copy(self) -> Optional[BaseException]:
+        """Waits until the thread started by :meth:`_start_working_copy` is
+        done, if it's running, and returns the error raised by the copy, if
+        any.
+        """
+        thread = self._working_copy_thread
+        if thread is None:
+            return None
+
+        self._working_copy_thread = None
+        thread.join()
+        error = self._working_copy_error
+        self._working_copy_error = None
+        return error
+
+    def _open_working_copy(self):
+        """If the file was opened read only while it was copied to the
+        autosave file, it waits for the copy and replaces the file with the
+        autosave file, so that it can be changed.
+        """
+        if self._working_copy_thread is None:
+            return
+
+        error = self._wait_working_copy()
+        if error is not None:
+            raise error
+
+        self.nix_file.close()
+        self.nix_file = nix.File.open(
+            self.backup_filename, nix.FileMode.ReadWrite,
+            compression=self.nix_compression)
+        self.data_file.reopen_file(self.nix_file)
+        Logger.debug(
+            'Glitter2: Switched to tempfile {}, from file "{}"'.format(
+                self.backup_filename, self.filename))
+
+    def _can_sync_file(self, filename) -> bool:
+        """Returns whether the autosave file can be saved to the file by only
+        writing the changes since the last save.
+        """
+        if not self.filename or not exists(filename) or \
+                abspath(filename) != abspath(self.filename):
+            return False
+
+        if self._get_file_stat(filename) != self._saved_file_stat:
+            return False
+
+        # deleted data leaves unused space in the file, so once the file grew
+        # too much we replace it to get rid of it
+        size = os.stat(self.backup_filename).st_size
+        return self._saved_file_stat[0] <= 2 * size + 1024 * 1024
+
+    def _save_to_file(self, filename):
+        """Saves the closed autosave file to the file.
+        """
+        unsaved = self._unsaved_data_arrays
+        for key, i in self.data_file.pop_modified_data_arrays().items():
+            unsaved[key] = min(i, unsaved.get(key, i))
+
+        if self._can_sync_file(filename):
+            try:
+                sync_h5_file(self.backup_filename, filename, unsaved)
+            except Exception as e:
+                Logger.warning(
+                    'Glitter2: Could not save only the changes to "{}", '
+                    'saving the whole file: {}'.format(filename, e))
+                copy2(self.backup_filename, filename)
+        else:
+            copy2(self.backup_filename, filename)
+
+        if self.filename and abspath(filename) == abspath(self.filename):
+            self._saved_file_stat = self._get_file_stat(filename)
+            self._unsaved_data_arrays = {}
 
     @app_error
     def import_file(self, filename, exclude_app_settings=False):
@@ -454,29 +656,170 @@ class StorageController(EventDispatcher):
         if not force and not self.has_unsaved and not self.config_changed:
             return
 
+        # store the channels' padding so the saved file has the data of all
+        # the timestamps
+        self.data_file.pad_all_channels_to_num_frames()
         self.write_changes_to_autosave()
         filename = filename or self.filename
         if filename:
             with self.cycle_file():
-                copy2(self.backup_filename, filename)
+                self._save_to_file(filename)
             self.has_unsaved = False
 
     def write_changes_to_autosave(self, *largs, scheduled=False):
-        """Writes unsaved changes to the current (autosave) file. """
+        """Writes unsaved changes to the current (autosave) file.
+
+        If ``scheduled``, the changes are copied and then written in
+        :attr:`autosave_thread`, otherwise they are written before returning.
+        """
         if not self.nix_file or scheduled and self.read_only_file:
             return
 
+        if not scheduled:
+            self.wait_for_autosave()
+            if self.config_changed:
+                self._write_config(self.data_file, *self._get_config())
+                self.config_changed = False
+
+            self.data_file.flush()
+            self._flush_nix_file(self.nix_file)
+            return
+
+        if not self._autosave_idle.is_set():
+            # don't let the changes queue up if writing is slow
+            self.autosave_skipped_count += 1
+            return
+
+        ts = time.perf_counter()
+        config = None
         if self.config_changed:
-            self.data_file.app_config_dict = self.app.get_app_config_data()
-            self.data_file.write_channels_config(
-                *self.channel_controller.get_channels_metadata())
-            self.data_file.set_pixels_per_meter(self.ruler.pixels_per_meter)
+            # mark it unsaved now, so the thread doesn't have to
+            self.set_data_unsaved()
+            config = self._get_config()
             self.config_changed = False
 
+        snapshot = self.data_file.get_flush_snapshot()
+        if config is None and not snapshot:
+            return
+
+        self._autosave_idle.clear()
+        self._autosave_queue.put(
+            ('autosave', (self.data_file, self.nix_file, config, snapshot)))
+        self.autosave_snapshot_time = time.perf_counter() - ts
+
+    def _get_config(self) -> tuple:
+        return (
+            self.app.get_app_config_data(),
+            self.channel_controller.get_channels_metadata(),
+            self.ruler.pixels_per_meter
+        )
+
+    @staticmethod
+    def _write_config(
+            data_file: DataFile, app_config, channels_config,
+            pixels_per_meter):
+        data_file.app_config_dict = app_config
+        data_file.write_channels_config(*channels_config)
+        data_file.set_pixels_per_meter(pixels_per_meter)
+
+    @staticmethod
+    def _flush_nix_file(nix_file: nix.File, sync=False):
         try:
-            self.nix_file.flush()
+            nix_file.flush()
         except AttributeError:
-            self.nix_file._h5file.flush()
+            nix_file._h5file.flush()
+
+        if sync:
+            # also make sure it's written to disk
+            try:
+                os.fsync(nix_file._h5file.id.get_vfd_handle())
+            except (AttributeError, OSError, ValueError):
+                pass
+
+    def wait_for_autosave(self):
+        """Waits until :attr:`autosave_thread` is done writing the last
+        scheduled autosave, if it's still writing.
+
+        It's called before the file is accessed in the Kivy thread.
+        """
+        if self._autosave_idle.is_set() or \
+                current_thread() is self.autosave_thread:
+            return
+
+        ts = time.perf_counter()
+        self._autosave_idle.wait()
+        self.autosave_wait_time += time.perf_counter() - ts
+
+    def run_autosave_thread(self, kivy_queue, read_queue):
+        """The function that runs in :attr:`autosave_thread` and writes the
+        changes to the file.
+        """
+        kivy_queue_put = kivy_queue.put
+        trigger = self.trigger_run_in_kivy
+        Logger.info('Glitter2: Starting autosave thread')
+
+        while True:
+            msg, value = read_queue.get(block=True)
+            if msg == 'eof':
+                Logger.info('Glitter2: Exiting autosave thread')
+                return
+
+            try:
+                ts = time.perf_counter()
+                data_file, nix_file, config, snapshot = value
+                if config is not None:
+                    self._write_config(data_file, *config)
+                data_file.write_flush_snapshot(snapshot)
+                self._flush_nix_file(nix_file, sync=True)
+
+                kivy_queue_put(
+                    ('setattr',
+                     (self, 'autosave_write_time', time.perf_counter() - ts)))
+            except BaseException as e:
+                # the snapshot has the items that were not written
+                kivy_queue_put(('restore_snapshot', (data_file, snapshot)))
+                kivy_queue_put(
+                    ('exception',
+                     (str(e),
+                      ''.join(traceback.format_exception(*sys.exc_info()))))
+                )
+            finally:
+                self._autosave_idle.set()
+                trigger()
+
+    def process_queue_in_kivy_thread(self, *largs):
+        """Method that is called in the kivy thread when
+        :attr:`trigger_run_in_kivy` is triggered. It reads messages from the
+        thread.
+        """
+        queue = self._kivy_thread_queue
+        while not queue.empty():
+            msg, value = queue.get(block=False)
+            if msg == 'exception':
+                e, exec_info = value
+                report_exception_in_app(e, exc_info=exec_info)
+            elif msg == 'restore_snapshot':
+                data_file, snapshot = value
+                # write it again with the next autosave, unless it was closed
+                if data_file is self.data_file:
+                    data_file.restore_flush_snapshot(snapshot)
+            elif msg == 'setattr':
+                obj, prop, val = value
+                setattr(obj, prop, val)
+            else:
+                assert False, f'Unknown message "{msg}", "{value}"'
+
+    def stop(self):
+        """Stops :attr:`autosave_thread`, after it finished writing.
+        """
+        if self.backup_event is not None:
+            self.backup_event.cancel()
+            self.backup_event = None
+        if self._autosave_queue is not None:
+            self._autosave_queue.put(('eof', None))
+        if self.autosave_thread is not None:
+            self.autosave_thread.join()
+            self.autosave_thread = None
 
     @app_error
     def write_yaml_config(
@@ -534,7 +877,14 @@ class StorageController(EventDispatcher):
                 self.update_last_filename('')
 
     def set_data_unsaved(self):
+        if current_thread() is self.autosave_thread:
+            # it was already marked when the autosave was started
+            return
+
         self.has_unsaved = True
+        # we must write to the autosave file, not to the opened file
+        if self._working_copy_thread is not None:
+            self._open_working_copy()
 
     @app_error
     def create_gui_channels(self, event_channels, pos_channels, zone_channels):
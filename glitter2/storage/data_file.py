@@ -5,16 +5,21 @@ Data channel methods, unless specified should not be called directly.
 """
 
 import numpy as np
+import json
+from copy import deepcopy
 from typing import List, Dict, Optional, Tuple, Callable, Set, Union, Any, Type
 import nixio as nix
 from nixio.exceptions.exceptions import InvalidFile
-from bisect import bisect_left
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from itertools import chain
 
 from more_kivy_app.utils import yaml_dumps, yaml_loads
 
 __all__ = (
     'DataFile', 'DataChannelBase', 'TemporalDataChannelBase',
-    'EventChannelData', 'PosChannelData', 'ZoneChannelData', 'read_nix_prop')
+    'EventChannelData', 'PosChannelData', 'ZoneChannelData', 'read_nix_prop',
+    'GrowableArray', 'SparseFrameData', 'TimestampIndex', 'MetadataSection')
 
 
 def read_nix_prop(prop):
@@ -33,6 +38,537 @@ def _unsaved_callback():
     pass
 
 
+def _file_access_callback():
+    pass
+
+
+def _coalesce_ranges(
+        ranges: List[List[int]], gap: int = 0) -> List[Tuple[int, int]]:
+    """Takes a list of half open ``[start, end)`` index ranges and returns
+    the sorted list of ranges, where any ranges that overlap or whose
+    distance is at most ``gap`` are merged into a single range.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def _runs_from_dense(data: np.ndarray) -> np.ndarray:
+    """Takes a 1-d array and returns a ``(M, 2)`` int64 array of the sorted
+    half open ``[start, end)`` index ranges where the array is non-zero.
+    """
+    active = np.zeros(len(data) + 2, dtype=np.int8)
+    active[1:-1] = np.asarray(data) != 0
+    edges = np.flatnonzero(np.diff(active))
+    return edges.astype(np.int64).reshape(-1, 2)
+
+
+def _dense_from_runs(runs: np.ndarray, size: int) -> np.ndarray:
+    """The inverse of :func:`_runs_from_dense`, returns a uint8 array of
+    length ``size`` that is 1 within the ``runs`` and zero elsewhere.
+    """
+    toggle = np.zeros(size + 1, dtype=np.int8)
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+    np.add.at(toggle, np.minimum(runs[:, 0], size), 1)
+    np.add.at(toggle, np.minimum(runs[:, 1], size), -1)
+    return (np.cumsum(toggle[:-1]) > 0).astype(np.uint8)
+
+
+class GrowableArray:
+    """A numpy array that can be efficiently appended to, item by item.
+
+    It over-allocates its internal buffer geometrically, so appending an item
+    is amortized constant time and doesn't re-allocate the array each time.
+    :attr:`array` returns a view of the valid items in the buffer.
+
+    E.g.::
+
+        >>> arr = GrowableArray(dtype=np.float64)
+        >>> arr.append(1.)
+        >>> arr.extend([2., 3.])
+        >>> arr.array
+        array([1., 2., 3.])
+    """
+
+    _buffer: np.ndarray = None
+
+    _size: int = 0
+
+    def __init__(
+            self, data: Optional[Union[np.ndarray, list]] = None,
+            dtype=np.float64, item_shape: Tuple[int, ...] = ()):
+        if data is None:
+            self._buffer = np.empty((16, ) + tuple(item_shape), dtype=dtype)
+            self._size = 0
+        else:
+            data = np.array(data, dtype=dtype)
+            if not len(data):
+                data = data.reshape((0, ) + tuple(item_shape))
+            self._buffer = data
+            self._size = len(data)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        return self._buffer[:self._size][item]
+
+    def __setitem__(self, key, value):
+        self._buffer[:self._size][key] = value
+
+    @property
+    def array(self) -> np.ndarray:
+        """A view of the valid data of the array. It is invalidated when the
+        array is appended to.
+        """
+        return self._buffer[:self._size]
+
+    def _reserve(self, size: int):
+        buffer = self._buffer
+        if size <= len(buffer):
+            return
+
+        new_size = max(size, 2 * len(buffer), 16)
+        new_buffer = np.empty(
+            (new_size, ) + buffer.shape[1:], dtype=buffer.dtype)
+        new_buffer[:self._size] = buffer[:self._size]
+        self._buffer = new_buffer
+
+    def append(self, item):
+        """Adds the item to the end of the array.
+        """
+        size = self._size
+        self._reserve(size + 1)
+        self._buffer[size] = item
+        self._size = size + 1
+
+    def extend(self, items: Union[np.ndarray, list]):
+        """Adds all the items to the end of the array.
+        """
+        items = np.asarray(items, dtype=self._buffer.dtype)
+        size = self._size
+        n = len(items)
+        self._reserve(size + n)
+        self._buffer[size:size + n] = items
+        self._size = size + n
+
+
+class SparseFrameData:
+    """Per-frame data of an interval that stores only the frames whose value
+    is not the default, as their sorted frame indices and values.
+
+    It has a length of :attr:`size` frames and indexing it like the dense
+    numpy array of all the frames returns the dense data, where frames not
+    stored have the :attr:`default` value. E.g.::
+
+        >>> data = SparseFrameData(np.array([-1., -1.]), size=4)
+        >>> data.set_value(2, (5., 6.))
+        >>> data[1:3, :]
+        array([[-1., -1.],
+               [ 5.,  6.]])
+        >>> np.asarray(data).shape
+        (4, 2)
+    """
+
+    default: np.ndarray = None
+    """The value of the frames that are not stored.
+    """
+
+    size: int = 0
+    """The number of frames, including the frames that are not stored.
+    """
+
+    _indices: GrowableArray = None
+
+    _values: GrowableArray = None
+
+    def __init__(
+            self, default: np.ndarray, size: int = 0,
+            indices: Optional[np.ndarray] = None,
+            values: Optional[np.ndarray] = None):
+        self.default = default = np.asarray(default)
+        self.size = size
+        self._indices = GrowableArray(indices, dtype=np.int64)
+        self._values = GrowableArray(
+            values, dtype=default.dtype, item_shape=default.shape)
+
+    @classmethod
+    def from_dense(
+            cls, data: np.ndarray, default: np.ndarray) -> 'SparseFrameData':
+        """Creates it from the dense data of all the frames.
+        """
+        data = np.asarray(data)
+        modified = (data != default).reshape(len(data), -1).any(axis=1)
+        indices = np.flatnonzero(modified)
+        return cls(default, len(data), indices, data[indices])
+
+    @classmethod
+    def from_array(
+            cls, array: np.ndarray, default: np.ndarray, size: int
+    ) -> 'SparseFrameData':
+        """Creates it from the array returned by :meth:`to_array`.
+        """
+        array = np.asarray(array).reshape(-1, 1 + np.asarray(default).size)
+        return cls(
+            default, size, array[:, 0].astype(np.int64),
+            array[:, 1:].reshape((-1, ) + np.shape(default)))
+
+    def to_array(self) -> np.ndarray:
+        """Returns a 2-d array whose rows are the index of each stored frame
+        followed by its flattened value.
+        """
+        values = self._values.array
+        return np.concatenate([
+            self._indices.array[:, None].astype(values.dtype),
+            values.reshape(len(values), -1)], axis=1)
+
+    @property
+    def indices(self) -> np.ndarray:
+        """The sorted indices of the stored frames.
+        """
+        return self._indices.array
+
+    @property
+    def values(self) -> np.ndarray:
+        """The values of the stored frames, corresponding to :attr:`indices`.
+        """
+        return self._values.array
+
+    def __len__(self):
+        return self.size
+
+    def __array__(self, dtype=None):
+        data = self.get_dense()
+        if dtype is not None:
+            return data.astype(dtype, copy=False)
+        return data
+
+    def __getitem__(self, item):
+        key, rest = (item[0], item[1:]) if isinstance(item, tuple) else \
+            (item, ())
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step < 0:
+                data = self.get_dense()[key]
+            else:
+                data = self.get_dense(start, max(start, stop))[::step]
+            rest = (slice(None), ) + rest
+        else:
+            data = self.get_value(key)
+        return data[rest] if rest else data
+
+    def _find(self, i: int) -> Tuple[int, bool]:
+        """Returns the index in :attr:`indices` where frame ``i`` is or
+        would be inserted, and whether it's stored.
+        """
+        indices = self._indices.array
+        k = int(np.searchsorted(indices, i))
+        return k, k < len(indices) and indices[k] == i
+
+    def get_dense(self, start: int = 0, end: Optional[int] = None
+                  ) -> np.ndarray:
+        """Returns the dense data of the frames in the half open
+        ``[start, end)`` range (defaulting to all the frames).
+        """
+        if end is None:
+            end = self.size
+        data = np.repeat(self.default[None, ...], end - start, axis=0)
+
+        indices = self._indices.array
+        s, e = np.searchsorted(indices, [start, end])
+        data[indices[s:e] - start] = self._values.array[s:e]
+        return data
+
+    def get_value(self, i: int) -> np.ndarray:
+        """Returns the value of frame ``i``.
+        """
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+
+        k, stored = self._find(i)
+        if stored:
+            return self._values[k].copy()
+        return self.default.copy()
+
+    def set_value(self, i: int, value):
+        """Sets the value of frame ``i``. If it's the :attr:`default`, the
+        frame is no longer stored.
+        """
+        value = np.asarray(value, dtype=self.default.dtype)
+        k, stored = self._find(i)
+        if np.array_equal(value, self.default):
+            if stored:
+                self._indices = GrowableArray(
+                    np.delete(self._indices.array, k), dtype=np.int64)
+                self._values = GrowableArray(
+                    np.delete(self._values.array, k, axis=0),
+                    dtype=self.default.dtype, item_shape=self.default.shape)
+        elif stored:
+            self._values[k] = value
+        elif k == len(self._indices):
+            # frames are mostly set sequentially, so this is the common case
+            self._indices.append(i)
+            self._values.append(value)
+        else:
+            self._indices = GrowableArray(
+                np.insert(self._indices.array, k, i), dtype=np.int64)
+            self._values = GrowableArray(
+                np.insert(self._values.array, k, value, axis=0),
+                dtype=self.default.dtype, item_shape=self.default.shape)
+
+        self.size = max(self.size, i + 1)
+
+    def extend(self, other: 'SparseFrameData'):
+        """Adds the frames of ``other`` after the frames of this instance.
+        """
+        self._indices.extend(other.indices + self.size)
+        self._values.extend(other.values)
+        self.size += other.size
+
+
+class TimestampIndex(Mapping):
+    """Compact mapping of timestamps to their ``(key, index)`` in
+    :attr:`DataFile.timestamps_arrays`, used for
+    :attr:`DataFile.timestamp_data_map`.
+
+    Rather than storing a dict item for each timestamp, the timestamps are
+    stored in a sorted float64 array, along with parallel int arrays of the
+    interval key and the offset in that interval. Lookups use
+    :func:`numpy.searchsorted`.
+
+    Newly added timestamps are first stored in a small dict and are only
+    merged into the arrays in bulk, once there are enough of them, so adding
+    a timestamp is amortized constant time.
+    """
+
+    merge_threshold = 4096
+    """The number of added timestamps to accumulate before merging them
+    into the arrays.
+    """
+
+    _times: np.ndarray = None
+
+    _keys: np.ndarray = None
+
+    _offsets: np.ndarray = None
+
+    _pending: Dict[float, Tuple[int, int]] = {}
+
+    def __init__(self):
+        self._times = np.empty(0, dtype=np.float64)
+        self._keys = np.empty(0, dtype=np.int32)
+        self._offsets = np.empty(0, dtype=np.int32)
+        self._pending = {}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[int, np.ndarray]) -> 'TimestampIndex':
+        """Creates the index from a dict mapping interval keys to the
+        array of timestamps in that interval.
+        """
+        index = cls()
+        arrays = [(key, np.asarray(arr)) for key, arr in arrays.items()]
+        if not arrays:
+            return index
+
+        times = np.concatenate(
+            [arr for _, arr in arrays]).astype(np.float64, copy=False)
+        keys = np.concatenate(
+            [np.full(len(arr), key, dtype=np.int32) for key, arr in arrays])
+        offsets = np.concatenate(
+            [np.arange(len(arr), dtype=np.int32) for _, arr in arrays])
+
+        order = np.argsort(times, kind='stable')
+        index._times = times[order]
+        index._keys = keys[order]
+        index._offsets = offsets[order]
+        return index
+
+    def _find(self, t: float) -> int:
+        """Returns the index of ``t`` in the arrays, or -1 if it's not in
+        the arrays.
+        """
+        times = self._times
+        i = int(np.searchsorted(times, t))
+        if i < len(times) and times[i] == t:
+            return i
+        return -1
+
+    def _merge_pending(self):
+        """Merges the pending timestamps into the arrays.
+        """
+        pending = self._pending
+        if not pending:
+            return
+
+        times = np.fromiter(
+            pending.keys(), dtype=np.float64, count=len(pending))
+        values = np.array(list(pending.values()), dtype=np.int32)
+        order = np.argsort(times)
+        times = times[order]
+        values = values[order]
+
+        pos = np.searchsorted(self._times, times)
+        self._times = np.insert(self._times, pos, times)
+        self._keys = np.insert(self._keys, pos, values[:, 0])
+        self._offsets = np.insert(self._offsets, pos, values[:, 1])
+        self._pending = {}
+
+    def __getitem__(self, t: float) -> Tuple[int, int]:
+        pending = self._pending
+        if t in pending:
+            return pending[t]
+
+        i = self._find(t)
+        if i == -1:
+            raise KeyError(t)
+        return int(self._keys[i]), int(self._offsets[i])
+
+    def __setitem__(self, t: float, value: Tuple[int, int]):
+        i = self._find(t)
+        if i != -1:
+            self._keys[i], self._offsets[i] = value
+            return
+
+        pending = self._pending
+        pending[t] = value
+        if len(pending) >= self.merge_threshold:
+            self._merge_pending()
+
+    def __contains__(self, t) -> bool:
+        return t in self._pending or self._find(t) != -1
+
+    def __len__(self):
+        return len(self._times) + len(self._pending)
+
+    def __iter__(self):
+        self._merge_pending()
+        return iter(self._times.tolist())
+
+    def relabel_key(self, old_key: int, new_key: int, offset: int):
+        """Changes the key of all the timestamps with key ``old_key`` to
+        ``new_key``, adding ``offset`` to their index.
+
+        Used when merging the interval ``old_key`` onto the end of interval
+        ``new_key``.
+        """
+        self._merge_pending()
+        mask = self._keys == old_key
+        self._keys[mask] = new_key
+        self._offsets[mask] += offset
+
+
+class MetadataSection:
+    """Cached access to the metadata stored in a NixIO section as a dict.
+
+    The section is read and decoded once and reads are then served from
+    memory. When updated, only the keys whose values changed are written.
+
+    By default, each key is stored YAML encoded as a separate property of the
+    section. If :attr:`compact` and the section is empty, the metadata is
+    instead stored as a single JSON encoded property named
+    :attr:`compact_name`, mapping the keys to the YAML encoded values. That
+    is much faster to read when there are many channels. An existing section
+    is always read and written using the format it was created with.
+    """
+
+    compact_name = '__metadata__'
+    """The name of the property that stores all the metadata, if it's stored
+    in the compact format.
+    """
+
+    section: nix.Section = None
+    """The NixIO section that stores the metadata.
+    """
+
+    compact: bool = False
+    """Whether to use the compact format if the section is empty. See
+    :class:`MetadataSection`.
+    """
+
+    _encoded: Optional[Dict[str, str]] = None
+    """The YAML encoded values of all the keys, or None if not yet read.
+    """
+
+    _values: Optional[Dict[str, Any]] = None
+    """The decoded values of all the keys, or None if not yet read.
+    """
+
+    _is_compact: bool = False
+    """Whether the section is stored in the compact format.
+    """
+
+    def __init__(self, section: nix.Section, compact: bool = False):
+        self.section = section
+        self.compact = compact
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the section was already read from the file.
+        """
+        return self._values is not None
+
+    def _load(self):
+        encoded = {
+            prop.name: read_nix_prop(prop) for prop in self.section.props}
+        if self.compact_name in encoded:
+            self._is_compact = True
+            encoded = json.loads(encoded[self.compact_name])
+        else:
+            self._is_compact = self.compact and not encoded
+
+        self._encoded = encoded
+        self._values = {k: yaml_loads(v) for k, v in encoded.items()}
+
+    def get_dict(self) -> dict:
+        """Returns a copy of the metadata as a dict.
+        """
+        if self._values is None:
+            self._load()
+        return deepcopy(self._values)
+
+    def __contains__(self, key: str) -> bool:
+        if self._values is None:
+            self._load()
+        return key in self._values
+
+    def update(self, data: dict):
+        """Updates the metadata with the items of ``data`` and writes the keys
+        whose values changed to the file.
+        """
+        if self._values is None:
+            self._load()
+
+        # replace rather than change the dicts, so they can be read from
+        # another thread meanwhile
+        encoded = dict(self._encoded)
+        values = dict(self._values)
+        changed = {}
+        for k, v in data.items():
+            value = yaml_dumps(v)
+            if encoded.get(k) != value:
+                changed[k] = encoded[k] = value
+                values[k] = yaml_loads(value)
+
+        if not changed:
+            return
+
+        section = self.section
+        if self._is_compact:
+            section[self.compact_name] = json.dumps(encoded)
+        else:
+            for k, value in changed.items():
+                section[k] = value
+        self._encoded = encoded
+        self._values = values
+
+
 class DataFile:
     """Data file interface to the NixIO file that stores the video file
     annotated data.
@@ -61,10 +597,34 @@ class DataFile:
     them, that's when we consider having seen all frames and
     :attr:`saw_all_timestamps` is automatically set to the True and
     :attr:`timestamps` becomes the singular timestamps array.
+
+    Timestamps and channel data are changed in memory and only written to the
+    NixIO file in bulk. So :meth:`flush` must be called before the NixIO file
+    is closed or copied.
+
+    Channels are not padded with the default value as timestamps are added.
+    Each channel data array has a logical length of the number of timestamps
+    in its interval (see :meth:`TemporalDataChannelBase.get_num_frames`), and
+    frames past the stored data have the default value. The padding is only
+    stored with :meth:`pad_all_channels_to_num_frames`, e.g. before the file
+    is saved, or when a channel's data is changed.
     """
 
     unsaved_callback: Callable = None
     """Callback that is called whenever the data file changes.
+
+    It is called before the NixIO file is changed, so the callback may e.g.
+    replace a read only file with a writable copy of it using
+    :meth:`reopen_file`.
+    """
+
+    file_access_callback: Callable = None
+    """Callback that is called before the NixIO file is read or written.
+
+    Changes that are only in memory, e.g. adding a timestamp or setting the
+    value of a channel at a timestamp, don't call it. It may be used to wait
+    until another thread that is writing to the file, e.g. with
+    :meth:`write_flush_snapshot`, is done.
     """
 
     nix_file: nix.File = None
@@ -80,6 +640,43 @@ class DataFile:
     """Stores the metadata of the video file.
     """
 
+    compact_metadata: bool = False
+    """Whether the app, video and channels metadata is stored in the compact
+    format of :class:`MetadataSection` when it's written for the first time.
+
+    It should be set before :meth:`init_new_file` or :meth:`open_file`. It's
+    more efficient when there are many channels, but the files cannot be read
+    by glitter versions that don't support it.
+    """
+
+    event_runs_storage: bool = False
+    """Whether event channels created from now on store their data in the
+    file as the runs of frames during which the event is active, rather than
+    a value for each frame. See :attr:`EventChannelData.runs_storage`.
+
+    Existing channels keep the layout they were created with. It's much
+    smaller for sparse events, but the files cannot be read by glitter
+    versions that don't support it.
+    """
+
+    pos_sparse_storage: bool = False
+    """Whether pos channels created from now on store in the file only the
+    frames whose position was set, rather than a value for each frame. See
+    :attr:`PosChannelData.sparse_storage`.
+
+    Existing channels keep the layout they were created with. It's much
+    smaller when the position is only set for some of the frames, but the
+    files cannot be read by glitter versions that don't support it.
+    """
+
+    _app_config_metadata: 'MetadataSection' = None
+    """Caches :attr:`app_config_section`.
+    """
+
+    _video_metadata: 'MetadataSection' = None
+    """Caches :attr:`video_metadata_section`.
+    """
+
     timestamps: nix.DataArray = None
     """The first timestamps data array containing the very first timestamps of
     the video file, created when the data file is created.
@@ -115,6 +712,39 @@ class DataFile:
     :attr:`timestamp_intervals_ordered_keys`.
     """
 
+    timestamps_buffers: Dict[int, GrowableArray] = {}
+    """In-memory copy of the timestamps in each of the arrays of
+    :attr:`timestamps_arrays`, with the same keys.
+
+    New timestamps are appended to these buffers as the video is played
+    and they are only written to the NixIO :attr:`timestamps_arrays` in bulk
+    with :meth:`flush`, which is automatically called when intervals are
+    merged, when the video is seeked, or when we see the last timestamp.
+    The file should otherwise be flushed before it is saved or closed.
+
+    Until then, :attr:`timestamps_arrays` may contain only a prefix of the
+    timestamps in the buffers, so when the file is open for writing the
+    timestamps should be read from here.
+    """
+
+    _timestamps_flushed: Dict[int, int] = {}
+    """Maps keys of :attr:`timestamps_buffers` to the number of timestamps
+    in the buffer already written to the corresponding array in
+    :attr:`timestamps_arrays`.
+    """
+
+    _modified_data_arrays: Dict[str, int] = {}
+    """Maps the ID of each NixIO data array written by :meth:`flush` since
+    the last call to :meth:`pop_modified_data_arrays` to the index of the
+    first item written.
+    """
+
+    _deleted_data_arrays: List[Tuple[str, str]] = []
+    """The ``(block name, data array name)`` of the NixIO timestamps and
+    channel data arrays of intervals that were merged into another interval,
+    and that are deleted from the file with the next :meth:`flush`.
+    """
+
     timestamp_intervals_start: List[float] = []
     """List of :attr:`timestamps_arrays` start interval timestamps sorted by
     value.
@@ -129,15 +759,22 @@ class DataFile:
     """The keys of the timestamp arrays form :attr:`timestamps_arrays`
     sorted temporally such that the first timestamp in each array
     corresponding to the key is strictly increasing.
+
+    It and :attr:`timestamp_intervals_start` and
+    :attr:`timestamp_intervals_end` are computed when the file is opened and
+    are then updated in place as intervals are added or merged, using bisect
+    to find the position of an interval.
     """
 
-    timestamp_data_map: Dict[float, Tuple[int, int]] = {}
+    timestamp_data_map: TimestampIndex = None
     """Maps timestamps to their ``(key, index)`` in :attr:`timestamps_arrays`.
 
     For each known timestamp, it maps the timestamp to ``(key, index)``,
     where `key`` is the key in :attr:`timestamps_arrays` and ``index`` is the
     index in that array. Such that ``k, i = timestamp_data_map[t];
     timestamps_arrays[k][i] == t``.
+
+    It is a :class:`TimestampIndex`, which behaves like a dict.
     """
 
     event_channels: Dict[int, 'EventChannelData'] = {}
@@ -207,14 +844,21 @@ class DataFile:
     :meth:`create_channel`.
     """
 
-    def __init__(self, nix_file: nix.File, unsaved_callback=_unsaved_callback):
+    def __init__(
+            self, nix_file: nix.File, unsaved_callback=_unsaved_callback,
+            file_access_callback=_file_access_callback):
         self.nix_file = nix_file
         self.unsaved_callback = unsaved_callback
+        self.file_access_callback = file_access_callback
         self.event_channels = {}
         self.pos_channels = {}
         self.zone_channels = {}
         self.timestamps_arrays = {}
-        self.timestamp_data_map = {}
+        self.timestamps_buffers = {}
+        self._timestamps_flushed = {}
+        self._modified_data_arrays = {}
+        self._deleted_data_arrays = []
+        self.timestamp_data_map = TimestampIndex()
         self.timestamp_intervals_start = []
         self.timestamp_intervals_end = []
         self.timestamp_intervals_ordered_keys = []
@@ -244,6 +888,7 @@ class DataFile:
         f = self.nix_file
 
         self.unsaved_callback()
+        self.file_access_callback()
 
         f.create_section('app_config', 'configuration')
 
@@ -280,10 +925,15 @@ class DataFile:
             data_file.upgrade_file()
             data_file.open_file()
         """
+        self.file_access_callback()
         self.app_config_section = self.nix_file.sections['app_config']
+        self._app_config_metadata = MetadataSection(
+            self.app_config_section, compact=self.compact_metadata)
 
         data_config = self.nix_file.sections['data_config']
         self.video_metadata_section = data_config.sections['video_metadata']
+        self._video_metadata = MetadataSection(
+            self.video_metadata_section, compact=self.compact_metadata)
 
         self.saw_all_timestamps = yaml_loads(data_config['saw_all_timestamps'])
         self._saw_first_timestamp = yaml_loads(
@@ -300,20 +950,27 @@ class DataFile:
         self._last_timestamps_n = None
         self._last_timestamps_ordered_index = None
 
-        self.unsaved_callback()
-
     def reopen_file(self, nix_file: nix.File):
         """Repopulates the data links with the provided file.
 
         Used to reopen a nix file that has been closed after
         :class:`DataFile` is initialized if no changes occurred to the file.
+        If :meth:`open_file` was not called yet, e.g. if the file was
+        reopened while it's upgraded with :meth:`upgrade_file`, only the
+        file is replaced.
         """
+        self.file_access_callback()
         self.nix_file = nix_file
+        if self._app_config_metadata is None:
+            # open_file was not called yet, it'll read everything
+            return
 
         self.app_config_section = self.nix_file.sections['app_config']
+        self._app_config_metadata.section = self.app_config_section
 
         data_config = self.nix_file.sections['data_config']
         self.video_metadata_section = data_config.sections['video_metadata']
+        self._video_metadata.section = self.video_metadata_section
 
         self._read_timestamps_from_file(reopen=True)
 
@@ -342,17 +999,22 @@ class DataFile:
             # no need to re-read the data, it didn't change
             return
 
-        data_map = self.timestamp_data_map = {}
-        for i, timestamps in timestamps_arrays.items():
-            for t_index, val in enumerate(np.asarray(timestamps)):
-                data_map[val] = i, t_index
+        buffers = self.timestamps_buffers = {
+            i: GrowableArray(np.asarray(timestamps), dtype=np.float64)
+            for i, timestamps in timestamps_arrays.items()
+        }
+        self._timestamps_flushed = {i: len(buf) for i, buf in buffers.items()}
+
+        self.timestamp_data_map = TimestampIndex.from_arrays(
+            {i: timestamps.array for i, timestamps in buffers.items()})
 
         self._populate_timestamp_intervals()
 
     def _populate_timestamp_intervals(self):
-        """Computes the timestamp interval start/end points and order.
+        """Computes the timestamp interval start/end points and order from
+        all the intervals.
         """
-        timestamps = self.timestamps_arrays
+        timestamps = self.timestamps_buffers
         items = sorted(
             ((key, arr) for key, arr in timestamps.items()
              if len(arr)), key=lambda item: item[1][0]
@@ -362,6 +1024,33 @@ class DataFile:
         self.timestamp_intervals_start = [timestamps[i][0] for i in keys]
         self.timestamp_intervals_end = [timestamps[i][-1] for i in keys]
 
+    def _insert_timestamp_interval(self, key: int, t: float) -> int:
+        """Adds the newly created interval ``key``, whose first timestamp is
+        ``t``, to the ordered intervals.
+
+        Returns its index in :attr:`timestamp_intervals_ordered_keys`.
+        """
+        i = bisect_left(self.timestamp_intervals_start, t)
+        self.timestamp_intervals_start.insert(i, t)
+        self.timestamp_intervals_end.insert(i, t)
+        self.timestamp_intervals_ordered_keys.insert(i, key)
+        return i
+
+    def _get_timestamp_interval_index(self, t: float) -> int:
+        """Returns the index in :attr:`timestamp_intervals_ordered_keys` of the
+        interval containing the known timestamp ``t``.
+        """
+        return bisect_right(self.timestamp_intervals_start, t) - 1
+
+    def _merge_timestamp_intervals(self, i: int):
+        """Merges the interval following the interval at index ``i`` of
+        :attr:`timestamp_intervals_ordered_keys` into it.
+        """
+        self.timestamp_intervals_end[i] = self.timestamp_intervals_end[i + 1]
+        del self.timestamp_intervals_start[i + 1]
+        del self.timestamp_intervals_end[i + 1]
+        del self.timestamp_intervals_ordered_keys[i + 1]
+
     def set_file_data(
             self, video_file_metadata: Dict, saw_all_timestamps: bool,
             timestamps: List[Union[np.ndarray, List[float]]],
@@ -411,16 +1100,17 @@ class DataFile:
         if saw_all_timestamps:
             self._mark_saw_all_timestamps()
 
-        timestamps_arrays = self.timestamps_arrays
+        timestamps_buffers = self.timestamps_buffers
         idx_map = {}
         for idx, array in enumerate(timestamps):
             array = np.asarray(array)
             if not idx:
-                timestamps_arrays[0].append(array)
+                timestamps_buffers[0].extend(array)
                 idx_map[idx] = 0
             else:
                 idx_map[idx] = i = self._create_timestamps_channels_array()
-                timestamps_arrays[i].append(array)
+                timestamps_buffers[i].extend(array)
+        self._populate_timestamp_intervals()
 
         for event_type, channels in [
                 ('event', event_channels), ('pos', pos_channels)]:
@@ -428,13 +1118,14 @@ class DataFile:
                 channel = self.create_channel(event_type)
                 channel.channel_config_dict = metadata
                 for idx, array in enumerate(arrays):
-                    nix_array = channel.data_arrays[idx_map[idx]]
-                    nix_array[:] = np.asarray(array)
+                    channel.set_data_array_values(
+                        idx_map[idx], np.asarray(array))
 
         for metadata in zone_channels:
             channel = self.create_channel('zone')
             channel.channel_config_dict = metadata
 
+        self.flush()
         self.unsaved_callback()
 
     def _create_channels_from_file(self):
@@ -470,8 +1161,12 @@ class DataFile:
 
         :meth:`open_file` should be called after this.
         """
-        self.unsaved_callback()
+        sec = self.nix_file.sections['data_config']
+        if 'pixels_per_meter' in sec and 'channel_count' in sec:
+            return
 
+        self.unsaved_callback()
+        self.file_access_callback()
         sec = self.nix_file.sections['data_config']
         if 'pixels_per_meter' not in sec:
             sec['pixels_per_meter'] = yaml_dumps(0.)
@@ -489,7 +1184,152 @@ class DataFile:
     def has_content(self):
         """Returns whether any video timestamps has yet been added to the file.
         """
-        return bool(len(self.timestamps))
+        return bool(len(self.timestamps_buffers[0]))
+
+    def flush(self):
+        """Writes all the timestamps buffered in :attr:`timestamps_buffers`
+        that have not yet been written to the NixIO :attr:`timestamps_arrays`
+        as well as any channel data changed in memory (see
+        :meth:`TemporalDataChannelBase.flush`).
+
+        It should be called before the file is saved or closed. If writing
+        fails, the data that was not written is written with the next flush.
+        """
+        self.file_access_callback()
+        snapshot = self.get_flush_snapshot()
+        try:
+            self.write_flush_snapshot(snapshot)
+        except BaseException:
+            self.restore_flush_snapshot(snapshot)
+            raise
+
+    def get_flush_snapshot(
+            self) -> List[Tuple[nix.DataArray, int, np.ndarray, bool]]:
+        """Returns a copy of all the data that :meth:`flush` would write to
+        the file and marks it as written, without accessing the file.
+
+        The snapshot can then be written with :meth:`write_flush_snapshot`,
+        e.g. from another thread, but it must be written before the file is
+        accessed again otherwise (see :attr:`file_access_callback`).
+
+        Each item is a 4-tuple of the NixIO data array, the index in the array
+        where to write, the data, and whether the data is appended to the
+        array. If the last item is None instead, the data replaces all the
+        data of the array and the index is zero. If the data is also None,
+        the first two items are the names of a NixIO block and of its data
+        array to be deleted.
+        """
+        snapshot = [
+            (block, name, None, None)
+            for block, name in self._deleted_data_arrays]
+        self._deleted_data_arrays = []
+
+        flushed = self._timestamps_flushed
+        timestamps_arrays = self.timestamps_arrays
+        for key, buffer in self.timestamps_buffers.items():
+            n = flushed[key]
+            if n == len(buffer):
+                continue
+
+            snapshot.append(
+                (timestamps_arrays[key], n, buffer[n:].copy(), True))
+            flushed[key] = len(buffer)
+
+        for chan in self.event_channels.values():
+            snapshot.extend(chan.get_flush_snapshot())
+        for chan in self.pos_channels.values():
+            snapshot.extend(chan.get_flush_snapshot())
+        return snapshot
+
+    def write_flush_snapshot(
+            self, snapshot: List[Tuple[nix.DataArray, int, np.ndarray, bool]]
+    ):
+        """Writes the data returned by :meth:`get_flush_snapshot` to the file.
+
+        The items are removed from ``snapshot`` as they are written. So if it
+        raises an error, ``snapshot`` contains the items that were not
+        written, which should be given to :meth:`restore_flush_snapshot`.
+        """
+        written = 0
+        try:
+            for data_array, start, data, append in snapshot:
+                if data is None:
+                    # data_array and start are the names of the block and
+                    # the array
+                    del self.nix_file.blocks[data_array].data_arrays[start]
+                    written += 1
+                    continue
+
+                if append:
+                    # write at the index, rather than append, so that writing
+                    # it again after a failure doesn't duplicate it
+                    data_array.data_extent = \
+                        (start + len(data), ) + data.shape[1:]
+                    data_array[start:start + len(data)] = data
+                elif append is None:
+                    data_array.data_extent = data.shape
+                    if len(data):
+                        data_array[:len(data)] = data
+                else:
+                    data_array[start:start + len(data)] = data
+                self._mark_data_array_modified(data_array, start)
+                written += 1
+        finally:
+            del snapshot[:written]
+
+    def restore_flush_snapshot(
+            self, snapshot: List[Tuple[nix.DataArray, int, np.ndarray, bool]]
+    ):
+        """Marks the data of the snapshot items, returned by
+        :meth:`get_flush_snapshot`, as not yet written so that it's written
+        with the next :meth:`flush`. It's used when writing the snapshot with
+        :meth:`write_flush_snapshot` failed.
+        """
+        owners = {
+            id(arr): (None, key) for key, arr in self.timestamps_arrays.items()
+        }
+        for chan in chain(
+                self.event_channels.values(), self.pos_channels.values()):
+            for key, arr in chan.data_arrays.items():
+                owners[id(arr)] = chan, key
+
+        flushed = self._timestamps_flushed
+        for data_array, start, data, append in snapshot:
+            if data is None:
+                self._deleted_data_arrays.append((data_array, start))
+                continue
+
+            if id(data_array) not in owners:
+                # it was deleted since
+                continue
+
+            chan, key = owners[id(data_array)]
+            if chan is None:
+                flushed[key] = min(flushed[key], start)
+            elif append:
+                chan._data_flushed[key] = min(chan._data_flushed[key], start)
+            else:
+                chan._mark_dirty(key, start, start + len(data))
+
+    def _mark_data_array_modified(self, data_array: nix.DataArray, start: int):
+        """Records that the items of the NixIO data array starting at index
+        ``start`` were written to the file.
+        """
+        modified = self._modified_data_arrays
+        key = data_array.id
+        modified[key] = min(start, modified.get(key, start))
+
+    def pop_modified_data_arrays(self) -> Dict[str, int]:
+        """Returns a dict mapping the ID of each NixIO data array written to
+        the file by :meth:`flush`, since the last call to this method, to the
+        index of the first item written. It's used to save only the changed
+        data (see :func:`~glitter2.storage.sync.sync_h5_file`).
+
+        Data arrays created or deleted are not included.
+        """
+        modified = self._modified_data_arrays
+        self._modified_data_arrays = {}
+        return modified
 
     @staticmethod
     def get_file_glitter2_version(filename) -> Optional[str]:
@@ -517,11 +1357,7 @@ class DataFile:
 
         try:
             config = f.sections['data_config'].sections['video_metadata']
-            data = {}
-            for prop in config.props:
-                data[prop.name] = yaml_loads(read_nix_prop(prop))
-
-            return data
+            return MetadataSection(config).get_dict()
         finally:
             f.close()
 
@@ -533,41 +1369,45 @@ class DataFile:
         This is the metadata from
         :meth:`~glitter2.player.GlitterPlayer.get_file_data`.
 
-        .. warning::
+        .. note::
 
-            This property reads/writes to the file when accessed.
+            The metadata is read from the file once and then cached. When set,
+            only the keys whose values changed are written to the file.
         """
-        config = self.video_metadata_section
-        data = {}
-        for prop in config.props:
-            data[prop.name] = yaml_loads(read_nix_prop(prop))
-
-        return data
+        if not self._video_metadata.loaded:
+            self.file_access_callback()
+        return self._video_metadata.get_dict()
 
     @video_metadata_dict.setter
     def video_metadata_dict(self, metadata: dict):
         self.unsaved_callback()
-        config = self.video_metadata_section
-        for k, v in metadata.items():
-            config[k] = yaml_dumps(v)
+        self.file_access_callback()
+        self._video_metadata.update(metadata)
 
     def set_default_video_metadata(self, metadata: dict):
         """Sets the video file metadata, but only for the metadata that has
         not yet been set.
         """
+        video_metadata = self._video_metadata
+        if not video_metadata.loaded:
+            self.file_access_callback()
+        missing = {
+            k: v for k, v in metadata.items() if k not in video_metadata}
+        if not missing:
+            return
+
         self.unsaved_callback()
-        config = self.video_metadata_section
-        for k, v in metadata.items():
-            if k not in config:
-                config[k] = yaml_dumps(v)
+        self.file_access_callback()
+        video_metadata.update(missing)
 
     def set_pixels_per_meter(self, value: float):
         """Sets the pixels per meter of the video file.
         """
+        self.unsaved_callback()
+        self.file_access_callback()
         self.nix_file.sections['data_config']['pixels_per_meter'] = \
             yaml_dumps(value)
         self.pixels_per_meter = value
-        self.unsaved_callback()
 
     @property
     def app_config_dict(self) -> dict:
@@ -577,23 +1417,22 @@ class DataFile:
         config. The app config can be generated most simply from
         :meth:`~glitter2.main.Glitter2App.get_app_config_data`.
 
-        .. warning::
+        .. note::
 
-            This property reads/writes to the file when accessed.
+            The config is read from the file once and then cached. When set,
+            only the keys whose values changed are written to the file.
         """
-        data = {}
-        for prop in self.app_config_section.props:
-            data[prop.name] = yaml_loads(read_nix_prop(prop))
-        return data
+        if not self._app_config_metadata.loaded:
+            self.file_access_callback()
+        return self._app_config_metadata.get_dict()
 
     @app_config_dict.setter
     def app_config_dict(self, data: dict):
         """Writes the application configuration into the file.
         """
         self.unsaved_callback()
-        config = self.app_config_section
-        for k, v in data.items():
-            config[k] = yaml_dumps(v)
+        self.file_access_callback()
+        self._app_config_metadata.update(data)
 
     def write_channels_config(
             self, event_channels: Dict[int, dict] = None,
@@ -606,6 +1445,7 @@ class DataFile:
         the channel's new metadata.
         """
         self.unsaved_callback()
+        self.file_access_callback()
         if event_channels:
             event_channels_ = self.event_channels
             for i, data in event_channels.items():
@@ -651,6 +1491,7 @@ class DataFile:
             created.
         """
         self.unsaved_callback()
+        self.file_access_callback()
         config = self.nix_file.sections['data_config']
         count = yaml_loads(read_nix_prop(config.props['channel_count']))
         config['channel_count'] = yaml_dumps(count + 1)
@@ -661,6 +1502,7 @@ class DataFile:
         be created.
         """
         self.unsaved_callback()
+        self.file_access_callback()
         config = self.nix_file.sections['data_config']
         count = yaml_loads(config['timestamps_arrays_counter'])
         config['timestamps_arrays_counter'] = yaml_dumps(count + 1)
@@ -679,6 +1521,7 @@ class DataFile:
         items = getattr(self, f'{channel_type}_channels')
 
         self.unsaved_callback()
+        self.file_access_callback()
         n = self._increment_channel_count()
         name = '{}_channel_{}'.format(channel_type, n)
         block = self.nix_file.create_block(name, 'channel')
@@ -718,6 +1561,7 @@ class DataFile:
         video.
         """
         self.unsaved_callback()
+        self.file_access_callback()
 
         self.saw_all_timestamps = True
         self._saw_first_timestamp = True
@@ -737,7 +1581,6 @@ class DataFile:
         if self.saw_all_timestamps:
             return
 
-        self.pad_all_channels_to_num_frames_interval()
         # indicate that we seeked
         self._last_timestamps_n = None
         self._last_timestamps_ordered_index = None
@@ -752,6 +1595,7 @@ class DataFile:
 
         self._saw_first_timestamp = True
         self.unsaved_callback()
+        self.file_access_callback()
         self.nix_file.sections['data_config']['saw_first_timestamp'] = \
             yaml_dumps(True)
 
@@ -767,10 +1611,11 @@ class DataFile:
 
         self._saw_last_timestamp = True
         self.unsaved_callback()
+        self.file_access_callback()
         self.nix_file.sections['data_config']['saw_last_timestamp'] = \
             yaml_dumps(True)
 
-        self.pad_all_channels_to_num_frames_interval()
+        self.flush()
 
         if self._saw_first_timestamp and len(self.timestamps_arrays) == 1:
             self._mark_saw_all_timestamps()
@@ -780,33 +1625,41 @@ class DataFile:
         """Merges the timestamps arrays of the two time intervals, as well
         as the corresponding data arrays for all the channels.
 
+        Only the in-memory buffers are merged and the NixIO file is not
+        accessed. With the next :meth:`flush`, the data of the second
+        interval is appended to the NixIO arrays of the first and the arrays
+        of the second interval are deleted (see :attr:`_deleted_data_arrays`).
+
         Returns the ID of the data array that contains the merged data.
         """
-        timestamps_arrays = self.timestamps_arrays
-        timestamp_data_map = self.timestamp_data_map
-        arr1 = timestamps_arrays[arr_num1]
-        arr2 = timestamps_arrays[arr_num2]
-
-        if arr2.name == 'timestamps':
+        if not arr_num2:
             # currently the first timestamps array must start at the first ts
             # so we cannot append that array to any other array
             raise NotImplementedError
 
         self.unsaved_callback()
-        self.pad_all_channels_to_num_frames_interval(arr_num1)
-
-        start_index = len(arr1)
-        arr1.append(arr2)
-        for i, t in enumerate(np.asarray(arr2), start_index):
-            timestamp_data_map[t] = arr_num1, i
-        del self.nix_file.blocks['timestamps'].data_arrays[arr2.name]
-        del timestamps_arrays[arr_num2]
+        timestamps_arrays = self.timestamps_arrays
+        timestamps_buffers = self.timestamps_buffers
+        timestamp_data_map = self.timestamp_data_map
+        arr2 = timestamps_arrays[arr_num2]
+        buffer1 = timestamps_buffers[arr_num1]
+        buffer2 = timestamps_buffers[arr_num2]
 
+        # merge the channels first, while they can still get the number of
+        # frames of the first array to pad it
         for chan in self.event_channels.values():
             chan.merge_arrays(arr_num1, arr_num2)
         for chan in self.pos_channels.values():
             chan.merge_arrays(arr_num1, arr_num2)
 
+        # the buffer past what was flushed is appended to the first array
+        timestamp_data_map.relabel_key(arr_num2, arr_num1, len(buffer1))
+        buffer1.extend(buffer2.array)
+        self._deleted_data_arrays.append(('timestamps', arr2.name))
+        del timestamps_arrays[arr_num2]
+        del timestamps_buffers[arr_num2]
+        del self._timestamps_flushed[arr_num2]
+
         return arr_num1
 
     def _create_timestamps_channels_array(self) -> int:
@@ -817,12 +1670,15 @@ class DataFile:
         :attr:`timestamps_arrays`.
         """
         self.unsaved_callback()
+        self.file_access_callback()
         n = self._increment_timestamps_arrays_counter()
 
         block = self.nix_file.blocks['timestamps']
         self.timestamps_arrays[n] = block.create_data_array(
             'timestamps_{}'.format(n), 'timestamps', dtype=np.float64,
             data=[])
+        self.timestamps_buffers[n] = GrowableArray(dtype=np.float64)
+        self._timestamps_flushed[n] = 0
 
         for chan in self.event_channels.values():
             chan.create_data_array(n)
@@ -830,46 +1686,19 @@ class DataFile:
             chan.create_data_array(n)
         return n
 
-    def pad_channel_to_num_frames_interval(
-            self, channel: 'TemporalDataChannelBase'):
-        """Pads the channel data arrays to the current number of timestamps.
-
-        When adding timestamps, we don't increase all the channels data arrays
-        with each new timestamp, but only do it when the channel data is
-        updated or when the file is saved etc. This increases the data
-        arrays size to the timestamps size.
-        """
-        array_num = self._last_timestamps_n
-        if array_num is None:
-            return
-
-        size = len(self.timestamps_arrays[array_num])
-        if not size:
-            return
-
-        channel.pad_channel_to_num_frames(array_num, size)
-
-    def pad_all_channels_to_num_frames_interval(self, array_num=None):
-        """Similar to :meth:`pad_channel_to_num_frames_interval`, but for all
-        the channels.
+    def pad_all_channels_to_num_frames(self):
+        """Pads all the data arrays of all the channels to their number of
+        frames (see :meth:`TemporalDataChannelBase.pad_to_num_frames`), so
+        that the padding is stored in the file with the next :meth:`flush`.
 
-        If ``array_num`` is specified, we pad that array, other wise we use
-        :attr:`_last_timestamps_n` if it's not None.
+        Reading the data with the channels doesn't require it, but it should
+        be called before the file is saved, so that other readers of the file
+        get the data for each timestamp.
         """
-        if array_num is None:
-            array_num = self._last_timestamps_n
-            if array_num is None:
-                return
-
-        size = len(self.timestamps_arrays[array_num])
-        if not size:
-            return
-
-        self.unsaved_callback()
         for chan in self.event_channels.values():
-            chan.pad_channel_to_num_frames(array_num, size)
+            chan.pad_to_num_frames()
         for chan in self.pos_channels.values():
-            chan.pad_channel_to_num_frames(array_num, size)
+            chan.pad_to_num_frames()
 
     def notify_add_timestamp(self, t: float) -> int:
         """Adds the next timestamp to the file.
@@ -901,18 +1730,20 @@ class DataFile:
                 # only merge if this is not the first timestamp and
                 # we didn't jump by seeking to new timestamp
                 if last_timestamps_n is not None:
+                    i = self._last_timestamps_ordered_index
+                    # playing sequentially, we reached the next interval
+                    assert self.timestamp_intervals_ordered_keys[i + 1] == n
                     n = self._merge_timestamp_channels_arrays(
                         last_timestamps_n, n)
+                    self._merge_timestamp_intervals(i)
 
                     # have we finally seen all timestamps?
                     if self._saw_last_timestamp and self._saw_first_timestamp \
                             and len(self.timestamps_arrays) == 1:
                         self._mark_saw_all_timestamps()
-
-                    self._populate_timestamp_intervals()
-
-                self._last_timestamps_ordered_index = \
-                    self.timestamp_intervals_ordered_keys.index(n)
+                else:
+                    self._last_timestamps_ordered_index = \
+                        self._get_timestamp_interval_index(t)
                 self._last_timestamps_n = n
             return n
 
@@ -928,15 +1759,14 @@ class DataFile:
 
             last_timestamps_n = self._last_timestamps_n = n
 
-        data_array = self.timestamps_arrays[last_timestamps_n]
-        timestamps_map[t] = last_timestamps_n, len(data_array)
-        data_array.append(t)
+        buffer = self.timestamps_buffers[last_timestamps_n]
+        timestamps_map[t] = last_timestamps_n, len(buffer)
+        buffer.append(t)
 
         if jumped_array:
-            # we added a new interval so recompute the intervals order
-            self._populate_timestamp_intervals()
+            # we added a new interval so add it to the intervals order
             self._last_timestamps_ordered_index = \
-                self.timestamp_intervals_ordered_keys.index(last_timestamps_n)
+                self._insert_timestamp_interval(last_timestamps_n, t)
         else:
             # update the current interval end point
             self.timestamp_intervals_end[
@@ -967,15 +1797,20 @@ class DataFile:
         The channel ID is stored in :attr:`DataChannelBase.num`.
         """
         if i in self.event_channels:
-            channel = self.event_channels.pop(i)
+            channels = self.event_channels
         elif i in self.pos_channels:
-            channel = self.pos_channels.pop(i)
+            channels = self.pos_channels
         elif i in self.zone_channels:
-            channel = self.zone_channels.pop(i)
+            channels = self.zone_channels
         else:
             raise ValueError(i)
 
         self.unsaved_callback()
+        self.file_access_callback()
+        channel = channels.pop(i)
+        self._deleted_data_arrays = [
+            item for item in self._deleted_data_arrays
+            if item[0] != channel.name]
         del self.nix_file.blocks[channel.name]
         del self.nix_file.sections[channel.name + '_metadata']
 
@@ -983,7 +1818,7 @@ class DataFile:
         """Returns whether the timestamp is the last timestamp of a interval.
         """
         n, i = self.timestamp_data_map[t]
-        arr = self.timestamps_arrays[n]
+        arr = self.timestamps_buffers[n]
 
         if i < len(arr) - 1:
             return False
@@ -1039,8 +1874,8 @@ class DataFile:
             return None
 
         # t is in the ith interval, find the closest value
-        timestamps = self.timestamps_arrays[keys[i]]
-        k = bisect_left(timestamps, t)
+        timestamps = self.timestamps_buffers[keys[i]].array
+        k = int(np.searchsorted(timestamps, t))
 
         # it cannot be zero. It clearly cannot be less than timestamps[0] as
         # that would make it outside the interval. It cannot be exactly
@@ -1052,6 +1887,52 @@ class DataFile:
             return float(timestamps[k])
         return float(timestamps[k - 1])
 
+    def condition_timestamps(self, t: np.ndarray) -> np.ndarray:
+        """Similar to :meth:`condition_timestamp`, but conditions a whole
+        array of timestamps at once.
+
+        :param t: The array of timestamps to condition.
+        :return: An float64 array of the same size as ``t`` with the
+            conditioned timestamps. For timestamps for which
+            :meth:`condition_timestamp` would return None, it contains NaN.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        result = t.copy()
+
+        start = np.asarray(self.timestamp_intervals_start, dtype=np.float64)
+        end = np.asarray(self.timestamp_intervals_end, dtype=np.float64)
+        keys = self.timestamp_intervals_ordered_keys
+        # if we have not seen any frames yet, all timestamps are valid
+        if not keys:
+            return result
+
+        i = np.searchsorted(end, t)
+
+        # t is larger than the largest known timestamp
+        after = i == len(keys)
+        result[after] = end[-1] if self._saw_last_timestamp else np.nan
+
+        inside = ~after
+        inside[inside] = t[inside] >= start[i[inside]]
+        # t is before the start of the ith interval
+        before = ~after & ~inside
+        # t is before the start of the video or between two intervals
+        result[before] = np.where(i[before] == 0, start[0], np.nan)
+
+        # for t in an interval find the closest value
+        for interval in np.unique(i[inside]):
+            mask = inside & (i == interval)
+            timestamps = self.timestamps_buffers[keys[interval]].array
+            values = t[mask]
+
+            k = np.searchsorted(timestamps, values)
+            upper = timestamps[k]
+            lower = timestamps[np.maximum(k - 1, 0)]
+            result[mask] = np.where(
+                upper - values <= values - lower, upper, lower)
+
+        return result
+
 
 class DataChannelBase:
     """Base class for data channels stored in a :class:`DataFile`.
@@ -1065,6 +1946,10 @@ class DataChannelBase:
     """The metadata section that stores the channel metadata.
     """
 
+    _config_metadata: MetadataSection = None
+    """Caches :attr:`metadata`.
+    """
+
     name: str = ''
     """The name of the channel in the file. This is not the user facing name,
     but rather the internal NixIO name of the :attr:`block` containing the
@@ -1090,6 +1975,8 @@ class DataChannelBase:
         self.block = block
         self.metadata = block.metadata
         self.data_file = data_file
+        self._config_metadata = MetadataSection(
+            self.metadata, compact=data_file.compact_metadata)
 
     def reopen_file(self, block: nix.Block):
         """Repopulates the data links from the provided block.
@@ -1098,6 +1985,7 @@ class DataChannelBase:
         """
         self.block = block
         self.metadata = block.metadata
+        self._config_metadata.section = self.metadata
 
     def create_initial_data(self):
         """Creates whatever initial data structures are needed for storing the
@@ -1115,25 +2003,23 @@ class DataChannelBase:
         """Reads/writes the channel metadata from the **current** NixIO file
         into/from a dict.
 
-        .. warning::
+        .. note::
 
-            This property reads/writes to the file when accessed.
+            The metadata is read from the file once and then cached. When
+            set, only the keys whose values changed are written to the file.
 
         See :meth:`DataFile.set_file_data` for the metadata requirements
         if setting manually outside the GUI.
         """
-        config = self.metadata
-        data = {}
-        for prop in config.props:
-            data[prop.name] = yaml_loads(read_nix_prop(prop))
-        return data
+        if not self._config_metadata.loaded:
+            self.data_file.file_access_callback()
+        return self._config_metadata.get_dict()
 
     @channel_config_dict.setter
     def channel_config_dict(self, data: dict):
         self.data_file.unsaved_callback()
-        config = self.metadata
-        for k, v in data.items():
-            config[k] = yaml_dumps(v)
+        self.data_file.file_access_callback()
+        self._config_metadata.update(data)
 
     def copy_data(self, channel: 'ChannelType'):
         """Copies this channel's data, if any, into the given channel.
@@ -1161,6 +2047,34 @@ class TemporalDataChannelBase(DataChannelBase):
     intervals.
     """
 
+    data_buffers: Dict[int, GrowableArray] = {}
+    """In-memory mirror of the channel data in :attr:`data_arrays`, with the
+    same keys.
+
+    The data is read and changed only in memory, and the changed index
+    ranges are tracked and written back to :attr:`data_arrays` in coalesced
+    slices with :meth:`flush` (via :meth:`DataFile.flush`).
+
+    A buffer may be shorter than its :meth:`get_num_frames`, in which case
+    the missing frames have the :attr:`default_data_value`.
+    """
+
+    _data_flushed: Dict[int, int] = {}
+    """Maps keys of :attr:`data_buffers` to the number of items in the
+    corresponding array in :attr:`data_arrays`. Items past it are appended
+    to the array when flushed.
+    """
+
+    _dirty_ranges: Dict[int, List[List[int]]] = {}
+    """Maps keys of :attr:`data_buffers` to the list of half open index
+    ranges that have changed in memory since the last :meth:`flush`.
+    """
+
+    flush_gap = 64
+    """When flushing, changed ranges separated by at most this many
+    unchanged items are written together in a single slice.
+    """
+
     default_data_value = None
     """The per-channel type default data used before the user modifies
     the data. E.g. for an event channel it may default to False.
@@ -1169,6 +2083,9 @@ class TemporalDataChannelBase(DataChannelBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.data_arrays = {}
+        self.data_buffers = {}
+        self._data_flushed = {}
+        self._dirty_ranges = {}
 
     def reopen_file(self, block: nix.Block):
         super().reopen_file(block)
@@ -1176,8 +2093,9 @@ class TemporalDataChannelBase(DataChannelBase):
 
     def create_initial_data(self):
         self.data_file.unsaved_callback()
+        self.data_file.file_access_callback()
 
-        timestamps = self.data_file.timestamps_arrays
+        timestamps = self.data_file.timestamps_buffers
         for i, timestamps_arr in timestamps.items():
             self.create_data_array(i, count=len(timestamps_arr))
 
@@ -1194,6 +2112,17 @@ class TemporalDataChannelBase(DataChannelBase):
         """
         raise NotImplementedError
 
+    def _create_data_buffer(self, n: int, count: Optional[int]):
+        """Creates the :attr:`data_buffers` mirror for a newly created
+        data array, filled with the :attr:`default_data_value`.
+        """
+        default = self.default_data_value
+        count = count or 0
+        self.data_buffers[n] = GrowableArray(
+            default.repeat(count, axis=0), dtype=default.dtype,
+            item_shape=default.shape[1:])
+        self._data_flushed[n] = count
+
     def read_initial_data(self, reopen=False):
         block = self.block
         data_arrays = self.data_arrays = {}
@@ -1206,29 +2135,140 @@ class TemporalDataChannelBase(DataChannelBase):
             n = int(item.name.split('_')[-1])
             data_arrays[n] = item
 
+        if reopen:
+            # no need to re-read the data, it didn't change
+            return
+
+        self._read_data_buffers()
+        self._dirty_ranges = {}
+
+    def _read_data_buffers(self):
+        """Reads the data of all the :attr:`data_arrays` into
+        :attr:`data_buffers`.
+        """
+        default = self.default_data_value
+        buffers = self.data_buffers = {
+            i: GrowableArray(
+                np.asarray(arr), dtype=default.dtype,
+                item_shape=default.shape[1:])
+            for i, arr in self.data_arrays.items()
+        }
+        self._data_flushed = {i: len(buf) for i, buf in buffers.items()}
+
+    def _mark_dirty(self, n: int, start: int, end: int):
+        """Records that the half open ``[start, end)`` range of the
+        :attr:`data_buffers` array ``n`` changed and needs to be flushed.
+        """
+        ranges = self._dirty_ranges.setdefault(n, [])
+        if ranges:
+            last = ranges[-1]
+            # most changes are sequential, so try extending the last range
+            if last[0] <= start <= last[1]:
+                if end > last[1]:
+                    last[1] = end
+                return
+        ranges.append([start, end])
+
+    def flush(self):
+        """Writes all the changes to the :attr:`data_buffers` since the last
+        flush to the NixIO :attr:`data_arrays`.
+
+        Changed ranges are coalesced so that each array is written using as
+        few slices as possible. It is called by :meth:`DataFile.flush`.
+        """
+        data_file = self.data_file
+        data_file.file_access_callback()
+        snapshot = self.get_flush_snapshot()
+        try:
+            data_file.write_flush_snapshot(snapshot)
+        except BaseException:
+            data_file.restore_flush_snapshot(snapshot)
+            raise
+
+    def get_flush_snapshot(
+            self) -> List[Tuple[nix.DataArray, int, np.ndarray, bool]]:
+        """Like :meth:`DataFile.get_flush_snapshot`, but only for the data of
+        this channel.
+        """
+        snapshot = []
+        data_arrays = self.data_arrays
+        data_buffers = self.data_buffers
+        flushed = self._data_flushed
+
+        for n, ranges in self._dirty_ranges.items():
+            arr = data_arrays[n]
+            buffer = data_buffers[n]
+            size = flushed[n]
+            for start, end in _coalesce_ranges(ranges, self.flush_gap):
+                # items past the stored size are appended below
+                end = min(end, size)
+                if start < end:
+                    snapshot.append(
+                        (arr, start, buffer[start:end].copy(), False))
+        self._dirty_ranges = {}
+
+        for n, buffer in data_buffers.items():
+            size = flushed[n]
+            if size < len(buffer):
+                snapshot.append(
+                    (data_arrays[n], size, buffer[size:].copy(), True))
+                flushed[n] = len(buffer)
+        return snapshot
+
     def merge_arrays(self, arr_num1: int, arr_num2: int):
         """Merges the data arrays into a single array.
 
         The same as :attr:`DatFile._merge_timestamp_channels_arrays`, but for
-        data arrays.
+        data arrays. It must be called before the timestamps are merged.
         """
+        self.data_file.unsaved_callback()
         data_arrays = self.data_arrays
-        arr1 = data_arrays[arr_num1]
         arr2 = data_arrays[arr_num2]
         assert arr2 is not self.data_array
 
-        self.data_file.unsaved_callback()
-        arr1.append(arr2)
-        del self.block.data_arrays[arr2.name]
+        # the second array's data is appended to the first from the buffer,
+        # so the first must have all its frames. The missing frames at the
+        # end of the second array are the missing frames of the merged array
+        self.pad_channel_to_num_frames(arr_num1, self.get_num_frames(arr_num1))
+        self._merge_buffers(arr_num1, arr_num2)
+        self.data_file._deleted_data_arrays.append((self.name, arr2.name))
         del data_arrays[arr_num2]
+        del self._data_flushed[arr_num2]
+        self._dirty_ranges.pop(arr_num2, None)
+
+    def _merge_buffers(self, arr_num1: int, arr_num2: int):
+        """Appends the in-memory data of array ``arr_num2`` to ``arr_num1``
+        and removes it. Called by :meth:`merge_arrays`.
+        """
+        self.data_buffers[arr_num1].extend(self.data_buffers[arr_num2].array)
+        del self.data_buffers[arr_num2]
+
+    def get_num_frames(self, n: int) -> int:
+        """Returns the number of frames of the data array ``n`` in
+        :attr:`data_arrays`, which is the number of timestamps in the
+        corresponding :attr:`DataFile.timestamps_buffers` array.
+
+        The buffer in :attr:`data_buffers` may store fewer items, the frames
+        past them have the :attr:`default_data_value`.
+        """
+        return len(self.data_file.timestamps_buffers[n])
+
+    def pad_to_num_frames(self, n: Optional[int] = None):
+        """Pads the data array ``n``, or all the arrays if None, to its number
+        of frames (:meth:`get_num_frames`) using
+        :meth:`pad_channel_to_num_frames`.
+        """
+        keys = list(self.data_arrays) if n is None else [n]
+        for key in keys:
+            self.pad_channel_to_num_frames(key, self.get_num_frames(key))
 
     def pad_channel_to_num_frames(self, array_num: int, size: int):
         """Pads the channel data arrays to the given size, if it's smaller.
 
-        See :attr:`DataFile.pad_channel_to_num_frames_interval`.
+        See :meth:`pad_to_num_frames`.
         """
-        arr = self.data_arrays[array_num]
-        n = len(arr)
+        buffer = self.data_buffers[array_num]
+        n = len(buffer)
         diff = size - n
         assert diff >= 0
 
@@ -1236,7 +2276,16 @@ class TemporalDataChannelBase(DataChannelBase):
             return
 
         self.data_file.unsaved_callback()
-        arr.append(self.default_data_value.repeat(diff, axis=0))
+        buffer.extend(self.default_data_value.repeat(diff, axis=0))
+
+    def set_data_array_values(self, n: int, values: np.ndarray):
+        """Sets all the values of the data array ``n`` in :attr:`data_arrays`
+        to ``values``.
+        """
+        self.data_file.unsaved_callback()
+        buffer = self.data_buffers[n]
+        buffer[:] = values
+        self._mark_dirty(n, 0, len(buffer))
 
     def get_timestamps_modified_state(self) -> Dict[float, bool]:
         """Returns a dict whose keys are timestamps and values indicate whether
@@ -1261,17 +2310,21 @@ class TemporalDataChannelBase(DataChannelBase):
         Number of items in data must be the same as the number of true
         elements in mask, if provided.
         """
-        self.data_file.pad_channel_to_num_frames_interval(self)
         if not self.data_file.saw_all_timestamps:
             raise TypeError(
                 'Cannot set the data at once when missing timestamps')
+        self.pad_to_num_frames(0)
 
         self.data_file.unsaved_callback()
+        buffer = self.data_buffers[0]
         if mask is None:
-            self.data_array[:] = data
+            buffer[:] = data
+            self._mark_dirty(0, 0, len(buffer))
         else:
-            # workaround for https://github.com/h5py/h5py/issues/1750
-            self.data_array[mask.nonzero()[0]] = data
+            indices = mask.nonzero()[0]
+            buffer[indices] = data
+            if len(indices):
+                self._mark_dirty(0, int(indices[0]), int(indices[-1]) + 1)
 
     def get_timestamp_value(self, t: float) -> Any:
         """Returns the value of the data array for the given timestamp ``t``.
@@ -1281,13 +2334,18 @@ class TemporalDataChannelBase(DataChannelBase):
     def reset_data_to_default(self):
         """Resets all the data array values to the :attr:`default_data_value`.
         """
-        for arr in self.data_arrays.values():
-            arr[:] = self.default_data_value
+        self.data_file.unsaved_callback()
+        for n, buffer in self.data_buffers.items():
+            buffer[:] = self.default_data_value
+            self._mark_dirty(n, 0, len(buffer))
 
     def copy_data(self, channel: 'ChannelType'):
-        src_data_arrays = self.data_arrays
-        for key, target_arr in channel.data_arrays.items():
-            target_arr[:] = src_data_arrays[key]
+        self.pad_to_num_frames()
+        channel.pad_to_num_frames()
+        src_data_buffers = self.data_buffers
+        for key, target_buffer in channel.data_buffers.items():
+            target_buffer[:] = src_data_buffers[key].array
+            channel._mark_dirty(key, 0, len(target_buffer))
 
 
 class EventChannelData(TemporalDataChannelBase):
@@ -1306,28 +2364,138 @@ class EventChannelData(TemporalDataChannelBase):
     It is False (0) for the event channel.
     """
 
+    runs_storage: bool = False
+    """Whether the channel data is stored in the file as runs, rather than a
+    value for each frame.
+
+    If True, each of the :attr:`data_arrays` is a ``(M, 2)`` int64 array of
+    the sorted half open ``[start, end)`` index ranges of the frames of the
+    interval during which the event is active. The dense per-frame data of
+    :attr:`data_buffers` is only created from the runs when first accessed,
+    and the runs are rewritten from it when flushed. See :meth:`get_runs`.
+
+    It's set from :attr:`DataFile.event_runs_storage` when the channel is
+    created, or from the file when it's read.
+    """
+
+    runs_data_type = 'event_runs'
+    """The NixIO type of the data arrays when :attr:`runs_storage`.
+    """
+
+    _data_buffers: Dict[int, GrowableArray] = {}
+
+    _pending_runs: Dict[int, Tuple[np.ndarray, int]] = {}
+    """Maps keys of :attr:`data_arrays` to the runs read from the file and
+    the number of frames of the array, for the arrays whose
+    :attr:`data_buffers` have not been created yet.
+    """
+
+    @property
+    def data_buffers(self) -> Dict[int, GrowableArray]:
+        """Same as :attr:`TemporalDataChannelBase.data_buffers`. With
+        :attr:`runs_storage`, the buffers are created from the runs read from
+        the file when first accessed.
+        """
+        pending = self._pending_runs
+        if pending:
+            self._pending_runs = {}
+            buffers = self._data_buffers
+            for n, (runs, size) in pending.items():
+                buffers[n] = GrowableArray(
+                    _dense_from_runs(runs, size), dtype=np.uint8)
+        return self._data_buffers
+
+    @data_buffers.setter
+    def data_buffers(self, value: Dict[int, GrowableArray]):
+        self._data_buffers = value
+        self._pending_runs = {}
+
+    def create_initial_data(self):
+        self.runs_storage = self.data_file.event_runs_storage
+        super().create_initial_data()
+
+    def _read_data_buffers(self):
+        data_arrays = self.data_arrays
+        runs_storage = self.runs_storage = \
+            self.data_array.type == self.runs_data_type
+        if not runs_storage:
+            super()._read_data_buffers()
+            return
+
+        timestamps = self.data_file.timestamps_buffers
+        self.data_buffers = {}
+        self._data_flushed = {n: len(timestamps[n]) for n in data_arrays}
+        self._pending_runs = {
+            n: (np.asarray(arr).astype(np.int64).reshape(-1, 2),
+                len(timestamps[n]))
+            for n, arr in data_arrays.items()
+        }
+
+    def get_runs(self, n: int) -> np.ndarray:
+        """Returns the ``(M, 2)`` int64 array of the sorted half open
+        ``[start, end)`` index ranges during which the event is active, in
+        the data array ``n`` of :attr:`data_arrays`.
+
+        With :attr:`runs_storage`, if the data was not changed since it was
+        read, the runs are returned without creating the dense data.
+        """
+        if n in self._pending_runs:
+            return self._pending_runs[n][0].copy()
+        return _runs_from_dense(self.data_buffers[n].array)
+
+    def get_flush_snapshot(
+            self) -> List[Tuple[nix.DataArray, int, np.ndarray, bool]]:
+        if not self.runs_storage:
+            return super().get_flush_snapshot()
+
+        # padding doesn't change the runs, only changed data does
+        snapshot = []
+        data_arrays = self.data_arrays
+        data_buffers = self.data_buffers
+        for n in self._dirty_ranges:
+            runs = _runs_from_dense(data_buffers[n].array)
+            snapshot.append((data_arrays[n], 0, runs, None))
+        self._dirty_ranges = {}
+        return snapshot
+
+    def merge_arrays(self, arr_num1: int, arr_num2: int):
+        size = len(self.data_buffers[arr_num1])
+        super().merge_arrays(arr_num1, arr_num2)
+        if self.runs_storage:
+            # the runs of the second array must be added to the first
+            self._mark_dirty(
+                arr_num1, size, len(self.data_buffers[arr_num1]))
+
     def create_data_array(self, n: int = 0, count: Optional[int] = None):
         self.data_file.unsaved_callback()
+        self.data_file.file_access_callback()
         name = self.name if not n else '{}_group_{}'.format(self.name, n)
 
-        if not count:
+        if self.runs_storage:
+            # the default data has no runs
+            self.data_arrays[n] = self.block.create_data_array(
+                name, self.runs_data_type, dtype=np.int64,
+                data=np.empty((0, 2), dtype=np.int64))
+        elif not count:
             self.data_arrays[n] = self.block.create_data_array(
                 name, 'event', dtype=np.uint8, data=[])
         else:
             self.data_arrays[n] = self.block.create_data_array(
                 name, 'event', dtype=np.uint8,
                 data=self.default_data_value.repeat(count, axis=0))
+        self._create_data_buffer(n, count)
 
     def get_timestamps_modified_state(self) -> Dict[float, bool]:
-        self.data_file.pad_channel_to_num_frames_interval(self)
-        data_arrays = self.data_arrays
-        timestamp_arrays = self.data_file.timestamps_arrays
+        data_buffers = self.data_buffers
+        timestamp_arrays = self.data_file.timestamps_buffers
 
         results = {}
-        for i in data_arrays:
-            data_array = np.array(data_arrays[i]) != 0
-            timestamp_array = np.array(timestamp_arrays[i])
-            for j in range(len(timestamp_array)):
+        for i in data_buffers:
+            data_array = data_buffers[i].array != 0
+            timestamp_array = timestamp_arrays[i].array
+            # frames that are not stored are not modified
+            results.update(dict.fromkeys(timestamp_array, False))
+            for j in range(min(len(timestamp_array), len(data_array))):
                 results[timestamp_array[j]] = data_array[j]
 
         return results
@@ -1336,19 +2504,20 @@ class EventChannelData(TemporalDataChannelBase):
         """Changes the value of the data array for the given timestamp ``t``
         to ``value``.
         """
-        self.data_file.pad_channel_to_num_frames_interval(self)
         data_file = self.data_file
         data_file.unsaved_callback()
         n, i = data_file.timestamp_data_map[t]
-        self.data_arrays[n][i] = value
+        self.pad_to_num_frames(n)
+        self.data_buffers[n][i] = value
+        self._mark_dirty(n, i, i + 1)
 
     def get_timestamp_value(self, t: float) -> bool:
         """Returns the value of the data array for the given timestamp ``t``.
         """
         n, i = self.data_file.timestamp_data_map[t]
-        if len(self.data_arrays[n]) <= i:
+        if len(self.data_buffers[n]) <= i:
             return False
-        return bool(self.data_arrays[n][i])
+        return bool(self.data_buffers[n][i])
 
 
 class PosChannelData(TemporalDataChannelBase):
@@ -1368,10 +2537,140 @@ class PosChannelData(TemporalDataChannelBase):
     channel.
     """
 
+    sparse_storage: bool = False
+    """Whether only the frames whose position was set are stored.
+
+    If True, each of the :attr:`data_arrays` is a ``(M, 3)`` float64 array
+    whose rows are the index of a frame of the interval followed by its x
+    and y position, sorted by the index. In memory, the data is kept in
+    :attr:`sparse_buffers` and the dense per-frame :attr:`data_buffers` are
+    only created from them when first accessed. When flushed, the arrays
+    whose data changed are rewritten.
+
+    It's set from :attr:`DataFile.pos_sparse_storage` when the channel is
+    created, or from the file when it's read.
+    """
+
+    sparse_data_type = 'pos_sparse'
+    """The NixIO type of the data arrays when :attr:`sparse_storage`.
+    """
+
+    sparse_buffers: Dict[int, SparseFrameData] = {}
+    """With :attr:`sparse_storage`, the in-memory data of the arrays in
+    :attr:`data_arrays`, with the same keys, until :attr:`data_buffers` is
+    accessed. It's empty otherwise.
+    """
+
+    _data_buffers: Dict[int, GrowableArray] = {}
+
+    @property
+    def data_buffers(self) -> Dict[int, GrowableArray]:
+        """Same as :attr:`TemporalDataChannelBase.data_buffers`. With
+        :attr:`sparse_storage`, the buffers are created from
+        :attr:`sparse_buffers` when first accessed, which are then cleared.
+        """
+        sparse_buffers = self.sparse_buffers
+        if sparse_buffers:
+            self.sparse_buffers = {}
+            default = self.default_data_value
+            buffers = self._data_buffers
+            for n, data in sparse_buffers.items():
+                buffers[n] = GrowableArray(
+                    data.get_dense(), dtype=default.dtype,
+                    item_shape=default.shape[1:])
+        return self._data_buffers
+
+    @data_buffers.setter
+    def data_buffers(self, value: Dict[int, GrowableArray]):
+        self._data_buffers = value
+        self.sparse_buffers = {}
+
+    @property
+    def _is_sparse(self) -> bool:
+        """Whether the data is currently in :attr:`sparse_buffers`.
+        """
+        return self.sparse_storage and not self._data_buffers
+
+    def create_initial_data(self):
+        self.sparse_storage = self.data_file.pos_sparse_storage
+        super().create_initial_data()
+
+    def _read_data_buffers(self):
+        data_arrays = self.data_arrays
+        sparse_storage = self.sparse_storage = \
+            self.data_array.type == self.sparse_data_type
+        if not sparse_storage:
+            super()._read_data_buffers()
+            return
+
+        timestamps = self.data_file.timestamps_buffers
+        default = self.default_data_value[0]
+        self.data_buffers = {}
+        self._data_flushed = {n: len(timestamps[n]) for n in data_arrays}
+        self.sparse_buffers = {
+            n: SparseFrameData.from_array(
+                np.asarray(arr), default, len(timestamps[n]))
+            for n, arr in data_arrays.items()
+        }
+
+    def get_flush_snapshot(
+            self) -> List[Tuple[nix.DataArray, int, np.ndarray, bool]]:
+        if not self.sparse_storage:
+            return super().get_flush_snapshot()
+
+        # padding doesn't change the stored frames, only changed data does
+        snapshot = []
+        data_arrays = self.data_arrays
+        sparse_buffers = self.sparse_buffers
+        default = self.default_data_value[0]
+        for n in self._dirty_ranges:
+            if n in sparse_buffers:
+                data = sparse_buffers[n]
+            else:
+                data = SparseFrameData.from_dense(
+                    self._data_buffers[n].array, default)
+            snapshot.append((data_arrays[n], 0, data.to_array(), None))
+        self._dirty_ranges = {}
+        return snapshot
+
+    def _merge_buffers(self, arr_num1: int, arr_num2: int):
+        if not self._is_sparse:
+            super()._merge_buffers(arr_num1, arr_num2)
+            return
+
+        sparse_buffers = self.sparse_buffers
+        data = sparse_buffers.pop(arr_num2)
+        sparse_buffers[arr_num1].extend(data)
+        if len(data.indices):
+            self._mark_dirty(arr_num1, 0, len(sparse_buffers[arr_num1]))
+
+    def pad_channel_to_num_frames(self, array_num: int, size: int):
+        if not self._is_sparse:
+            super().pad_channel_to_num_frames(array_num, size)
+            return
+
+        data = self.sparse_buffers[array_num]
+        assert size >= data.size
+        data.size = size
+
     def create_data_array(self, n: int = 0, count: Optional[int] = None):
         self.data_file.unsaved_callback()
+        self.data_file.file_access_callback()
         name = self.name if not n else '{}_group_{}'.format(self.name, n)
 
+        if self.sparse_storage:
+            # the default data has no set frames
+            self.data_arrays[n] = self.block.create_data_array(
+                name, self.sparse_data_type, dtype=np.float64,
+                data=np.empty((0, 3)))
+            if self._is_sparse:
+                self.sparse_buffers[n] = SparseFrameData(
+                    self.default_data_value[0], count or 0)
+                self._data_flushed[n] = count or 0
+            else:
+                self._create_data_buffer(n, count)
+            return
+
         if not count:
             self.data_arrays[n] = self.block.create_data_array(
                 name, 'pos', dtype=np.float64, data=np.empty((0, 2)))
@@ -1379,17 +2678,28 @@ class PosChannelData(TemporalDataChannelBase):
             self.data_arrays[n] = self.block.create_data_array(
                 name, 'pos', dtype=np.float64,
                 data=self.default_data_value.repeat(count, axis=0))
+        self._create_data_buffer(n, count)
 
     def get_timestamps_modified_state(self) -> Dict[float, bool]:
-        self.data_file.pad_channel_to_num_frames_interval(self)
-        data_arrays = self.data_arrays
-        timestamp_arrays = self.data_file.timestamps_arrays
-
+        timestamp_arrays = self.data_file.timestamps_buffers
+        if self._is_sparse:
+            results = {}
+            for i, data in self.sparse_buffers.items():
+                timestamp_array = timestamp_arrays[i].array
+                results.update(dict.fromkeys(timestamp_array, False))
+                set_frames = data.indices[data.values[:, 0] != -1]
+                results.update(
+                    dict.fromkeys(timestamp_array[set_frames], True))
+            return results
+
+        data_buffers = self.data_buffers
         results = {}
-        for i in data_arrays:
-            data_array = np.array(data_arrays[i])[:, 0] != -1
-            timestamp_array = np.array(timestamp_arrays[i])
-            for j in range(len(timestamp_array)):
+        for i in data_buffers:
+            data_array = data_buffers[i].array[:, 0] != -1
+            timestamp_array = timestamp_arrays[i].array
+            # frames that are not stored are not modified
+            results.update(dict.fromkeys(timestamp_array, False))
+            for j in range(min(len(timestamp_array), len(data_array))):
                 results[timestamp_array[j]] = data_array[j]
 
         return results
@@ -1399,27 +2709,41 @@ class PosChannelData(TemporalDataChannelBase):
         """Changes the value of the data array for the given timestamp ``t``
         to ``value``.
         """
-        self.data_file.pad_channel_to_num_frames_interval(self)
         data_file = self.data_file
         data_file.unsaved_callback()
         n, i = data_file.timestamp_data_map[t]
-        self.data_arrays[n][i, :] = value
+        self.pad_to_num_frames(n)
+        if self._is_sparse:
+            self.sparse_buffers[n].set_value(i, value)
+        else:
+            self.data_buffers[n][i, :] = value
+        self._mark_dirty(n, i, i + 1)
+
+    def _get_data_view(self, n: int) -> Union[np.ndarray, SparseFrameData]:
+        """Returns the data of array ``n``, either the dense array or its
+        :class:`SparseFrameData`, which can be indexed like the dense array.
+        """
+        if self._is_sparse:
+            return self.sparse_buffers[n]
+        return self.data_buffers[n].array
 
     def get_timestamp_value(self, t: float) -> Tuple[float, float]:
         """Returns the value of the data array for the given timestamp ``t``.
         """
         n, i = self.data_file.timestamp_data_map[t]
-        if len(self.data_arrays[n]) <= i:
+        data = self._get_data_view(n)
+        if len(data) <= i:
             return -1, -1
-        x, y = self.data_arrays[n][i, :]
+        x, y = data[i]
         return float(x), float(y)
 
     def get_previous_timestamp_data(self, t):
         n, i = self.data_file.timestamp_data_map[t]
-        if len(self.data_arrays[n]) < i:
+        data = self._get_data_view(n)
+        if len(data) < i:
             return None, None, None
 
-        return self.data_file.timestamps_arrays[n], self.data_arrays[n], i - 1
+        return self.data_file.timestamps_buffers[n].array, data, i - 1
 
 
 class ZoneChannelData(DataChannelBase):
@@ -0,0 +1,226 @@
+"""H5 file sync
+===============
+
+Saving a file copies the autosave file over the saved file. For large files
+this is slow even when little changed, so :func:`sync_h5_file` instead
+updates the saved file in place with only the changes, assuming the saved
+file was identical to the autosave file at the last save.
+
+Groups, links and attributes are always compared, because they are small.
+Small datasets are compared by value, while large datasets (i.e. the data
+arrays) are only compared by shape and dtype, so the data arrays that changed
+since the last save must be provided. :class:`~glitter2.storage.data_file.
+DataFile` tracks this in :meth:`~glitter2.storage.data_file.DataFile.
+pop_modified_data_arrays`.
+
+E.g.::
+
+    modified = data_file.pop_modified_data_arrays()
+    nix_file.close()
+    sync_h5_file(autosave_filename, filename, modified)
+"""
+from typing import Dict, Optional
+import h5py
+import numpy as np
+
+__all__ = ('sync_h5_file', )
+
+_small_dataset_size = 64 * 1024
+"""Datasets with at most this many bytes are compared by value. Larger
+datasets are only compared by value if they are listed as modified.
+"""
+
+_write_chunk_size = 16 * 1024 * 1024
+"""The approximate max number of bytes of a dataset written at once.
+"""
+
+
+def _get_addr(obj) -> int:
+    """Returns the address of the object in its file, which is the same for
+    all the hard links to the object.
+    """
+    return h5py.h5o.get_info(obj.id).addr
+
+
+def _sync_attrs(src, dst):
+    src_attrs = src.attrs
+    dst_attrs = dst.attrs
+    for name in list(dst_attrs):
+        if name not in src_attrs:
+            del dst_attrs[name]
+
+    for name in src_attrs:
+        value = src_attrs[name]
+        dtype = src_attrs.get_id(name).dtype
+        if name in dst_attrs:
+            if dst_attrs.get_id(name).dtype == dtype and \
+                    np.array_equal(dst_attrs[name], value):
+                continue
+        dst_attrs.create(name, value, dtype=dtype)
+
+
+def _copy_rows(src: h5py.Dataset, dst: h5py.Dataset, start: int):
+    """Copies all the rows of ``src`` starting at ``start`` into ``dst``, in
+    chunks.
+    """
+    n = src.shape[0]
+    row_size = max(1, src.dtype.itemsize * int(np.prod(src.shape[1:])))
+    step = max(1, _write_chunk_size // row_size)
+    for i in range(start, n, step):
+        dst[i:i + step] = src[i:i + step]
+
+
+def _sync_dataset(
+        src: h5py.Dataset, dst: h5py.Dataset, modified: Dict[str, int]
+) -> bool:
+    """Updates ``dst`` to be the same as ``src``.
+
+    Returns False if it cannot be updated in place and it must be replaced
+    with a copy of ``src``.
+    """
+    if src.dtype != dst.dtype or src.ndim != dst.ndim or \
+            src.compression != dst.compression or src.chunks != dst.chunks:
+        return False
+
+    _sync_attrs(src, dst)
+    if not src.ndim:
+        if not np.array_equal(src[()], dst[()]):
+            dst[()] = src[()]
+        return True
+
+    # nix data arrays are stored in a group with the ID in its attrs
+    entity_id = src.parent.attrs.get('entity_id', None)
+    if isinstance(entity_id, bytes):
+        entity_id = entity_id.decode('utf8')
+    start = modified.get(entity_id, None) if src.name.endswith('/data') \
+        else None
+
+    small = src.size * src.dtype.itemsize <= _small_dataset_size
+    if src.shape != dst.shape:
+        if src.shape[1:] != dst.shape[1:] or dst.chunks is None or any(
+                m is not None and m < s
+                for m, s in zip(dst.maxshape, src.shape)):
+            return False
+
+        if start is None:
+            # if it's not listed, assume only the new items changed
+            start = 0 if small else min(src.shape[0], dst.shape[0])
+        dst.resize(src.shape)
+        start = min(start, src.shape[0])
+    elif start is None:
+        if not small:
+            return True
+        if np.array_equal(src[()], dst[()]):
+            return True
+        start = 0
+
+    _copy_rows(src, dst, start)
+    return True
+
+
+def _sync_group(
+        src: h5py.Group, dst: h5py.Group, modified: Dict[str, int],
+        synced: Dict[int, str], claimed: Dict[int, int]):
+    """Updates ``dst`` to be the same as ``src``, recursively.
+
+    :param synced: Maps the address of each ``src`` object already synced
+        to its name in the destination file, so that hard links to it can be
+        re-created.
+    :param claimed: Maps the address of each ``dst`` object already synced to
+        the address of the ``src`` object it was synced with. If a ``dst``
+        object is hard linked and has been synced with another object, it
+        must not be updated again for the current object.
+    """
+    _sync_attrs(src, dst)
+
+    for name in list(dst):
+        if name not in src:
+            del dst[name]
+
+    # iterate in creation order if it's tracked, so new links are created in
+    # the same order
+    for name in src:
+        link = src.get(name, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dst_link = dst.get(name, getlink=True)
+            if type(dst_link) is not type(link) or \
+                    getattr(dst_link, 'path', None) != link.path or \
+                    getattr(dst_link, 'filename', None) != getattr(
+                        link, 'filename', None):
+                if dst_link is not None:
+                    del dst[name]
+                dst[name] = link
+            continue
+
+        src_obj = src[name]
+        src_addr = _get_addr(src_obj)
+        if src_addr in synced:
+            # we already synced this object, just re-create the hard link
+            target = dst.file[synced[src_addr]]
+            if name in dst and isinstance(
+                    dst.get(name, getlink=True), h5py.HardLink) and \
+                    _get_addr(dst[name]) == _get_addr(target):
+                continue
+            if name in dst:
+                del dst[name]
+            dst[name] = target
+            continue
+
+        is_group = isinstance(src_obj, h5py.Group)
+        dst_obj: Optional[h5py.HLObject] = None
+        if name in dst and isinstance(
+                dst.get(name, getlink=True), h5py.HardLink):
+            dst_obj = dst[name]
+            dst_addr = _get_addr(dst_obj)
+            if isinstance(dst_obj, h5py.Group) != is_group or \
+                    claimed.get(dst_addr, src_addr) != src_addr:
+                dst_obj = None
+            else:
+                claimed[dst_addr] = src_addr
+
+        if dst_obj is None:
+            if name in dst:
+                del dst[name]
+            if is_group:
+                # nix accesses items by creation order, so it must be tracked
+                order = src_obj.id.get_create_plist().get_link_creation_order()
+                dst_obj = dst.create_group(name, track_order=bool(order))
+            else:
+                dst.copy(src_obj, name)
+                dst_obj = dst[name]
+            claimed[_get_addr(dst_obj)] = src_addr
+
+            if not is_group:
+                # a new copy is already the same
+                synced[src_addr] = dst_obj.name
+                continue
+
+        synced[src_addr] = dst_obj.name
+        if is_group:
+            _sync_group(src_obj, dst_obj, modified, synced, claimed)
+        elif not _sync_dataset(src_obj, dst_obj, modified):
+            del dst[name]
+            dst.copy(src_obj, name)
+            claimed[_get_addr(dst[name])] = src_addr
+
+
+def sync_h5_file(
+        src_filename: str, dst_filename: str,
+        modified: Optional[Dict[str, int]] = None):
+    """Updates the h5 file ``dst_filename`` in place so it contains the same
+    data as ``src_filename``.
+
+    ``dst_filename`` must have been a copy of ``src_filename`` at some point,
+    and all the nix data arrays whose data changed since then must be listed
+    in ``modified``. Otherwise, changes to large datasets may be missed.
+
+    :param src_filename: The h5 file to copy from.
+    :param dst_filename: The existing h5 file to update.
+    :param modified: A dict mapping the nix entity ID of each data array that
+        changed since ``dst_filename`` was last synced with ``src_filename``,
+        to the index of the first item that changed.
+    """
+    modified = modified or {}
+    with h5py.File(src_filename, 'r') as src:
+        with h5py.File(dst_filename, 'r+') as dst:
+            _sync_group(src, dst, modified, {_get_addr(src): '/'}, {})
@@ -131,3 +131,34 @@ async def test_code_data_in_gui(
 
         check_metadata(analysis, video_filename=str(sample_video_file.name))
         check_channel_data(analysis)
+
+
+async def test_open_legacy_file(glitter_app: Glitter2TestApp, tmp_path):
+    import nixio
+    from glitter2.storage.data_file import DataFile
+
+    # a file created before pixels_per_meter was added needs an upgrade
+    filename = str(tmp_path / 'legacy.h5')
+    nix_file = nixio.File.open(filename, nixio.FileMode.Overwrite)
+    try:
+        DataFile(nix_file=nix_file).init_new_file()
+        del nix_file.sections['data_config']['pixels_per_meter']
+    finally:
+        nix_file.close()
+
+    storage = glitter_app.storage_controller
+    storage.open_file(filename)
+    await glitter_app.wait_clock_frames(2)
+
+    # the upgrade was written to the autosave file, not the opened file
+    assert storage.data_file.pixels_per_meter == 0
+    assert Path(storage.nix_file._h5file.filename) == Path(
+        storage.backup_filename)
+    assert 'pixels_per_meter' in storage.nix_file.sections['data_config']
+
+    storage.close_file(force_remove_autosave=True)
+    nix_file = nixio.File.open(filename, nixio.FileMode.ReadOnly)
+    try:
+        assert 'pixels_per_meter' not in nix_file.sections['data_config']
+    finally:
+        nix_file.close()
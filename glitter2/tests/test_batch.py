@@ -0,0 +1,109 @@
+import json
+import io
+import os
+import sys
+import subprocess
+import pandas as pd
+
+from glitter2.tests.coded_data import channel_names
+
+
+def get_stats_job(coded_data_file, **kwargs):
+    job = {
+        'batch_mode': 'export_stats',
+        'source': str(coded_data_file.parent),
+        'stats_export_path': str(coded_data_file.with_name('stats.xlsx')),
+        'stats': {
+            'computations': [{
+                'channels': [channel_names[0]],
+                'method': 'EventAnalysisChannel.event_count',
+                'compute_key': 'count'}],
+        },
+    }
+    job.update(kwargs)
+    return job
+
+
+def test_batch_export_stats(coded_data_file):
+    from glitter2.batch import run_job
+
+    coded_data_file.with_name('invalid.h5').write_bytes(b'not h5')
+    job = get_stats_job(coded_data_file, num_workers=2)
+
+    out = io.StringIO()
+    assert run_job(job, out=out) == 1
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert lines[0]['event'] == 'start'
+    assert lines[0]['num_files'] == 2
+
+    processed = {
+        os.path.basename(line['filename']): line['status']
+        for line in lines if line['event'] == 'processed'}
+    assert processed == {'invalid.h5': 'failed', 'video.h5': 'done'}
+
+    summary = lines[-1]
+    assert summary['event'] == 'summary'
+    assert summary['processed'] == 1
+    assert summary['failed'] == 1
+    assert summary['exit_code'] == 1
+
+    df = pd.read_excel(job['stats_export_path'], sheet_name='statistics')
+    assert df['measure_key'].to_list() == ['count']
+    assert df['value'].to_list() == [12]
+
+
+def test_batch_cli(coded_data_file):
+    job_file = coded_data_file.with_name('job.json')
+    job_file.write_text(json.dumps(get_stats_job(coded_data_file)))
+
+    res = subprocess.run(
+        [sys.executable, '-m', 'glitter2.batch', str(job_file)],
+        stdout=subprocess.PIPE, check=False)
+    assert res.returncode == 0
+
+    lines = [json.loads(line) for line in res.stdout.decode().splitlines()]
+    assert [line['event'] for line in lines] == [
+        'start', 'running', 'processed', 'summary']
+
+
+def test_batch_invalid_job(coded_data_file):
+    from glitter2.batch import run_job
+
+    out = io.StringIO()
+    job = get_stats_job(coded_data_file, batch_mode='export_everything')
+    assert run_job(job, out=out) == 2
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line['event'] for line in lines] == ['error', 'summary']
+
+
+def test_batch_resume_journal(coded_data_file):
+    from glitter2.batch import run_job
+
+    export_root = coded_data_file.parent / 'raw'
+    job = {
+        'batch_mode': 'export_raw',
+        'source': str(coded_data_file.parent),
+        'root_raw_data_export_path': str(export_root),
+    }
+
+    def run():
+        out = io.StringIO()
+        code = run_job(job, out=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        return code, [line['event'] for line in lines[1:-1]]
+
+    assert run() == (0, ['running', 'processed'])
+    assert (export_root / 'video.xlsx').exists()
+    assert run() == (0, ['previously_done'])
+
+    # the input changed so it's exported again, once the old output is gone
+    os.utime(coded_data_file, ns=(0, 0))
+    assert run() == (1, ['running', 'processed'])
+    os.remove(export_root / 'video.xlsx')
+    assert run() == (0, ['running', 'processed'])
+
+    assert run() == (0, ['previously_done'])
+    job['resume_from_journal'] = False
+    assert run() == (1, ['running', 'processed'])
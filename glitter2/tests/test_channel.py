@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+from glitter2.channel import PosChannel
+
+
+def get_tail_start_index(channel, timestamps, i, tail_length):
+    tail_start = timestamps[i] - tail_length
+    s = PosChannel._get_tail_start_index(channel, timestamps, i, tail_start)
+
+    assert s == np.searchsorted(timestamps[:i + 1], tail_start)
+    return s
+
+
+@pytest.fixture
+def timestamps():
+    # uneven frame durations
+    return np.cumsum(np.random.RandomState(0).uniform(.01, .1, 500))
+
+
+@pytest.mark.parametrize('tail_length', [0, .05, 1, 100])
+def test_tail_start_sequential(timestamps, tail_length):
+    channel = SimpleNamespace(_tail_window=None)
+    for i in range(len(timestamps)):
+        get_tail_start_index(channel, timestamps, i, tail_length)
+
+
+def test_tail_start_seek_backwards(timestamps):
+    channel = SimpleNamespace(_tail_window=None)
+    for i in range(300):
+        get_tail_start_index(channel, timestamps, i, 1)
+
+    for i in (299, 250, 100, 101, 102, 0, 1):
+        get_tail_start_index(channel, timestamps, i, 1)
+
+
+def test_tail_start_jump_forward(timestamps):
+    channel = SimpleNamespace(_tail_window=None)
+    for i in range(100):
+        get_tail_start_index(channel, timestamps, i, 1)
+
+    # skipping a frame stays in the window, past it the window is reset
+    for i in (101, 103, 106, 200, 201, 499):
+        get_tail_start_index(channel, timestamps, i, 1)
+
+
+def test_tail_start_change_length(timestamps):
+    channel = SimpleNamespace(_tail_window=None)
+    lengths = [1, 1, .5, .5, 2, 2, 0, 0, 10, .2]
+    for i in range(200):
+        get_tail_start_index(channel, timestamps, i, lengths[i % len(lengths)])
+
+
+def test_tail_start_other_interval(timestamps):
+    channel = SimpleNamespace(_tail_window=None)
+    for i in range(100):
+        get_tail_start_index(channel, timestamps, i, 1)
+
+    # a different interval of timestamps, e.g. after seeking
+    other = timestamps[200:]
+    for i in range(100, 110):
+        get_tail_start_index(channel, other, i, 1)
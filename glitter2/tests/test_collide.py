@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from glitter2.analysis.collide import zone_collider_from_state, \
+    collide_any_zone
+
+
+def get_shape(cls_name):
+    from kivy_garden.painter import PaintCircle, PaintEllipse, \
+        PaintPolygon, PaintPoint
+
+    if cls_name == 'PaintCircle':
+        return PaintCircle.create_shape(center=(40.5, 52.25), radius=31.3)
+    if cls_name == 'PaintEllipse':
+        return PaintEllipse.create_shape(
+            center=(51.5, 43.), radius_x=37.1, radius_y=12.6, angle=.7)
+    if cls_name == 'PaintPoint':
+        return PaintPoint.create_shape(position=(30.5, 30.))
+    if cls_name == 'PaintPolygon':
+        # concave with corners both on and off the pixel grid
+        return PaintPolygon.create_shape(points=[
+            10., 10., 60., 12.5, 35.3, 35., 80., 80., 20., 64.2, 40., 40.])
+    assert False
+
+
+@pytest.mark.parametrize(
+    'cls_name', ['PaintCircle', 'PaintEllipse', 'PaintPoint', 'PaintPolygon'])
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_zone_collider_matches_shape_collider(cls_name, prefilter):
+    from glitter2.analysis import ZoneAnalysisChannel
+
+    shape = get_shape(cls_name)
+    rng = np.random.default_rng(0)
+    points = np.concatenate([
+        rng.uniform(0, 100, (5000, 2)),
+        # points on the pixel grid and half grid hit the edges
+        np.round(rng.uniform(0, 100, (5000, 2)) * 2) / 2])
+
+    collider = ZoneAnalysisChannel.collider_from_shape(shape)
+    expected = np.array(collider.collide_points(points.tolist()), dtype=bool)
+
+    zone_collider = zone_collider_from_state(shape.get_state())
+    result = zone_collider.collide_points(points, prefilter=prefilter)
+    assert result.dtype == np.bool_
+    assert expected.any()
+    assert result.tolist() == expected.tolist()
+
+
+def test_collide_any_zone():
+    circle = zone_collider_from_state(
+        {'cls': 'PaintCircle', 'center': [10, 10], 'radius': 5})
+    polygon = zone_collider_from_state(
+        {'cls': 'PaintPolygon', 'points': [20, 0, 30, 0, 30, 10, 20, 10]})
+
+    points = np.array([[10, 12], [25, 5], [17, 5], [10, 5], [50, 50]])
+    assert collide_any_zone(points, [circle, polygon]).tolist() == [
+        True, True, False, True, False]
+    assert collide_any_zone(points, []).tolist() == [False] * 5
+    assert collide_any_zone(np.empty((0, 2)), [circle]).tolist() == []
+
+
+def test_unknown_zone_shape():
+    with pytest.raises(ValueError):
+        zone_collider_from_state({'cls': 'PaintSquare'})
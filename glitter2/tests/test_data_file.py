@@ -1,5 +1,9 @@
+import pytest
+import numpy as np
+import nixio
 
-from glitter2.storage.data_file import DataFile
+from glitter2.storage.data_file import DataFile, TimestampIndex, \
+    MetadataSection, SparseFrameData
 
 
 def test_notify_ends_straight(raw_data_file: DataFile):
@@ -118,3 +122,500 @@ def test_condition_seek(raw_data_file: DataFile):
     assert raw_data_file.notify_add_timestamp(4.) == 0
     assert raw_data_file.condition_timestamp(5.) == 4.
     assert raw_data_file.notify_add_timestamp(4.) == 0
+
+
+def test_timestamps_flushed_in_bulk(raw_data_file: DataFile):
+    assert raw_data_file.notify_add_timestamp(1) == 0
+    raw_data_file.notify_saw_first_timestamp()
+    assert raw_data_file.notify_add_timestamp(2) == 0
+    assert raw_data_file.notify_add_timestamp(3) == 0
+
+    # timestamps are buffered until flushed
+    assert not len(raw_data_file.timestamps)
+    assert raw_data_file.timestamps_buffers[0].array.tolist() == [1, 2, 3]
+    assert raw_data_file.is_end_timestamp(3)
+    assert not raw_data_file.is_end_timestamp(2)
+
+    # seeking doesn't write the timestamps, only flushing does
+    raw_data_file.notify_interrupt_timestamps()
+    assert not len(raw_data_file.timestamps)
+    raw_data_file.flush()
+    assert list(raw_data_file.timestamps) == [1, 2, 3]
+
+    assert raw_data_file.notify_add_timestamp(5) == 1
+    assert raw_data_file.notify_add_timestamp(6) == 1
+    assert not len(raw_data_file.timestamps_arrays[1])
+
+    raw_data_file.notify_interrupt_timestamps()
+    assert raw_data_file.notify_add_timestamp(3) == 0
+    assert raw_data_file.notify_add_timestamp(4) == 0
+    assert raw_data_file.notify_add_timestamp(5) == 0
+
+    # merging the intervals is only written to the file when flushed
+    assert list(raw_data_file.timestamps_arrays) == [0]
+    block = raw_data_file.nix_file.blocks['timestamps']
+    assert len(block.data_arrays) == 2
+    assert list(raw_data_file.timestamps) == [1, 2, 3]
+
+    raw_data_file.flush()
+    assert len(block.data_arrays) == 1
+    assert list(raw_data_file.timestamps) == [1, 2, 3, 4, 5, 6]
+
+
+def test_channel_data_flushed_in_bulk(raw_data_file: DataFile):
+    event = raw_data_file.create_channel('event')
+    pos = raw_data_file.create_channel('pos')
+
+    for i, t in enumerate(range(1, 6)):
+        raw_data_file.notify_add_timestamp(t)
+        if not i:
+            raw_data_file.notify_saw_first_timestamp()
+        event.set_timestamp_value(t, bool(i % 2))
+        pos.set_timestamp_value(t, (t, 2 * t))
+
+    # values are served from memory, nothing was written yet
+    assert not len(event.data_array)
+    assert not len(pos.data_array)
+    assert event.get_timestamp_value(2)
+    assert pos.get_timestamp_value(3) == (3, 6)
+
+    raw_data_file.notify_saw_last_timestamp()
+    assert list(event.data_array) == [0, 1, 0, 1, 0]
+    assert pos.data_array[:, 1].tolist() == [2, 4, 6, 8, 10]
+
+    event.set_timestamp_value(1, True)
+    event.set_timestamp_value(5, True)
+    pos.set_timestamp_value(4, (-1, -1))
+    assert list(event.data_array) == [0, 1, 0, 1, 0]
+
+    raw_data_file.flush()
+    assert list(event.data_array) == [1, 1, 0, 1, 1]
+    assert pos.data_array[3, :].tolist() == [-1, -1]
+
+
+def test_timestamp_index():
+    index = TimestampIndex.from_arrays(
+        {0: np.array([1., 2., 3.]), 3: np.array([5., 6.])})
+    index.merge_threshold = 2
+
+    assert len(index) == 5
+    assert index[2.] == (0, 1)
+    assert index[6.] == (3, 1)
+    assert 4. not in index
+    with pytest.raises(KeyError):
+        _ = index[4.]
+
+    index[4.] = 0, 3
+    assert 4. in index
+    assert index[4.] == (0, 3)
+    index[0.5] = 7, 0
+    assert list(index) == [.5, 1., 2., 3., 4., 5., 6.]
+
+    index.relabel_key(3, 0, 4)
+    assert index[5.] == (0, 4)
+    assert index[6.] == (0, 5)
+    assert dict(index.items())[.5] == (7, 0)
+
+
+def test_condition_timestamps(raw_data_file: DataFile):
+    times = np.linspace(0, 6, 61)
+    np.testing.assert_array_equal(
+        raw_data_file.condition_timestamps(times), times)
+
+    def check():
+        expected = [raw_data_file.condition_timestamp(t) for t in times]
+        expected = [np.nan if t is None else t for t in expected]
+        np.testing.assert_array_equal(
+            raw_data_file.condition_timestamps(times), expected)
+
+    raw_data_file.notify_add_timestamp(1)
+    raw_data_file.notify_saw_first_timestamp()
+    raw_data_file.notify_add_timestamp(2)
+    check()
+
+    raw_data_file.notify_interrupt_timestamps()
+    raw_data_file.notify_add_timestamp(3)
+    raw_data_file.notify_add_timestamp(3.5)
+    raw_data_file.notify_add_timestamp(4)
+    check()
+
+    raw_data_file.notify_saw_last_timestamp()
+    check()
+
+
+def test_flush_snapshot(raw_data_file: DataFile):
+    event = raw_data_file.create_channel('event')
+    accessed = []
+    raw_data_file.file_access_callback = lambda: accessed.append(True)
+
+    raw_data_file.notify_add_timestamp(1)
+    raw_data_file.notify_saw_first_timestamp()
+    accessed.clear()
+    raw_data_file.notify_add_timestamp(2)
+    event.set_timestamp_value(1, True)
+
+    # taking the snapshot doesn't touch the file
+    snapshot = raw_data_file.get_flush_snapshot()
+    assert not accessed
+    assert not raw_data_file.get_flush_snapshot()
+
+    # later changes are not part of the snapshot
+    event.set_timestamp_value(2, True)
+    raw_data_file.write_flush_snapshot(snapshot)
+    assert list(raw_data_file.timestamps) == [1, 2]
+    assert list(event.data_array) == [1, 0]
+
+    raw_data_file.flush()
+    assert accessed
+    assert list(event.data_array) == [1, 1]
+
+
+@pytest.mark.parametrize('in_place', [True, False])
+def test_flush_snapshot_failed(raw_data_file: DataFile, monkeypatch, in_place):
+    event = raw_data_file.create_channel('event')
+    raw_data_file.notify_add_timestamp(1)
+    raw_data_file.notify_saw_first_timestamp()
+    raw_data_file.notify_add_timestamp(2)
+    if in_place:
+        raw_data_file.flush()
+    event.set_timestamp_value(1, True)
+    raw_data_file.notify_add_timestamp(3)
+    event.set_timestamp_value(3, True)
+
+    setitem = nixio.DataArray.__setitem__
+
+    def failing_setitem(self, index, value):
+        if self.name == event.data_array.name:
+            raise OSError('write failed')
+        setitem(self, index, value)
+
+    monkeypatch.setattr(nixio.DataArray, '__setitem__', failing_setitem)
+    snapshot = raw_data_file.get_flush_snapshot()
+    with pytest.raises(OSError):
+        raw_data_file.write_flush_snapshot(snapshot)
+    assert snapshot
+    raw_data_file.restore_flush_snapshot(snapshot)
+
+    # the failed data is still written with the next flush
+    with pytest.raises(OSError):
+        raw_data_file.flush()
+    monkeypatch.setattr(nixio.DataArray, '__setitem__', setitem)
+
+    raw_data_file.flush()
+    assert list(raw_data_file.timestamps) == [1, 2, 3]
+    assert list(event.data_array) == [1, 0, 1]
+    assert not raw_data_file.get_flush_snapshot()
+
+
+def test_metadata_cached(raw_data_file: DataFile):
+    zone = raw_data_file.create_channel('zone')
+    zone.channel_config_dict = {'name': 'zone', 'shape_config': {'x': [1, 2]}}
+
+    accessed = []
+    raw_data_file.file_access_callback = lambda: accessed.append(True)
+    metadata = zone.channel_config_dict
+    assert metadata == {'name': 'zone', 'shape_config': {'x': [1, 2]}}
+    assert not accessed
+
+    # changing the returned dict doesn't change the cache
+    metadata['shape_config']['x'].append(3)
+    assert zone.channel_config_dict['shape_config'] == {'x': [1, 2]}
+
+    zone.channel_config_dict = {'name': 'zone2'}
+    assert zone.metadata['name'] == "zone2\n...\n"
+    assert zone.channel_config_dict == {
+        'name': 'zone2', 'shape_config': {'x': [1, 2]}}
+
+
+def test_metadata_compact(sample_video_file):
+    data_filename = str(sample_video_file.with_suffix('.h5'))
+    nix_file = nixio.File.open(data_filename, nixio.FileMode.Overwrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.compact_metadata = True
+        data_file.init_new_file()
+        data_file.app_config_dict = {'app': {'value': 1}}
+        data_file.video_metadata_dict = {'src_pix_fmt': b'yuv420p'}
+        event = data_file.create_channel('event')
+        event.channel_config_dict = {'name': 'event'}
+
+        assert [p.name for p in event.metadata.props] == [
+            MetadataSection.compact_name]
+    finally:
+        nix_file.close()
+
+    nix_file = nixio.File.open(data_filename, nixio.FileMode.ReadOnly)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.open_file()
+        assert data_file.app_config_dict == {'app': {'value': 1}}
+        assert data_file.video_metadata_dict == {'src_pix_fmt': b'yuv420p'}
+        event, = data_file.event_channels.values()
+        assert event.channel_config_dict == {'name': 'event'}
+    finally:
+        nix_file.close()
+
+
+def test_event_runs_storage(tmp_path):
+    filename = str(tmp_path / 'runs.h5')
+    nix_file = nixio.File.open(filename, nixio.FileMode.Overwrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.event_runs_storage = True
+        data_file.init_new_file()
+        event = data_file.create_channel('event')
+        event.channel_config_dict = {'name': 'event'}
+        assert event.runs_storage
+
+        for t in range(6):
+            data_file.notify_add_timestamp(t)
+            if not t:
+                data_file.notify_saw_first_timestamp()
+            event.set_timestamp_value(t, t in (1, 2, 4))
+        data_file.notify_interrupt_timestamps()
+        for t in range(8, 10):
+            data_file.notify_add_timestamp(t)
+            event.set_timestamp_value(t, True)
+        data_file.notify_saw_last_timestamp()
+        data_file.flush()
+
+        assert event.data_array.type == 'event_runs'
+        assert np.asarray(event.data_array).tolist() == [[1, 3], [4, 5]]
+        assert event.get_runs(1).tolist() == [[0, 2]]
+
+        # merging adds the runs of the second interval
+        data_file.notify_interrupt_timestamps()
+        for t in range(5, 10):
+            data_file.notify_add_timestamp(t)
+        event.set_timestamp_value(4, False)
+        data_file.flush()
+        assert data_file.saw_all_timestamps
+        assert np.asarray(event.data_array).tolist() == [[1, 3], [8, 10]]
+    finally:
+        nix_file.close()
+
+    nix_file = nixio.File.open(filename, nixio.FileMode.ReadOnly)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.open_file()
+        event, = data_file.event_channels.values()
+        assert event.runs_storage
+        # the dense data is only created when needed
+        assert event.get_runs(0).tolist() == [[1, 3], [8, 10]]
+        assert event._pending_runs
+        assert [event.get_timestamp_value(t) for t in range(10)] == [
+            False, True, True, False, False, False, False, False, True, True]
+        assert not event._pending_runs
+    finally:
+        nix_file.close()
+
+    from glitter2.analysis import FileDataAnalysis
+    with FileDataAnalysis(filename=filename) as analysis:
+        analysis.load_file_data()
+        assert analysis.event_channels_data['event'].tolist() == [
+            0, 1, 1, 0, 0, 0, 0, 0, 1, 1]
+
+
+def test_sparse_frame_data():
+    data = SparseFrameData(np.array([-1., -1.]), size=5)
+    data.set_value(3, (3., 4.))
+    data.set_value(1, (1., 2.))
+    data.set_value(4, (-1, -1))
+    assert data.indices.tolist() == [1, 3]
+    assert np.asarray(data).tolist() == [
+        [-1, -1], [1, 2], [-1, -1], [3, 4], [-1, -1]]
+    assert data[1:4, 0].tolist() == [1, -1, 3]
+    assert data[-2].tolist() == [3, 4]
+
+    data.set_value(1, (-1, -1))
+    assert data.indices.tolist() == [3]
+    data.extend(SparseFrameData.from_dense(
+        np.array([[5., 6.], [-1., -1.]]), np.array([-1., -1.])))
+    assert data.size == 7
+    assert data.to_array().tolist() == [[3, 3, 4], [5, 5, 6]]
+    assert SparseFrameData.from_array(
+        data.to_array(), data.default, 7)[:].tolist() == data[:].tolist()
+
+
+def test_pos_sparse_storage(tmp_path):
+    filename = str(tmp_path / 'sparse.h5')
+    nix_file = nixio.File.open(filename, nixio.FileMode.Overwrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.pos_sparse_storage = True
+        data_file.init_new_file()
+        pos = data_file.create_channel('pos')
+        pos.channel_config_dict = {'name': 'pos'}
+        assert pos.sparse_storage
+
+        for t in range(6):
+            data_file.notify_add_timestamp(t)
+            if not t:
+                data_file.notify_saw_first_timestamp()
+            if t in (1, 2):
+                pos.set_timestamp_value(t, (t, 10 * t))
+        data_file.notify_interrupt_timestamps()
+        for t in range(8, 10):
+            data_file.notify_add_timestamp(t)
+        pos.set_timestamp_value(9, (9, 90))
+        data_file.notify_saw_last_timestamp()
+        data_file.flush()
+
+        assert pos.data_array.type == 'pos_sparse'
+        assert np.asarray(pos.data_array).tolist() == [
+            [1, 1, 10], [2, 2, 20]]
+        assert pos.get_timestamp_value(2) == (2, 20)
+        assert pos.get_timestamp_value(3) == (-1, -1)
+        timestamps, data, i = pos.get_previous_timestamp_data(3)
+        assert np.array(data[:i + 1, :]).tolist() == [
+            [-1, -1], [1, 10], [2, 20]]
+
+        # merging the intervals
+        data_file.notify_interrupt_timestamps()
+        for t in range(5, 10):
+            data_file.notify_add_timestamp(t)
+        data_file.flush()
+        assert data_file.saw_all_timestamps
+        assert np.asarray(pos.data_array).tolist() == [
+            [1, 1, 10], [2, 2, 20], [9, 9, 90]]
+        assert pos.sparse_buffers
+    finally:
+        nix_file.close()
+
+    nix_file = nixio.File.open(filename, nixio.FileMode.ReadWrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.open_file()
+        pos, = data_file.pos_channels.values()
+        assert pos.sparse_storage
+        assert pos.get_timestamp_value(9) == (9, 90)
+        modified = pos.get_timestamps_modified_state()
+        assert [t for t, value in modified.items() if value] == [1, 2, 9]
+
+        # the dense view is created when needed and the data still flushed
+        assert pos.data_buffers[0].array[:3, 0].tolist() == [-1, 1, 2]
+        assert not pos.sparse_buffers
+        pos.set_timestamp_value(1, (-1, -1))
+        data_file.flush()
+        assert np.asarray(pos.data_array).tolist() == [
+            [2, 2, 20], [9, 9, 90]]
+    finally:
+        nix_file.close()
+
+    from glitter2.analysis import FileDataAnalysis
+    with FileDataAnalysis(filename=filename) as analysis:
+        analysis.load_file_data()
+        assert analysis.pos_channels_data['pos'][:, 0].tolist() == [
+            -1, -1, 2, -1, -1, -1, -1, -1, -1, 9]
+
+
+def test_virtual_padding(tmp_path):
+    filename = str(tmp_path / 'padding.h5')
+    nix_file = nixio.File.open(filename, nixio.FileMode.Overwrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.init_new_file()
+        event = data_file.create_channel('event')
+        event.channel_config_dict = {'name': 'event'}
+        pos = data_file.create_channel('pos')
+        pos.channel_config_dict = {'name': 'pos'}
+
+        for t in range(4):
+            data_file.notify_add_timestamp(t)
+            if not t:
+                data_file.notify_saw_first_timestamp()
+        event.set_timestamp_value(1, True)
+        data_file.notify_interrupt_timestamps()
+        for t in range(6, 9):
+            data_file.notify_add_timestamp(t)
+        data_file.notify_interrupt_timestamps()
+        data_file.notify_saw_last_timestamp()
+
+        # seeking doesn't pad the channels that were not changed
+        assert len(event.data_buffers[0]) == 4
+        assert not len(pos.data_buffers[0])
+        assert not len(pos.data_array)
+        assert pos.get_num_frames(0) == 4
+        assert pos.get_timestamp_value(2) == (-1, -1)
+        assert not event.get_timestamp_value(7)
+
+        # merging pads the first interval so the second follows it
+        for t in range(3, 7):
+            data_file.notify_add_timestamp(t)
+        assert data_file.saw_all_timestamps
+        pos.set_timestamp_value(8, (8, 8))
+        data_file.flush()
+        assert list(event.data_array) == [0, 1, 0, 0, 0, 0]
+        assert np.asarray(pos.data_array)[:, 0].tolist() == [-1] * 8 + [8]
+    finally:
+        nix_file.close()
+
+    from glitter2.analysis import FileDataAnalysis
+    with FileDataAnalysis(filename=filename) as analysis:
+        analysis.load_file_data()
+        assert analysis.event_channels_data['event'].tolist() == [
+            0, 1, 0, 0, 0, 0, 0, 0, 0]
+
+    nix_file = nixio.File.open(filename, nixio.FileMode.ReadWrite)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.open_file()
+        event, = data_file.event_channels.values()
+        data_file.pad_all_channels_to_num_frames()
+        data_file.flush()
+        assert list(event.data_array) == [0, 1, 0, 0, 0, 0, 0, 0, 0]
+    finally:
+        nix_file.close()
+
+
+def test_merge_deferred(raw_data_file: DataFile):
+    event = raw_data_file.create_channel('event')
+    pos = raw_data_file.create_channel('pos')
+    raw_data_file.notify_add_timestamp(1)
+    raw_data_file.notify_saw_first_timestamp()
+    raw_data_file.notify_add_timestamp(2)
+    raw_data_file.notify_interrupt_timestamps()
+    raw_data_file.notify_add_timestamp(4)
+    event.set_timestamp_value(4, True)
+    raw_data_file.notify_interrupt_timestamps()
+    raw_data_file.notify_add_timestamp(2)
+    assert len(event.block.data_arrays) == 2
+
+    accessed = []
+    raw_data_file.file_access_callback = lambda: accessed.append(True)
+    assert raw_data_file.notify_add_timestamp(3) == 0
+    assert raw_data_file.notify_add_timestamp(4) == 0
+    assert not accessed
+    assert event.get_timestamp_value(4)
+    assert list(event.data_buffers) == [0]
+
+    # the deleted channel's pending arrays are not deleted again
+    raw_data_file.delete_channel(pos.num)
+    snapshot = raw_data_file.get_flush_snapshot()
+    raw_data_file.write_flush_snapshot(snapshot)
+    assert len(event.block.data_arrays) == 1
+    assert list(event.data_array) == [0, 0, 0, 1]
+    assert list(raw_data_file.timestamps) == [1, 2, 3, 4]
+
+
+def test_timestamp_intervals_ordered(raw_data_file: DataFile):
+    rng = np.random.default_rng(0)
+    raw_data_file.notify_add_timestamp(0)
+    raw_data_file.notify_saw_first_timestamp()
+    # play short stretches of the first 100 frames, seeking in between
+    for _ in range(60):
+        raw_data_file.notify_interrupt_timestamps()
+        start = int(rng.integers(0, 95))
+        for t in range(start, start + int(rng.integers(1, 6))):
+            n = raw_data_file.notify_add_timestamp(t)
+            assert raw_data_file.timestamp_intervals_ordered_keys[
+                raw_data_file._last_timestamps_ordered_index] == n
+
+        keys = list(raw_data_file.timestamp_intervals_ordered_keys)
+        starts = list(raw_data_file.timestamp_intervals_start)
+        ends = list(raw_data_file.timestamp_intervals_end)
+        raw_data_file._populate_timestamp_intervals()
+        assert keys == raw_data_file.timestamp_intervals_ordered_keys
+        assert starts == raw_data_file.timestamp_intervals_start
+        assert ends == raw_data_file.timestamp_intervals_end
+    assert len(keys) < 60
@@ -1,7 +1,14 @@
+import gc
+import weakref
 
-from glitter2.analysis import FileDataAnalysis
+import h5py
+import pytest
+import numpy as np
+
+from glitter2.analysis import FileDataAnalysis, AnalysisSpec, \
+    EventAnalysisChannel, PosAnalysisChannel
 from glitter2.tests.coded_data import check_metadata, check_channel_metadata, \
-    check_channel_data
+    check_channel_data, channel_names
 
 
 def test_metadata(coded_data_file):
@@ -27,3 +34,190 @@ def test_channel_data(coded_data_file):
 
         check_channel_data(analysis, first_timestamp_repeated=True)
     check_channel_data(analysis, first_timestamp_repeated=True)
+
+
+def test_channel_data_lazy(coded_data_file):
+    analysis = FileDataAnalysis(filename=str(coded_data_file))
+    with analysis:
+        analysis.load_file_data(lazy=True)
+
+        event_data = analysis.event_channels_data
+        pos_data = analysis.pos_channels_data
+        assert not event_data.is_loaded(channel_names[0])
+        assert not pos_data.is_loaded(channel_names[1])
+
+        event_data[channel_names[0]]
+        assert event_data.is_loaded(channel_names[0])
+        assert not pos_data.is_loaded(channel_names[1])
+
+        check_channel_data(analysis, first_timestamp_repeated=True)
+    check_channel_data(analysis, first_timestamp_repeated=True)
+
+
+def test_channel_data_subset(coded_data_file):
+    analysis = FileDataAnalysis(filename=str(coded_data_file))
+    with analysis:
+        analysis.load_file_data({channel_names[0].upper()}, lazy=True)
+
+    assert list(analysis.channels_metadata) == [channel_names[0]]
+    assert list(analysis.event_channels_data) == [channel_names[0]]
+    assert not analysis.pos_channels_data
+    assert not analysis.zone_channels_shapes
+
+
+def test_channel_data_memmap(coded_data_file):
+    # rewrite the event data as a contiguous uncompressed dataset
+    with FileDataAnalysis(filename=str(coded_data_file)) as analysis:
+        analysis.load_file_metadata()
+        channel, = analysis.data_file.event_channels.values()
+        name = channel.data_arrays[0]._h5group.group['data'].name
+
+    with h5py.File(str(coded_data_file), 'r+') as f:
+        dataset = f[name]
+        data = dataset[()]
+        attrs = dict(dataset.attrs)
+        del f[name]
+        dataset = f.create_dataset(name, data=data)
+        dataset.attrs.update(attrs)
+
+    # it's only mapped when requested
+    with FileDataAnalysis(filename=str(coded_data_file)) as analysis:
+        analysis.load_file_data(lazy=True)
+        event = analysis.event_channels_data[channel_names[0]]
+        assert not isinstance(event, np.memmap)
+
+    analysis = FileDataAnalysis(filename=str(coded_data_file))
+    with analysis:
+        analysis.load_file_data(lazy=True, memmap=True)
+
+        event = analysis.event_channels_data[channel_names[0]]
+        assert isinstance(event, np.memmap)
+        assert not isinstance(
+            analysis.pos_channels_data[channel_names[1]], np.memmap)
+
+        check_channel_data(analysis, first_timestamp_repeated=True)
+        event_ref = weakref.ref(event)
+        del event
+
+    # closing releases the mapped data
+    assert analysis.event_channels_data[channel_names[0]] is None
+    assert analysis.pos_channels_data[channel_names[1]] is not None
+    gc.collect()
+    assert event_ref() is None
+
+
+def test_spec_required_channels():
+    spec = AnalysisSpec()
+    assert spec.get_required_channels() == set()
+
+    spec.add_new_channel_computation(
+        channel_names[1], 'in circle',
+        PosAnalysisChannel.compute_pos_in_any_zone,
+        zone_channels=[channel_names[2]])
+    spec.add_computation(
+        ['in circle', channel_names[0]],
+        EventAnalysisChannel.compute_active_duration)
+    assert spec.get_required_channels() == set(channel_names)
+
+    spec.add_computation([], PosAnalysisChannel.compute_mean_speed)
+    assert spec.get_required_channels() is None
+
+
+def test_spec_compute_plan(coded_data_file):
+    spec = AnalysisSpec()
+    spec.add_arg_default(PosAnalysisChannel, 'end', 8.)
+    windows = [{}, {'start': 2.}, {'start': 1., 'end': 6.}]
+    methods = [
+        EventAnalysisChannel.compute_active_duration,
+        EventAnalysisChannel.compute_event_count,
+        PosAnalysisChannel.compute_mean_speed,
+        PosAnalysisChannel.compute_distance_traveled,
+    ]
+    for kwargs in windows:
+        for method in methods:
+            spec.add_computation([], method, **kwargs)
+        spec.add_computation(
+            [channel_names[1]], PosAnalysisChannel.compute_distance_traveled,
+            event_channel=channel_names[0], **kwargs)
+
+    plan = spec.get_compute_plan()
+    assert [item[-1] for item in plan[:5]] == [
+        (None, None), (None, None), (None, None, 8.), (None, None, 8.),
+        (channel_names[0], None, 8.)]
+    assert spec.get_compute_plan() is plan
+
+    analysis = FileDataAnalysis(filename=str(coded_data_file))
+    with analysis:
+        analysis.load_file_data()
+    output = spec.compute(analysis)
+
+    # compute each item separately on a new channel
+    expected = []
+    for channels, compute_key, cls, method_name, args, kwargs in \
+            spec._computations:
+        channels = channels or list(getattr(
+            analysis, f'{cls.analysis_type}_channels_data'))
+        for channel in channels:
+            obj = cls(name=channel, analysis_object=analysis)
+            if cls is PosAnalysisChannel:
+                obj.end = 8.
+            res = getattr(obj, method_name)(*args, **kwargs)
+            expected.append((
+                cls.analysis_type, channel, method_name[8:], compute_key,
+                res))
+
+    assert [item[:4] for item in output] == [item[:4] for item in expected]
+    for item, expected_item in zip(output, expected):
+        assert item[4] == pytest.approx(expected_item[4])
+
+    # the end of the window limits the data
+    durations = [item[4] for item in output if item[2] == 'active_duration']
+    assert durations[2] < durations[0]
+
+
+def test_compute_cache():
+    from glitter2.analysis import ComputeCache, not_cached
+
+    cache = ComputeCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is not_cached
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+def test_channel_compute_cache(coded_data_file):
+    analysis = FileDataAnalysis(filename=str(coded_data_file))
+    with analysis:
+        analysis.load_file_data()
+
+    event = EventAnalysisChannel(
+        name=channel_names[0], analysis_object=analysis)
+    windows = [(None, None), (1., 5.), (2., None)]
+    durations = [event.compute_active_duration(s, e) for s, e in windows]
+    assert event.compute_cache.misses == 3
+    assert [event.compute_active_duration(s, e) for s, e in windows] == \
+        durations
+    assert event.compute_cache.hits == 3
+
+    # the event intervals are shared with a new channel
+    intervals = analysis.active_intervals_cache
+    assert intervals.misses == 3
+    event2 = EventAnalysisChannel(
+        name=channel_names[0].upper(), analysis_object=analysis)
+    assert event2.compute_event_count(1., 5.) == \
+        event.compute_event_count(1., 5.)
+    assert intervals.misses == 3
+
+    pos = PosAnalysisChannel(name=channel_names[1], analysis_object=analysis)
+    pos2 = PosAnalysisChannel(name=channel_names[1], analysis_object=analysis)
+    speed = pos.compute_mean_speed(channel_names[0], 1., 5.)
+    assert pos2.compute_distance_traveled(channel_names[0].lower(), 1., 5.)
+    assert pos2.compute_mean_speed(channel_names[0], 1., 5.) == speed
+    assert intervals.misses == 4
@@ -109,6 +109,102 @@ def test_export_coded_data_stats(coded_data_file):
     assert not data
 
 
+def test_export_stats_parallel(coded_data_file):
+    import os
+    import shutil
+    from glitter2.analysis.export import ExportManager, SourceFile
+    from glitter2.analysis import AnalysisSpec, EventAnalysisChannel
+
+    spec = AnalysisSpec()
+    spec.add_computation(
+        [channel_names[0]], EventAnalysisChannel.compute_event_count)
+
+    names = [f'video_{i}.h5' for i in range(5)]
+    for name in names:
+        shutil.copy(coded_data_file, coded_data_file.with_name(name))
+
+    manager = ExportManager()
+    try:
+        manager.batch_mode = 'export_stats'
+        manager.spec = spec
+        manager.stats_export_path = str(coded_data_file.with_name('s.xlsx'))
+        manager.num_workers = 2
+        manager.source_contents = [
+            SourceFile(
+                filename=coded_data_file.with_name(name),
+                source_root=coded_data_file.parent)
+            for name in names]
+        manager.source_contents[2].skip = True
+        manager.set_src_data_index(set_index=True)
+
+        manager.process_files()
+    finally:
+        manager.stop()
+
+    assert [item.status for item in manager.source_contents] == [
+        'done', 'done', '', 'done', 'done']
+
+    # the summary is in the order of the files, not the order they finished
+    df = pd.read_excel(manager.stats_export_path, sheet_name='statistics')
+    files = [os.path.basename(name) for name in df['data file'].to_list()]
+    assert files == [names[0], names[1], names[3], names[4]]
+    assert df['value'].to_list() == [12] * 4
+
+
+def test_export_stats_resume(coded_data_file):
+    import os
+    import shutil
+    from glitter2.analysis.export import SummeryStatsExporter, SourceFile
+    from glitter2.analysis import AnalysisSpec, EventAnalysisChannel
+
+    spec = AnalysisSpec()
+    spec.add_computation(
+        [channel_names[0]], EventAnalysisChannel.compute_event_count)
+    spec.add_computation(
+        [channel_names[0]], EventAnalysisChannel.compute_event_intervals)
+    second_file = coded_data_file.with_name('video_2.h5')
+    shutil.copy(coded_data_file, second_file)
+    files = [
+        SourceFile(filename=f, source_root=coded_data_file.parent)
+        for f in (coded_data_file, second_file)]
+    excel_file = coded_data_file.with_name('stats.xlsx')
+
+    exporter = SummeryStatsExporter(spec=spec, export_filename=str(excel_file))
+    exporter.init_process()
+    rows = exporter.process_file(files[0], 0)
+    assert files[0].status == 'done'
+    exporter.writer.close()
+    intervals = rows[1][-1]
+    assert isinstance(intervals, list) and intervals
+
+    # simulate a crash while writing the second file
+    csv_file = excel_file.with_suffix('.csv')
+    with open(csv_file, 'ab') as fh:
+        fh.write(b'partial,row')
+    with open(f'{csv_file}.index', 'ab') as fh:
+        fh.write(b'{"index": 1')
+
+    with pytest.raises(ValueError):
+        SummeryStatsExporter(spec=spec, export_filename=str(excel_file))
+
+    # the first file is not read again, and the order is the order of the
+    # files in this run
+    os.remove(coded_data_file)
+    exporter = SummeryStatsExporter(
+        spec=spec, export_filename=str(excel_file), resume=True)
+    exporter.init_process()
+    for i, item in enumerate(files[::-1]):
+        exporter.process_file(item, i)
+        assert item.status == 'done'
+    exporter.finish_process()
+
+    df = pd.read_excel(excel_file, sheet_name='statistics')
+    files = [os.path.basename(name) for name in df['data file'].to_list()]
+    assert files == ['video_2.h5', 'video_2.h5', 'video.h5', 'video.h5']
+    assert df['value'].to_list() == [12, str(intervals)] * 2
+    assert df['missed timestamps'].to_list() == [False] * 4
+
+
 def check_file_metadata(df):
     assert df.columns.to_list() == ['Property', 'Value']
     metadata = {key: value for _, (key, value) in df.iterrows()}
@@ -200,3 +296,62 @@ def test_export_coded_data_raw(coded_data_file, dump_zone_collider):
 
     df_zones = pd.read_excel(excel_file, sheet_name='zone_channels')
     check_zones(df_zones)
+
+
+@pytest.mark.parametrize('export_format', ['npz', 'h5', 'parquet'])
+def test_export_coded_data_raw_columnar(coded_data_file, export_format):
+    import h5py
+    import numpy as np
+    from glitter2.analysis.export import RawDataExporter, SourceFile
+
+    if export_format == 'parquet':
+        pytest.importorskip('pyarrow')
+
+    src = SourceFile(
+        filename=coded_data_file, source_root=coded_data_file.parent)
+    exporter = RawDataExporter(
+        dump_zone_collider=True, export_format=export_format,
+        data_export_root=str(coded_data_file.parent / 'raw'))
+    exporter.init_process()
+    filename = exporter.process_file(src)
+    if src.exception is not None:
+        e, exec_info = src.exception
+        print(exec_info)
+        raise Exception(e)
+    exporter.finish_process()
+
+    x_name = f'{channel_names[1]}:x'
+    zone_name = f'{channel_names[1]}:--:{channel_names[2]}'
+    if export_format == 'npz':
+        with np.load(filename) as f:
+            tables = {key: f[key] for key in f.files}
+    elif export_format == 'h5':
+        with h5py.File(filename, 'r') as f:
+            tables = {}
+            for table in f:
+                for name, dataset in f[table].items():
+                    if h5py.check_string_dtype(dataset.dtype):
+                        dataset = dataset.asstr()
+                    tables[f'{table}/{name}'] = dataset[()]
+            assert list(f['pos_channels']) == [
+                x_name, f'{channel_names[1]}:y', zone_name]
+    else:
+        tables = {}
+        for table in ('file_metadata', 'timestamps', 'pos_channels'):
+            df = pd.read_parquet(filename / f'{table}.parquet')
+            for name in df.columns:
+                tables[f'{table}/{name}'] = df[name].to_numpy()
+
+    timestamps = get_timestamps(first_timestamp_repeated=True)
+    assert get_rounded_list(tables['timestamps/timestamp']) == \
+        get_rounded_list(timestamps)
+
+    pos = get_pos_data(timestamps)
+    assert get_rounded_list(tables[f'pos_channels/{x_name}'], 3) == \
+        get_rounded_list([x for x, y in pos], 3)
+    assert tables[f'pos_channels/{zone_name}'].tolist() == [True] * len(pos)
+
+    metadata = dict(zip(
+        tables['file_metadata/Property'], tables['file_metadata/Value']))
+    assert metadata['filename_tail'] == 'video.mp4'
+    assert eval(metadata['src_vid_size']) == [352, 198]
@@ -0,0 +1,81 @@
+import os
+import pytest
+
+from glitter2.analysis.scan import SourceScanCache, iter_source_files, \
+    parse_match_patterns
+
+
+def create_tree(root):
+    names = [
+        'a.h5', 'b.csv', 'c.txt', 'sub/d.h5', 'sub/e.H5', 'sub/deeper/f.csv',
+        'other/g.h5']
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'1' * len(name))
+    return names
+
+
+def scan(root, match_suffix, **kwargs):
+    files = [f for batch in iter_source_files(root, match_suffix, **kwargs)
+             for f in batch]
+    return {f.filename.relative_to(root).as_posix(): f for f in files}
+
+
+def test_parse_match_patterns():
+    assert parse_match_patterns('*.h5') == ['*.h5']
+    assert parse_match_patterns(' *.h5; *.csv,') == ['*.h5', '*.csv']
+
+
+@pytest.mark.parametrize('num_threads', [0, 3])
+def test_scan(tmp_path, num_threads):
+    create_tree(tmp_path)
+
+    files = scan(tmp_path, '*.h5;*.csv', num_threads=num_threads)
+    expected = {'a.h5', 'b.csv', 'sub/d.h5', 'sub/deeper/f.csv', 'other/g.h5'}
+    if os.path.normcase('A') == 'a':
+        expected.add('sub/e.H5')
+    assert set(files) == expected
+
+    for name, item in files.items():
+        assert item.file_size == len(name)
+        assert item.source_root == tmp_path
+
+    files = scan(
+        tmp_path, '*.h5', num_threads=num_threads,
+        exclude=tmp_path / 'sub' / 'd.h5')
+    assert 'sub/d.h5' not in files
+    assert 'a.h5' in files
+
+
+def test_scan_depth_first_order(tmp_path):
+    create_tree(tmp_path)
+    files = list(scan(tmp_path, '*.h5;*.csv'))
+    # files of a directory are listed before those of its sub-directories
+    assert files.index('sub/d.h5') < files.index('sub/deeper/f.csv')
+
+
+@pytest.mark.parametrize('num_threads', [0, 3])
+def test_scan_cache(tmp_path, num_threads):
+    create_tree(tmp_path)
+    cache = SourceScanCache()
+
+    files = scan(tmp_path, '*.h5', num_threads=num_threads, cache=cache)
+    assert str(tmp_path / 'sub') in cache.directories
+    assert 'sub/d.h5' in files
+
+    # changing a file's size doesn't change the directory, but it's re-stat-ed
+    (tmp_path / 'sub' / 'd.h5').write_bytes(b'12')
+    files = scan(tmp_path, '*.h5', num_threads=num_threads, cache=cache)
+    assert files['sub/d.h5'].file_size == 2
+
+    # the cached listing is used with a different pattern
+    files = scan(tmp_path, '*.csv', num_threads=num_threads, cache=cache)
+    assert set(files) == {'b.csv', 'sub/deeper/f.csv'}
+
+    # a new file changes the directory so it's listed again
+    (tmp_path / 'sub' / 'new.csv').write_bytes(b'1')
+    st = os.stat(tmp_path / 'sub')
+    os.utime(tmp_path / 'sub', ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    files = scan(tmp_path, '*.csv', num_threads=num_threads, cache=cache)
+    assert set(files) == {'b.csv', 'sub/deeper/f.csv', 'sub/new.csv'}
@@ -0,0 +1,93 @@
+import shutil
+import h5py
+import numpy as np
+import nixio
+
+from glitter2.storage.data_file import DataFile
+from glitter2.storage.sync import sync_h5_file
+
+
+def check_same_h5(src, dst):
+    assert dict(src.attrs).keys() == dict(dst.attrs).keys()
+    for name, value in src.attrs.items():
+        assert np.array_equal(value, dst.attrs[name])
+
+    assert sorted(src) == sorted(dst)
+    for name in src:
+        src_obj = src[name]
+        dst_obj = dst[name]
+        if isinstance(src_obj, h5py.Group):
+            assert isinstance(dst_obj, h5py.Group)
+            check_same_h5(src_obj, dst_obj)
+        else:
+            assert isinstance(dst_obj, h5py.Dataset)
+            assert src_obj.dtype == dst_obj.dtype
+            assert np.array_equal(src_obj[()], dst_obj[()])
+
+
+def test_sync_changes(tmp_path):
+    src_filename = str(tmp_path / 'autosave.h5')
+    dst_filename = str(tmp_path / 'saved.h5')
+
+    nix_file = nixio.File.open(src_filename, nixio.FileMode.Overwrite)
+    data_file = DataFile(nix_file=nix_file)
+    data_file.init_new_file()
+    event = data_file.create_channel('event')
+    event.channel_config_dict = {'name': 'event'}
+    pos = data_file.create_channel('pos')
+    pos.channel_config_dict = {'name': 'pos'}
+    zone = data_file.create_channel('zone')
+    zone.channel_config_dict = {'name': 'zone'}
+
+    for t in range(5):
+        data_file.notify_add_timestamp(t)
+        if not t:
+            data_file.notify_saw_first_timestamp()
+        event.set_timestamp_value(t, bool(t % 2))
+    data_file.notify_interrupt_timestamps()
+    data_file.notify_add_timestamp(10)
+    data_file.flush()
+    nix_file.close()
+
+    shutil.copy2(src_filename, dst_filename)
+    data_file.pop_modified_data_arrays()
+
+    nix_file = nixio.File.open(src_filename, nixio.FileMode.ReadWrite)
+    data_file.reopen_file(nix_file)
+    data_file.notify_interrupt_timestamps()
+    for t in range(4, 10):
+        data_file.notify_add_timestamp(t)
+    data_file.notify_add_timestamp(10)
+    data_file.notify_saw_last_timestamp()
+    event.set_timestamp_value(1, False)
+    pos.set_timestamp_value(7, (3, 4))
+    data_file.delete_channel(zone.num)
+    zone = data_file.create_channel('zone')
+    zone.channel_config_dict = {'name': 'zone2'}
+    data_file.flush()
+
+    modified = data_file.pop_modified_data_arrays()
+    assert data_file.timestamps.id in modified
+    nix_file.close()
+
+    sync_h5_file(src_filename, dst_filename, modified)
+    with h5py.File(src_filename, 'r') as src:
+        with h5py.File(dst_filename, 'r') as dst:
+            check_same_h5(src, dst)
+
+    # hard links to the sections must be kept
+    nix_file = nixio.File.open(dst_filename, nixio.FileMode.ReadOnly)
+    try:
+        data_file = DataFile(nix_file=nix_file)
+        data_file.open_file()
+        assert data_file.saw_all_timestamps
+        assert list(data_file.timestamps) == list(range(11))
+        event, = data_file.event_channels.values()
+        assert list(event.data_array)[:5] == [0, 0, 0, 1, 0]
+        pos, = data_file.pos_channels.values()
+        assert pos.data_array[7, :].tolist() == [3, 4]
+        zone, = data_file.zone_channels.values()
+        assert zone.channel_config_dict == {'name': 'zone2'}
+        assert zone.block.metadata.name == zone.metadata.name
+    finally:
+        nix_file.close()
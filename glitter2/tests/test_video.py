@@ -0,0 +1,93 @@
+import math
+import numpy as np
+
+from glitter2.video import open_video_file, iter_video_timestamps, \
+    get_video_file_data, get_videos_file_data, VideoDataCache
+
+
+def test_video_timestamps_chunks(sample_video_file):
+    timestamps, metadata = get_video_file_data(str(sample_video_file))
+    assert len(timestamps) == 250
+    assert np.all(np.diff(timestamps) >= 0)
+    assert metadata['file_size'] == sample_video_file.stat().st_size
+    assert metadata['filename_tail'] == sample_video_file.name
+
+    ffplayer, _ = open_video_file(str(sample_video_file))
+    try:
+        chunks = list(iter_video_timestamps(ffplayer, chunk_size=100))
+    finally:
+        ffplayer.close_player()
+
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
+    np.testing.assert_array_equal(np.concatenate(chunks), timestamps)
+
+
+def test_videos_file_data_parallel(sample_video_file, temp_file):
+    video2 = temp_file('video.mp4')
+    video2.write_bytes(sample_video_file.read_bytes())
+
+    timestamps, _ = get_video_file_data(str(sample_video_file))
+    results = list(get_videos_file_data(
+        [str(sample_video_file), str(video2)], max_workers=2))
+
+    assert len(results) == 2
+    for (ts, metadata), video in zip(results, [sample_video_file, video2]):
+        np.testing.assert_array_equal(ts, timestamps)
+        assert metadata['filename_tail'] == video.name
+
+
+def test_video_data_cache(sample_video_file, tmp_path):
+    cache = VideoDataCache(str(tmp_path / 'cache'))
+    assert cache.get(str(sample_video_file)) is None
+
+    timestamps, metadata = get_video_file_data(
+        str(sample_video_file), cache=cache)
+    cached_timestamps, cached_metadata = cache.get(str(sample_video_file))
+    np.testing.assert_array_equal(cached_timestamps, timestamps)
+    assert cached_metadata == metadata
+
+    _, metadata_only = get_video_file_data(
+        str(sample_video_file), metadata_only=True, cache=cache)
+    assert metadata_only == metadata
+
+    # changing the file invalidates the entry
+    with open(sample_video_file, 'ab') as fh:
+        fh.write(b'\0')
+    assert cache.get(str(sample_video_file)) is None
+
+
+def test_video_data_cache_eviction(tmp_path):
+    cache = VideoDataCache(str(tmp_path / 'cache'), max_size=0)
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'data')
+
+    cache.put(str(video), np.arange(10.), {'file_size': 4})
+    assert cache.get(str(video)) is None
+
+    cache.max_size = 10 * 1024 * 1024
+    cache.put(str(video), np.arange(10.), {'file_size': 4})
+    timestamps, metadata = cache.get(str(video))
+    np.testing.assert_array_equal(timestamps, np.arange(10.))
+    assert metadata == {'file_size': 4}
+
+
+def test_video_data_cache_values(tmp_path):
+    cache = VideoDataCache(str(tmp_path / 'cache'))
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'data')
+
+    metadata = {
+        'duration': float('nan'), 'end': float('inf'),
+        'src_vid_size': (640, 480), 'frame_rate': [(30, 1)], 'codec': None,
+        'src_pix_fmt': b'yuv420p'}
+    cache.put(str(video), np.arange(10.), metadata)
+    _, cached = cache.get(str(video))
+    assert math.isnan(cached.pop('duration'))
+    assert cached == {
+        'end': math.inf, 'src_vid_size': (640, 480),
+        'frame_rate': [(30, 1)], 'codec': None, 'src_pix_fmt': b'yuv420p'}
+
+    # a corrupted cache file is a cache miss
+    with open(cache.get_cache_filename(str(video)), 'wb') as fh:
+        fh.write(b'corrupted')
+    assert cache.get(str(video)) is None
@@ -0,0 +1,352 @@
+"""Video file reading
+=====================
+
+Reads the metadata and frame timestamps of video files, without playing
+them in real time. It does not depend on Kivy, so it can also be used in
+worker processes e.g. with :func:`get_videos_file_data` to read many video
+files in parallel.
+
+Reading the timestamps of a long video requires decoding all its frames, so
+:class:`VideoDataCache` can be used to cache the data on disk for video files
+that are read repeatedly.
+
+E.g. to read the timestamps in chunks as they are read::
+
+    ffplayer, metadata = open_video_file(filename)
+    try:
+        for timestamps in iter_video_timestamps(ffplayer):
+            print(timestamps)
+    finally:
+        ffplayer.close_player()
+"""
+from typing import Tuple, Generator, Iterable, Optional, List
+import time
+import os
+import json
+import hashlib
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from kivy.logger import Logger
+
+from ffpyplayer.player import MediaPlayer
+
+__all__ = (
+    'get_video_metadata', 'open_video_file', 'iter_video_timestamps',
+    'get_video_file_data', 'get_videos_file_data', 'VideoDataCache')
+
+_min_poll_delay = .0005
+"""The initial time to wait for the next frame to be decoded, if it's not
+ready yet.
+"""
+
+_max_poll_delay = .01
+"""The maximum time to wait for the next frame to be decoded, if it's not
+ready yet. We wait between :attr:`_min_poll_delay` and this, doubling the delay
+each time the frame is not ready.
+"""
+
+
+def get_video_metadata(ffplayer: MediaPlayer, filename: str) -> dict:
+    """Returns the metadata from the given media player, adding any
+    additional required metadata.
+
+    :param ffplayer: The ffpyplayer ``MediaPlayer`` that opened the file.
+    :param filename: The filename of the video file.
+    """
+    metadata = ffplayer.get_metadata()
+    filename = os.path.abspath(os.path.expanduser(filename))
+    head, tail = os.path.split(filename)
+    metadata['filename_head'] = head
+    metadata['filename_tail'] = tail
+    metadata['file_size'] = os.stat(filename).st_size
+    return metadata
+
+
+def open_video_file(filename: str) -> Tuple[MediaPlayer, dict]:
+    """Opens the video file for reading its timestamps and returns the player
+    and the video metadata, once the metadata is available.
+
+    The frames are decoded as tiny gray images, because only the timestamps
+    are used. The player must be closed with ``close_player`` when done.
+
+    :param filename: The filename of the video file.
+    :return: A 2-tuple of the ffpyplayer ``MediaPlayer`` and the metadata
+        dict.
+    """
+    filename = os.path.abspath(filename)
+    ff_opts = {
+        'sync': 'video', 'an': True, 'sn': True, 'paused': False, 'x': 4,
+        'y': 4, 'out_fmt': 'gray'}
+    ffplayer = MediaPlayer(filename, ff_opts=ff_opts)
+
+    try:
+        delay = _min_poll_delay
+        while True:
+            metadata = ffplayer.get_metadata()
+            src_vid_size = metadata.get('src_vid_size')
+            duration = metadata.get('duration')
+            src_fmt = metadata.get('src_pix_fmt')
+
+            # only get out of opening when we have the metadata
+            if duration and src_vid_size[0] and src_vid_size[1] and src_fmt:
+                return ffplayer, get_video_metadata(ffplayer, filename)
+
+            time.sleep(delay)
+            delay = min(2 * delay, _max_poll_delay)
+    except BaseException:
+        ffplayer.close_player()
+        raise
+
+
+def iter_video_timestamps(
+        ffplayer: MediaPlayer, chunk_size: int = 1024
+) -> Generator[np.ndarray, None, None]:
+    """Generator that reads all the remaining frames of the video opened
+    with :func:`open_video_file` and yields their timestamps in chunks.
+
+    Frames are read as soon as they are decoded, rather than at the video's
+    play rate. If the next frame is not yet ready, we wait a short time that
+    grows the longer the frame is not ready.
+
+    :param ffplayer: The ffpyplayer ``MediaPlayer`` returned by
+        :func:`open_video_file`.
+    :param chunk_size: The maximum number of timestamps in each chunk.
+    :return: A generator that yields float64 arrays with the timestamps.
+    """
+    chunk = np.empty(chunk_size, dtype=np.float64)
+    n = 0
+    delay = _min_poll_delay
+
+    while True:
+        frame, val = ffplayer.get_frame(show=False)
+
+        assert val != 'paused'
+        if val == 'eof':
+            break
+        if frame is None:
+            time.sleep(delay)
+            delay = min(2 * delay, _max_poll_delay)
+            continue
+
+        delay = _min_poll_delay
+        chunk[n] = frame[1]
+        n += 1
+        if n == chunk_size:
+            yield chunk
+            chunk = np.empty(chunk_size, dtype=np.float64)
+            n = 0
+
+    if n:
+        yield chunk[:n]
+
+
+class VideoDataCache:
+    """On-disk cache of the timestamps and metadata of video files, as
+    returned by :func:`get_video_file_data`.
+
+    Each video file is identified by its full path, size and modification
+    time, so if the video file changes it will be read again. Each entry is
+    stored as a ``.npz`` file in :attr:`root`, containing the timestamps array
+    and the metadata encoded as JSON.
+
+    When the total size of the cache exceeds :attr:`max_size`, the least
+    recently used entries are removed.
+
+    E.g.::
+
+        cache = VideoDataCache('/home/user/.cache/glitter2/videos')
+        timestamps, metadata = get_video_file_data(filename, cache=cache)
+    """
+
+    root: str = ''
+    """The directory where the cache files are stored.
+    """
+
+    max_size: int = 0
+    """The maximum total size in bytes of the cache files.
+    """
+
+    def __init__(self, root: str, max_size: int = 256 * 1024 * 1024):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_size = max_size
+
+    def get_cache_filename(self, filename: str) -> str:
+        """Returns the filename of the cache file for the given video file.
+
+        It raises an ``OSError`` if the video file doesn't exist.
+        """
+        filename = os.path.abspath(os.path.expanduser(filename))
+        stat = os.stat(filename)
+        key = f'{filename}\0{stat.st_size}\0{stat.st_mtime_ns}'
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.root, f'{name}.npz')
+
+    @staticmethod
+    def _encode_metadata(value):
+        # json can't save bytes and saves tuples as lists, so mark them to be
+        # restored
+        if isinstance(value, bytes):
+            return {'__bytes__': value.hex()}
+        if isinstance(value, tuple):
+            return {'__tuple__': [
+                VideoDataCache._encode_metadata(v) for v in value]}
+        if isinstance(value, list):
+            return [VideoDataCache._encode_metadata(v) for v in value]
+        if isinstance(value, dict):
+            return {
+                k: VideoDataCache._encode_metadata(v)
+                for k, v in value.items()}
+        return value
+
+    @staticmethod
+    def _decode_metadata_item(value: dict):
+        if list(value) == ['__tuple__']:
+            return tuple(value['__tuple__'])
+        if list(value) == ['__bytes__']:
+            return bytes.fromhex(value['__bytes__'])
+        return value
+
+    def get(self, filename: str) -> Optional[Tuple[np.ndarray, dict]]:
+        """Returns the cached ``(timestamps, metadata)`` of the video file,
+        or None if it is not in the cache.
+        """
+        cache_filename = self.get_cache_filename(filename)
+        if not os.path.exists(cache_filename):
+            return None
+
+        try:
+            with np.load(cache_filename) as data:
+                timestamps = data['timestamps']
+                metadata = json.loads(
+                    str(data['metadata']),
+                    object_hook=self._decode_metadata_item)
+        except (OSError, KeyError, ValueError) as e:
+            Logger.warning(
+                f'Glitter2: Failed to read the cache file "{cache_filename}" '
+                f'of "{filename}": {e!r}')
+            return None
+
+        # mark it as recently used
+        try:
+            os.utime(cache_filename)
+        except OSError:
+            pass
+        return timestamps, metadata
+
+    def put(self, filename: str, timestamps: np.ndarray, metadata: dict):
+        """Adds the timestamps and metadata of the video file to the cache,
+        removing the least recently used entries if the cache is too large.
+        """
+        cache_filename = self.get_cache_filename(filename)
+        os.makedirs(self.root, exist_ok=True)
+
+        # write to a temp file first so readers never see a partial file
+        temp = NamedTemporaryFile(
+            suffix='.npz', prefix='.tmp_', dir=self.root, delete=False)
+        try:
+            with temp:
+                np.savez(
+                    temp, timestamps=np.asarray(timestamps, dtype=np.float64),
+                    metadata=np.array(
+                        json.dumps(self._encode_metadata(metadata))))
+            os.replace(temp.name, cache_filename)
+        except BaseException:
+            os.remove(temp.name)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the total size of
+        the cache is at most :attr:`max_size`.
+        """
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.endswith('.npz') and \
+                        not entry.name.startswith('.tmp_'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+
+def get_video_file_data(
+        filename: str, metadata_only: bool = False,
+        cache: Optional[VideoDataCache] = None
+) -> Tuple[np.ndarray, dict]:
+    """Returns the timestamps and metadata of the video file.
+
+    :param filename: The filename of the video file.
+    :param metadata_only: If True, the timestamps are not read and the
+        returned timestamps array is empty.
+    :param cache: An optional :class:`VideoDataCache`. If provided, the data
+        is read from the cache if present, otherwise it's added to the
+        cache once read.
+    :return: A 2-tuple of the float64 array of all the timestamps and the
+        metadata dict.
+    """
+    if cache is not None:
+        cached = cache.get(filename)
+        if cached is not None:
+            timestamps, metadata = cached
+            if metadata_only:
+                return np.empty(0, dtype=np.float64), metadata
+            return timestamps, metadata
+
+    ffplayer, metadata = open_video_file(filename)
+    try:
+        if metadata_only:
+            return np.empty(0, dtype=np.float64), metadata
+
+        chunks = list(iter_video_timestamps(ffplayer))
+    finally:
+        ffplayer.close_player()
+
+    if chunks:
+        timestamps = np.concatenate(chunks)
+    else:
+        timestamps = np.empty(0, dtype=np.float64)
+
+    if cache is not None:
+        cache.put(filename, timestamps, metadata)
+    return timestamps, metadata
+
+
+def get_videos_file_data(
+        filenames: Iterable[str], metadata_only: bool = False,
+        max_workers: Optional[int] = None,
+        cache: Optional[VideoDataCache] = None
+) -> Generator[Tuple[np.ndarray, dict], None, None]:
+    """Similar to :func:`get_video_file_data`, but reads the data of multiple
+    video files in parallel using a process pool.
+
+    :param filenames: The filenames of the video files.
+    :param metadata_only: See :func:`get_video_file_data`.
+    :param max_workers: The maximum number of worker processes to use. If
+        None, it's the number of CPUs.
+    :param cache: See :func:`get_video_file_data`.
+    :return: A generator that yields the :func:`get_video_file_data` result
+        for each video file, in the same order as ``filenames``.
+    """
+    filenames: List[str] = list(filenames)
+    if not filenames:
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(
+            partial(
+                get_video_file_data, metadata_only=metadata_only,
+                cache=cache),
+            filenames)
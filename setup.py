@@ -48,5 +48,7 @@ setup(
         'Source': URL,
     },
     entry_points={
-        'console_scripts': ['glitter2=glitter2.main:run_app']},
+        'console_scripts': [
+            'glitter2=glitter2.main:run_app',
+            'glitter2-batch=glitter2.batch:main']},
 )